@@ -1,5 +1,7 @@
 import asyncio
+import html
 import secrets
+import time
 import sqlite3
 from aiogram import Router, types, F
 from aiogram.filters import Command, CommandObject
@@ -7,8 +9,9 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from bot.settings import ADMINS
-from bot.services import db
+from bot.services import adb
 from bot.services import api
+from bot.views import sqlprof
 
 router = Router()
 
@@ -72,24 +75,29 @@ def kb_broadcast_controls() -> InlineKeyboardMarkup:
     ])
 
 
-def render_admin_header() -> str:
-    with db.db() as con:
-        u = con.execute("SELECT COUNT(*) FROM users").fetchone()[0] or 0
-        d = con.execute("SELECT COUNT(*) FROM devices WHERE status!='deleted'").fetchone()[0] or 0
-        bal = con.execute("SELECT COALESCE(SUM(balance_cents),0) FROM users").fetchone()[0] or 0
-    return (
+async def render_admin_header() -> str:
+    c = await adb.counts_summary()
+    today = int(time.time()) // 86400 * 86400
+    topup_day = await adb.payments_sum_since(today, "card")
+    topup_30d = await adb.payments_sum_since(today - 29 * 86400, "card")
+    q = await adb.node_ops_backlog()
+    text = (
         "👮 <b>Админ-панель</b>\n\n"
-        f"👤 Юзеров: <b>{u}</b>\n"
-        f"📱 Устройств: <b>{d}</b>\n"
-        f"💰 Баланс суммарный: <b>{bal//100} ₽</b>"
+        f"👤 Юзеров: <b>{c['users']}</b>\n"
+        f"📱 Устройств: <b>{c['devices']}</b>\n"
+        f"💰 Баланс суммарный: <b>{c['balance_total_cents']//100} ₽</b>\n"
+        f"💳 Пополнения: сегодня <b>{topup_day//100} ₽</b>, за 30 дней <b>{topup_30d//100} ₽</b>"
     )
+    if q["queued"]:
+        text += f"\n⏳ Операций на нодах в очереди повторов: <b>{q['queued']}</b>"
+    return text
 
 
 @router.message(Command("admin"))
 async def admin_root(message: types.Message):
     if not admin_only(message.from_user.id):
         return
-    await message.answer(render_admin_header(), parse_mode="HTML", reply_markup=kb_admin_menu())
+    await message.answer(await render_admin_header(), parse_mode="HTML", reply_markup=kb_admin_menu())
 
 
 @router.callback_query(F.data == "admin_menu")
@@ -98,7 +106,7 @@ async def admin_menu(cq: types.CallbackQuery):
         await cq.answer()
         return
     _AWAITING_BROADCAST.discard(cq.from_user.id)
-    text = render_admin_header()
+    text = await render_admin_header()
     try:
         await cq.message.edit_text(text, parse_mode="HTML", reply_markup=kb_admin_menu())
     except TelegramBadRequest:
@@ -108,6 +116,45 @@ async def admin_menu(cq: types.CallbackQuery):
             pass
     await cq.answer()
 
+async def _page_traffic(tg_ids: list[int]) -> dict[int, tuple[int, int]]:
+    """Трафик всех устройств страницы: один /traffic на ноду, ноды опрашиваются параллельно."""
+    if not tg_ids:
+        return {}
+    devs = await adb.devices_for_users(tg_ids)
+
+    owner: dict[str, int] = {}
+    per_node: dict[str, list[str]] = {}
+    for d in devs:
+        ident = (d["sub_id"] or "").strip() or (d["uuid"] or "").strip()
+        if not ident:
+            continue
+        owner[ident] = int(d["tg_id"])
+        base = (d["server_base"] or "").strip()
+        # устройство без server_base ищем на всех нодах — идентификаторы уникальны
+        for b in ([base] if base else api.all_bases()):
+            per_node.setdefault(b, []).append(ident)
+
+    nodes = list(per_node)
+    answers = await asyncio.gather(
+        *(api.fetch_traffic_bulk(per_node[b], base=b) for b in nodes),
+        return_exceptions=True,
+    )
+
+    out: dict[int, tuple[int, int]] = {}
+    seen: set[str] = set()
+    for got in answers:
+        if not isinstance(got, dict):
+            continue
+        for ident, (u, v) in got.items():
+            if ident in seen or ident not in owner:
+                continue
+            seen.add(ident)
+            tid = owner[ident]
+            up, dn = out.get(tid, (0, 0))
+            out[tid] = (up + u, dn + v)
+    return out
+
+
 @router.callback_query(F.data.startswith("admin:users:"))
 async def admin_users_btn(cq: types.CallbackQuery):
     if not admin_only(cq.from_user.id):
@@ -122,36 +169,12 @@ async def admin_users_btn(cq: types.CallbackQuery):
     limit = 20
 
 
-    with db.db() as con:
-        rows = con.execute("""
-            SELECT
-                u.tg_id,
-                COALESCE(u.username, '') AS username,
-                u.balance_cents,
-                (SELECT COUNT(*) FROM devices d
-                  WHERE d.tg_id = u.tg_id AND d.status != 'deleted') AS devs
-            FROM users u
-            ORDER BY u.created_at DESC
-            LIMIT ? OFFSET ?
-        """, (limit + 1, offset)).fetchall()
+    rows = await adb.users_page(offset, limit + 1)
 
     has_more = len(rows) > limit
     rows = rows[:limit]
 
-
-    traffic_map: dict[int, tuple[int, int]] = {}
-    mgr = await api.list_users()
-    if isinstance(mgr, list):
-        for u in mgr:
-            name = (u.get("name") or "").strip()
-            if name.startswith("tg_"):
-                try:
-                    tid = int(name[3:])
-                except Exception:
-                    continue
-                up = int(u.get("upload_bytes") or 0)
-                dn = int(u.get("download_bytes") or 0)
-                traffic_map[tid] = (up, dn)
+    traffic_map = await _page_traffic([int(r["tg_id"]) for r in rows])
 
     lines: list[str] = []
 
@@ -165,33 +188,7 @@ async def admin_users_btn(cq: types.CallbackQuery):
         devs_cnt = int(r["devs"] or 0)
 
 
-        up = dn = 0
-        try:
-            with db.db() as con2:
-                devs = con2.execute(
-                    "SELECT sub_id, uuid FROM devices "
-                    "WHERE tg_id = ? AND status != 'deleted'",
-                    (tg_id,)
-                ).fetchall()
-
-            for d in devs or []:
-                sub_id = (d["sub_id"] or "").strip()
-                uuid_  = (d["uuid"]  or "").strip()
-                ident  = sub_id or uuid_
-                if ident:
-                    u, v = await api.fetch_live_traffic_by_ident(ident)  # (upload, download)
-                    up += int(u or 0)
-                    dn += int(v or 0)
-        except Exception:
-
-            pass
-
-
-        if (up + dn) == 0:
-            tup = traffic_map.get(tg_id)
-            if tup:
-                up, dn = tup
-
+        up, dn = traffic_map.get(tg_id, (0, 0))
         total = up + dn
         traffic_str = (
             f" {human_bytes(total)} (↑{human_bytes(up)} / ↓{human_bytes(dn)})"
@@ -241,6 +238,47 @@ async def admin_genpromo_prompt(cq: types.CallbackQuery):
     await cq.answer()
 
 
+@router.message(Command("dbstats"))
+async def dbstats_cmd(message: types.Message, command: CommandObject):
+    """/dbstats [N] [total_ms|max_ms|calls|rows|slow] — худшие формы SQL; /dbstats reset."""
+    if not admin_only(message.from_user.id):
+        return
+    if not sqlprof.ENABLED:
+        await message.answer("Профилирование SQL выключено (DB_PROFILE=1 и перезапуск).")
+        return
+
+    args = (command.args or "").split()
+    if args[:1] == ["reset"]:
+        sqlprof.reset()
+        await message.answer("Статистика SQL сброшена.")
+        return
+    limit = int(args[0]) if args and args[0].isdigit() else 10
+    order = args[1] if len(args) > 1 else "total_ms"
+    if order not in ("total_ms", "max_ms", "calls", "rows", "slow"):
+        await message.answer("Сортировка: total_ms | max_ms | calls | rows | slow")
+        return
+
+    rows = sqlprof.top(min(limit, 30), order)
+    if not rows:
+        await message.answer("Запросов пока не было.")
+        return
+
+    lines = [f"🐢 <b>SQL по {html.escape(order)}</b> (медленные ≥ {sqlprof.SLOW_MS:.0f} мс)\n"]
+    size = len(lines[0])
+    for i, r in enumerate(rows, 1):
+        p95 = f"{r['p95_ms']}" if r["p95_ms"] is not None else f">{sqlprof.BUCKETS_MS[-1]}"
+        item = (
+            f"{i}. <b>{r['total_ms']:.0f} мс</b> · {r['calls']} выз · avg {r['avg_ms']:.2f} · "
+            f"p95≤{p95} · max {r['max_ms']:.0f} · строк {r['rows']} · медл. {r['slow']}\n"
+            f"<code>{html.escape(r['sql'][:300])}</code>"
+        )
+        size += len(item) + 1
+        if size > 4000:  # лимит Telegram; режем по целым записям, чтобы не порвать HTML
+            break
+        lines.append(item)
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
 @router.message(Command("genpromo"))
 async def genpromo_cmd(message: types.Message, command: CommandObject):
     if not admin_only(message.from_user.id):
@@ -272,11 +310,7 @@ async def genpromo_cmd(message: types.Message, command: CommandObject):
         return
 
     try:
-        with db.db() as con:
-            con.execute(
-                "INSERT INTO promos(code, amount_cents, uses_left) VALUES(?,?,?)",
-                (code, amount_rub * 100, uses)
-            )
+        await adb.create_promo(code, amount_rub * 100, uses)
         await message.answer(
             f"✅ Промокод создан\nКод: <code>{code}</code>\nНоминал: {amount_rub} ₽\nИспользований: {uses}",
             parse_mode="HTML"
@@ -303,11 +337,7 @@ async def genpromo_with_code(message: types.Message):
         return
 
     try:
-        with db.db() as con:
-            con.execute(
-                "INSERT INTO promos(code, amount_cents, uses_left) VALUES(?,?,?)",
-                (code, amount_rub * 100, uses)
-            )
+        await adb.create_promo(code, amount_rub * 100, uses)
         await message.answer(
             f"✅ Промокод создан\nКод: <code>{code}</code>\nНоминал: {amount_rub} ₽\nИспользований: {uses}",
             parse_mode="HTML"
@@ -333,11 +363,7 @@ async def genpromo_plain(message: types.Message):
 
     code = secrets.token_urlsafe(10)
     try:
-        with db.db() as con:
-            con.execute(
-                "INSERT INTO promos(code, amount_cents, uses_left) VALUES(?,?,?)",
-                (code, amount_rub * 100, uses)
-            )
+        await adb.create_promo(code, amount_rub * 100, uses)
         await message.answer(
             f"✅ Промокод создан\nКод: <code>{code}</code>\nНоминал: {amount_rub} ₽\nИспользований: {uses}",
             parse_mode="HTML"
@@ -394,9 +420,7 @@ async def admin_broadcast_catcher(message: types.Message):
         await message.answer("Пустое сообщение, ничего не отправил.")
         return
 
-    with db.db() as con:
-        rows = con.execute("SELECT DISTINCT tg_id FROM users").fetchall()
-    recipients = [int(r[0]) for r in rows if r and r[0]]
+    recipients = await adb.all_user_ids()
 
     total = len(recipients)
     sent = 0
@@ -2,19 +2,19 @@ from __future__ import annotations
 from aiogram import Router, types, F
 from bot.keyboards.common import main_kb
 from bot.views.render import main_menu_text
-from bot.services import db
+from bot.services import adb
 
 router = Router()
 
 async def _user_devices(tg_id: int) -> list[dict]:
 
-    return db.list_devices(tg_id)
+    return await adb.list_devices(tg_id)
 
 @router.callback_query(F.data == "home")
 async def cb_home(cq: types.CallbackQuery):
     tg_id = cq.from_user.id
     devices = await _user_devices(tg_id)
-    balance_cents = db.get_balance_cents(tg_id)
+    balance_cents = await adb.get_balance_cents(tg_id)
 
 
     active_devices = sum(1 for d in devices if str(d.get("status", "")).lower() == "active")
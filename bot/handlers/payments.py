@@ -5,7 +5,7 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramAPIError
 
 from bot.keyboards.common import pay_kb, back_kb
-from bot.services import db
+from bot.services import adb, db
 from bot.settings import MONTHLY_FEE
 from bot.services.yookassa_pay import create_payment_link
 
@@ -21,7 +21,7 @@ async def cb_pay(cq: types.CallbackQuery):
 async def cb_pay_card(cq: types.CallbackQuery):
     tg_id = cq.from_user.id
 
-    devices = db.list_devices(tg_id)
+    devices = await adb.list_devices(tg_id)
     active = sum(1 for d in devices if str(d.get("status", "")).lower() == "active")
 
     buttons = [[InlineKeyboardButton(text="💳 60 ₽", callback_data="pay:card:60")]]
@@ -55,6 +55,11 @@ async def cb_pay_card_amount(cq: types.CallbackQuery):
         await cq.answer()
         return
 
+    try:
+        await adb.record_yk_payment(resp["payment_id"], tg_id, amount * 100, resp.get("order_id"))
+    except Exception as e:
+        logging.warning("[pay] record yk payment %s failed: %s", resp.get("payment_id"), e)
+
     url = resp["url"]
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить", url=url)],
@@ -82,36 +87,15 @@ async def catch_promo(message: types.Message):
     code = message.text.strip()
     tg_id = message.from_user.id
 
-    with db.db() as con:
-        used = con.execute(
-            "SELECT 1 FROM payments WHERE tg_id=? AND method='promo' AND ref=? LIMIT 1",
-            (tg_id, code)
-        ).fetchone()
-        if used:
-            await message.answer("Вы уже активировали этот промокод.")
-            return
-
-        row = con.execute(
-            "SELECT amount_cents, uses_left FROM promos WHERE code=?",
-            (code,)
-        ).fetchone()
-
-        if not row or int(row["uses_left"]) <= 0:
-            await message.answer("Промокод не найден или уже использован.")
-            return
-
-        cur = con.execute(
-            "UPDATE promos SET uses_left = uses_left - 1 WHERE code=? AND uses_left > 0",
-            (code,)
-        )
-        if cur.rowcount == 0:
-            await message.answer("Промокод уже использован.")
-            return
-
-        amount_cents = int(row["amount_cents"])
-
-    db.add_balance(tg_id, amount_cents, method="promo", ref=code)
-    await message.answer("✅ Промокод активирован.")
+    status, _ = await adb.redeem_promo_code(tg_id, code)
+    if status == "already_used":
+        await message.answer("Вы уже активировали этот промокод.")
+    elif status == "not_found":
+        await message.answer("Промокод не найден или уже использован.")
+    elif status == "exhausted":
+        await message.answer("Промокод уже использован.")
+    else:
+        await message.answer("✅ Промокод активирован.")
 
 
 # === ФОНОВЫЙ УВЕДОМИТЕЛЬ КАРТОЧНЫХ ПЛАТЕЖЕЙ ===
@@ -124,11 +108,7 @@ async def run_card_payment_notifier(bot: Bot, poll_interval: float = 2.0):
     """
     last_id = 0
     try:
-        with db.db() as con:
-            row = con.execute(
-                "SELECT COALESCE(MAX(id),0) FROM payments WHERE method='card'"
-            ).fetchone()
-            last_id = int(row[0] or 0)
+        last_id = await adb.max_payment_id("card")
     except Exception as e:
         log.warning("[card_notifier] init last_id failed: %s", e)
 
@@ -137,17 +117,7 @@ async def run_card_payment_notifier(bot: Bot, poll_interval: float = 2.0):
     backoff = 1.0
     while True:
         try:
-            with db.db() as con:
-                rows = con.execute(
-                    """
-                    SELECT id, tg_id, amount_cents, ref, created_at
-                    FROM payments
-                    WHERE method='card' AND id > ?
-                    ORDER BY id ASC
-                    LIMIT 300
-                    """,
-                    (last_id,)
-                ).fetchall()
+            rows = await adb.payments_after("card", last_id, 300)
 
             if not rows:
                 backoff = 1.0
@@ -159,8 +129,10 @@ async def run_card_payment_notifier(bot: Bot, poll_interval: float = 2.0):
                 tg_id = int(r["tg_id"])
                 rub   = int(r["amount_cents"]) // 100
 
+                # платёж зачислен вебхуком в другом процессе — кэш этого процесса о нём не знает
+                db.forget_user(tg_id)
                 try:
-                    balance_rub = db.get_balance_cents(tg_id) // 100
+                    balance_rub = (await adb.get_balance_cents(tg_id)) // 100
                 except Exception:
                     balance_rub = None
 
@@ -3,7 +3,7 @@ import logging
 from typing import Sequence, Tuple, Any, Dict, Optional
 from aiogram import Bot
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramAPIError
-from bot.services import db
+from bot.services import adb
 
 from aiogram import Router
 router = Router()
@@ -12,11 +12,7 @@ log = logging.getLogger(__name__)
 async def run_referral_notifier(bot: Bot, poll_interval: float = 2.0):
     last_id = 0
     try:
-        with db.db() as con:
-            row = con.execute(
-                "SELECT COALESCE(MAX(id),0) FROM payments WHERE method='referral'"
-            ).fetchone()
-            last_id = int(row[0] or 0)
+        last_id = await adb.max_payment_id("referral")
     except Exception as e:
         log.warning("[referral_notifier] init last_id failed: %s", e)
 
@@ -25,18 +21,7 @@ async def run_referral_notifier(bot: Bot, poll_interval: float = 2.0):
     backoff = 1.0
     while True:
         try:
-            rows: Sequence[Dict[str, Any]]
-            with db.db() as con:
-                rows = con.execute(
-                    """
-                    SELECT id, tg_id, amount_cents, ref, created_at
-                    FROM payments
-                    WHERE method='referral' AND id > ?
-                    ORDER BY id ASC
-                    LIMIT 200
-                    """,
-                    (last_id,)
-                ).fetchall()
+            rows: Sequence[Dict[str, Any]] = await adb.payments_after("referral", last_id, 200)
 
             if not rows:
                 backoff = 1.0
@@ -4,7 +4,7 @@ from aiogram.filters import Command, CommandObject
 
 from bot.keyboards.common import first_start_kb, main_kb, os_kb
 from bot.views.render import promo_text, main_menu_text
-from bot.services import db, api
+from bot.services import adb, api
 import logging, html
 
 router = Router()
@@ -12,19 +12,17 @@ router = Router()
 WELCOME_BONUS_CENTS = 20 * 100  # 20 ₽
 
 async def _user_devices(tg_id: int) -> list[dict]:
-    return db.list_devices(tg_id)
+    return await adb.list_devices(tg_id)
 
-def _username_from_db_or_tg(tg_id: int, tg_username: str | None) -> str | None:
-    with db.db() as con:
-        r = con.execute("SELECT username FROM users WHERE tg_id=?", (tg_id,)).fetchone()
-        return (r["username"] if r and r["username"] else (tg_username or None))
+async def _username_from_db_or_tg(tg_id: int, tg_username: str | None) -> str | None:
+    return (await adb.get_username(tg_id)) or (tg_username or None)
 
 
 @router.message(Command("start"))
 async def start(message: types.Message, command: CommandObject):
     tg_id = message.from_user.id
-    db.ensure_user(tg_id)
-    db.update_username(tg_id, (message.from_user.username or "").strip())
+    await adb.ensure_user(tg_id)
+    await adb.update_username(tg_id, (message.from_user.username or "").strip())
 
 
     try:
@@ -38,12 +36,12 @@ async def start(message: types.Message, command: CommandObject):
     devices = await _user_devices(tg_id)
 
 
-    if not devices and not db.got_welcome(tg_id):
+    if not devices and not await adb.got_welcome(tg_id):
         await message.answer(promo_text(), reply_markup=first_start_kb())
         return
 
 
-    balance_cents = db.get_balance_cents(tg_id)
+    balance_cents = await adb.get_balance_cents(tg_id)
     active_devices = sum(1 for d in devices if str(d.get("status", "")).lower() == "active")
 
 
@@ -61,13 +59,13 @@ async def start(message: types.Message, command: CommandObject):
 @router.callback_query(F.data == "welcome_activate")
 async def cb_welcome_activate(cq: types.CallbackQuery):
     tg_id = cq.from_user.id
-    db.ensure_user(tg_id)
-    db.update_username(tg_id, (cq.from_user.username or "").strip())
+    await adb.ensure_user(tg_id)
+    await adb.update_username(tg_id, (cq.from_user.username or "").strip())
 
     note = ""
-    if not db.got_welcome(tg_id):
-        db.add_balance(tg_id, WELCOME_BONUS_CENTS, method="promo", ref="welcome")
-        db.set_welcome_given(tg_id)
+    if not await adb.got_welcome(tg_id):
+        await adb.add_balance(tg_id, WELCOME_BONUS_CENTS, method="promo", ref="welcome")
+        await adb.set_welcome_given(tg_id)
         note = "✅ Начислено 20 ₽ приветственного бонуса.\n\n"
 
     await cq.message.edit_text(
@@ -2,7 +2,6 @@ import asyncio
 import logging
 from aiogram import Router, F, types
 from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
-import time
 from bot.keyboards.common import (
     os_kb,
     first_buy_kb,
@@ -13,13 +12,15 @@ from bot.keyboards.common import (
     key_actions_kb
 )
 from bot.views.render import os_instruction
-from bot.services import api, db
+from bot.services import api, adb
+from bot.services.cache import TTLMap
 from bot.settings import DEFAULT_DAYS, MONTHLY_FEE, API_URL
 from bot.settings import MAX_DEVICES_PER_USER
 
 router = Router()
 
-_REFRESH_READY: dict[tuple[int, str], float] = {}
+# (tg_id, устройство) -> пользователь видел предупреждение; окно подтверждения 90 сек
+_REFRESH_READY = TTLMap(maxsize=10_000, ttl=90)
 
 
 async def safe_edit(msg: types.Message, text: str, retries: int = 3, **kwargs):
@@ -48,7 +49,12 @@ async def safe_answer(cq: types.CallbackQuery, text: str = "", show_alert: bool
 
 
 async def _user_devices(tg_id: int) -> list[dict]:
-    return db.list_devices(tg_id)
+    return await adb.list_devices(tg_id)
+
+def _sub_url(ident: str, server_base: str | None = None) -> str:
+    # ссылка на подписку — с той ноды, где живёт устройство
+    base = (server_base or API_URL).rstrip("/")
+    return f"{base}/sub/{ident}?b64=1"
 
 def _next_device_name(os_code: str, existing: list[dict], uuid: str | None = None) -> str:
 
@@ -73,22 +79,18 @@ def _next_device_name(os_code: str, existing: list[dict], uuid: str | None = Non
             return cand
         i += 1
 
-def _find_device_local(device_id: str, tg_id: int) -> dict | None:
+async def _find_device_local(device_id: str, tg_id: int) -> dict | None:
     try:
-        d = db.device_by_uuid(device_id)
+        d = await adb.device_by_uuid(device_id)
         if d and d.get("tg_id") == tg_id and d.get("status") != "deleted":
             return d
     except Exception:
         pass
     for field in ("id", "name"):
         try:
-            with db.db() as con:
-                r = con.execute(
-                    f"SELECT * FROM devices WHERE {field}=? AND tg_id=? AND status!='deleted'",
-                    (int(device_id) if field == "id" else device_id, tg_id)
-                ).fetchone()
-                if r:
-                    return dict(r)
+            r = await adb.user_device(tg_id, field, int(device_id) if field == "id" else device_id)
+            if r:
+                return r
         except Exception:
             pass
     return None
@@ -176,7 +178,7 @@ async def buy_create(cq: types.CallbackQuery):
     logging.info(f"[buy_create] Creating device name={name} for uuid={uuid_}")
 
     try:
-        db.add_device(
+        await adb.add_device(
             tg_id=cq.from_user.id,
             uuid=uuid_,
             name=name,
@@ -206,7 +208,7 @@ async def buy_create(cq: types.CallbackQuery):
         return
 
     ident = sub_id or uuid_
-    sub = f"{API_URL.rstrip('/')}/sub/{ident}?b64=1"
+    sub = _sub_url(ident, server_base)
     text = os_instruction(os_code) + f"\n\n<b>Ваша ссылка:</b>\n<code>{sub}</code>"
     done_kb = types.InlineKeyboardMarkup(
         inline_keyboard=[
@@ -256,7 +258,7 @@ async def devices_list(cq: types.CallbackQuery):
 @router.callback_query(F.data.regexp(r"^dev:.+?:open$"))
 async def dev_open(cq: types.CallbackQuery):
     _, dev_id, _ = cq.data.split(":", 2)
-    d = _find_device_local(dev_id, cq.from_user.id)
+    d = await _find_device_local(dev_id, cq.from_user.id)
     if not d:
         await safe_answer(cq, "Устройство не найдено", show_alert=True)
         return
@@ -277,7 +279,7 @@ async def dev_open(cq: types.CallbackQuery):
         await safe_answer(cq)
         return
 
-    sub = f"{API_URL.rstrip('/')}/sub/{ident}?b64=1"
+    sub = _sub_url(ident, d.get("server_base"))
 
     text = (
         f"Устройство: <b>{name}</b>\n"
@@ -306,7 +308,7 @@ async def dev_open(cq: types.CallbackQuery):
 @router.callback_query(F.data.regexp(r"^dev:.+?:key$"))
 async def dev_key(cq: types.CallbackQuery):
     _, dev_id, _ = cq.data.split(":", 2)
-    d = _find_device_local(dev_id, cq.from_user.id)
+    d = await _find_device_local(dev_id, cq.from_user.id)
     if not d:
         await safe_answer(cq, "Устройство не найдено", show_alert=True)
         return
@@ -323,7 +325,7 @@ async def dev_key(cq: types.CallbackQuery):
         return
 
     ident = sub_id or uuid_
-    sub = f"{API_URL.rstrip('/')}/sub/{ident}?b64=1"
+    sub = _sub_url(ident, d.get("server_base"))
     text = os_instruction((d.get("os") or "").lower()) + f"\n\n<b>Ваша ссылка:</b>\n<code>{sub}</code>"
 
     await safe_edit(
@@ -338,20 +340,18 @@ async def dev_key(cq: types.CallbackQuery):
 @router.callback_query(F.data.regexp(r"^dev:.+?:refresh$"))
 async def dev_refresh(cq: types.CallbackQuery):
     _, dev_id, _ = cq.data.split(":", 2)
-    d = _find_device_local(dev_id, cq.from_user.id)
+    d = await _find_device_local(dev_id, cq.from_user.id)
     if not d:
         await safe_answer(cq, "Устройство не найдено", show_alert=True)
         return
 
     uuid_cur = (d.get("uuid") or "").strip()
     sub_id   = (d.get("sub_id") or "").strip()
+    base     = (d.get("server_base") or "").strip() or None
 
 
     key = (cq.from_user.id, str(d.get("uuid") or d.get("id") or dev_id))
-    now = time.time()
-    ready_until = _REFRESH_READY.get(key, 0)
-    if now > ready_until:
-        _REFRESH_READY[key] = now + 90  # окно подтверждения 90 сек
+    if _REFRESH_READY.claim(key):
         await safe_answer(
             cq,
             "⚠️ Перед обновлением ключа отключите VPN в приложении.\n\n"
@@ -363,15 +363,13 @@ async def dev_refresh(cq: types.CallbackQuery):
 
     if not sub_id and uuid_cur:
         try:
-            sub_found = await api.resolve_sub_id_from_uuid(uuid_cur)
+            sub_found = await api.resolve_sub_id_from_uuid(uuid_cur, base=base)
         except Exception:
             sub_found = None
         if sub_found:
             sub_id = sub_found
             try:
-                with db.db() as con:
-                    con.execute("UPDATE devices SET sub_id=? WHERE id=?", (sub_id, d["id"]))
-                    con.commit()
+                await adb.set_device_sub_id_by_id(d["id"], sub_id)
             except Exception:
                 pass
 
@@ -380,7 +378,7 @@ async def dev_refresh(cq: types.CallbackQuery):
         await safe_answer(cq, "sub_id не найден для этого устройства.", show_alert=True)
         return
 
-    resp = await api.refresh_by_sub_id(sub_id)
+    resp = await api.refresh_by_sub_id(sub_id, base=base)
     if isinstance(resp, dict) and resp.get("_error"):
         _REFRESH_READY.pop(key, None)
         await safe_answer(cq, f"Не удалось обновить: {resp['_error']}", show_alert=True)
@@ -392,26 +390,20 @@ async def dev_refresh(cq: types.CallbackQuery):
 
     if new_uuid and new_uuid != uuid_cur:
         try:
-            with db.db() as con:
-                con.execute("UPDATE devices SET uuid=? WHERE id=?", (new_uuid, d["id"]))
-                con.execute(
-                    "INSERT INTO events(tg_id, type, payload, created_at) VALUES(?,?,?,?)",
-                    (cq.from_user.id, "refresh", f"old={uuid_cur} new={new_uuid}", int(time.time()))
-                )
-                con.commit()
+            await adb.replace_device_uuid(d["id"], cq.from_user.id, uuid_cur, new_uuid)
         except Exception as e:
             logging.exception(f"[dev_refresh] DB write failed: {e}")
 
 
     _REFRESH_READY.pop(key, None)
 
-    d = db.device_by_id(d["id"]) or d
+    d = (await adb.device_by_id(d["id"])) or d
     name   = (d.get("name") or d.get("label") or "Устройство").strip()
     status = (d.get("status") or "—").strip()
     uuid_now = (d.get("uuid") or uuid_cur or "").strip()
     sub_id   = (d.get("sub_id") or "").strip()
     ident    = (sub_id or uuid_now).strip()
-    sub_link = f"{API_URL.rstrip('/')}/sub/{ident}?b64=1"
+    sub_link = _sub_url(ident, d.get("server_base"))
 
     text = (
         f"Устройство: <b>{name}</b>\n"
@@ -439,16 +431,16 @@ async def dev_refresh(cq: types.CallbackQuery):
 @router.callback_query(F.data.regexp(r"^dev:.+?:delete$"))
 async def dev_delete(cq: types.CallbackQuery):
     _, dev_id, _ = cq.data.split(":", 2)
-    d = _find_device_local(dev_id, cq.from_user.id)
+    d = await _find_device_local(dev_id, cq.from_user.id)
     if not d:
         await safe_answer(cq, "Устройство уже удалено", show_alert=True)
         return
     uuid_ = (d.get("uuid") or "").strip()
     try:
-        await api.revoke(uuid_)
+        await api.revoke(uuid_, base=(d.get("server_base") or None))
     except Exception:
         pass
-    db.set_device_status(uuid_, "deleted")
+    await adb.set_device_status(uuid_, "deleted")
     devices = await _user_devices(cq.from_user.id)
     await safe_edit(
         cq.message,
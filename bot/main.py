@@ -7,12 +7,13 @@ from aiogram.enums.parse_mode import ParseMode
 from aiogram.client.default import DefaultBotProperties
 
 from bot.settings import BOT_TOKEN
-from bot.services import db, api
+from bot.services import db, adb, api
 from bot.services.scheduler import run_scheduler
 from bot.services.balance_guard import run_balance_guard
 from bot.handlers.referral import run_referral_notifier
 from bot.services.notify_server import start_notify_server
 from bot.handlers.payments import run_card_payment_notifier
+from bot.services.loop_monitor import run_loop_lag_monitor
 
 logging.basicConfig(level=logging.INFO)
 
@@ -35,35 +36,24 @@ async def run_multi_guard(bot: Bot):
                 old_uuid = item.get("old_uuid")
                 new_uuid = item.get("new_uuid")
 
-                with db.db() as con:
-                    dev = con.execute(
-                        "SELECT tg_id, name FROM devices WHERE sub_id=? AND uuid=?",
-                        (sub_id, old_uuid)
-                    ).fetchone()
-
-                    if dev:
-                        con.execute(
-                            "UPDATE devices SET uuid=? WHERE sub_id=? AND uuid=?",
-                            (new_uuid, sub_id, old_uuid)
-                        )
-                        con.commit()
-
-                        tg_id = dev["tg_id"]
-                        dev_name = dev["name"] or "ваше устройство"
-
-                        try:
-                            await bot.send_message(
-                                tg_id,
-                                (
-                                    "🚫 Нарушение правил!\n\n"
-                                    f"Ключ <b>{dev_name}</b> был использован на нескольких устройствах.\n"
-                                    "Он аннулирован, вам выдан новый.\n\n"
-                                    "⚠️ Обновите VPN в приложении.\n"
-                                    "Многократные нарушения могут привести к блокировке подписки."
-                                )
+                dev = await adb.replace_device_uuid_by_sub(sub_id, old_uuid, new_uuid)
+                if dev:
+                    tg_id = dev["tg_id"]
+                    dev_name = dev["name"] or "ваше устройство"
+
+                    try:
+                        await bot.send_message(
+                            tg_id,
+                            (
+                                "🚫 Нарушение правил!\n\n"
+                                f"Ключ <b>{dev_name}</b> был использован на нескольких устройствах.\n"
+                                "Он аннулирован, вам выдан новый.\n\n"
+                                "⚠️ Обновите VPN в приложении.\n"
+                                "Многократные нарушения могут привести к блокировке подписки."
                             )
-                        except Exception as e:
-                            logging.warning(f"Не смог отправить уведомление {tg_id}: {e}")
+                        )
+                    except Exception as e:
+                        logging.warning(f"Не смог отправить уведомление {tg_id}: {e}")
 
         except Exception as e:
             logging.error(f"multi_guard error: {e}")
@@ -82,8 +72,12 @@ async def main():
     asyncio.create_task(run_referral_notifier(bot))
     asyncio.create_task(run_card_payment_notifier(bot))
     asyncio.create_task(start_notify_server(bot))
+    asyncio.create_task(run_loop_lag_monitor())
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        adb.shutdown()
 
 
 if __name__ == "__main__":
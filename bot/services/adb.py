@@ -0,0 +1,55 @@
+import os
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from bot.services import db
+
+# Асинхронная обёртка над bot.services.db: каждый вызов уходит в пул DB-потоков,
+# event loop не ждёт sqlite. Записи всё равно идут по очереди через писателя db.db().
+#
+#   from bot.services import adb
+#   bal = await adb.get_balance_cents(tg_id)
+#   rows = await adb.run(some_sync_fn, arg)
+
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+SLOW_CALL_SEC = float(os.getenv("DB_SLOW_CALL_SEC", "0.5"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+def _timed(fn: Callable, *args, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        dt = time.perf_counter() - t0
+        if dt >= SLOW_CALL_SEC:
+            logging.warning("[adb] slow %s: %.0f ms", getattr(fn, "__name__", fn), dt * 1000)
+
+
+async def run(fn: Callable, *args, **kwargs) -> Any:
+    """Выполнить синхронную DB-функцию в пуле DB-потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_timed, fn, *args, **kwargs))
+
+
+def __getattr__(name: str):
+    fn = getattr(db, name, None)
+    if name.startswith("_") or not callable(fn):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    @functools.wraps(fn)
+    async def call(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+
+    globals()[name] = call
+    return call
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    db.close()
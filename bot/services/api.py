@@ -1,30 +1,34 @@
 import os
+import time
+import uuid
 import socket
+import asyncio
 import logging
 from typing import Optional, Tuple
+from urllib.parse import quote
 from aiogram import Bot
 import aiohttp
 from aiohttp import ClientSession, ClientTimeout, TCPConnector
 
-from bot.services import db
-
-API_URL = os.getenv("API_URL", "").strip()
-API_URL_2 = os.getenv("API_URL_2", "").strip()
-LOAD_THRESH = int(os.getenv("LOAD_THRESH", "75"))
-API1_CAP = int(os.getenv("API1_CAP", "200"))
-API2_CAP = int(os.getenv("API2_CAP", "200"))
+from bot.services import adb
+from bot.services.backends import router, norm
 
 TIMEOUT = ClientTimeout(total=60, connect=10, sock_connect=10, sock_read=50)
 
+# мутации с тем же Idempotency-Key менеджер не выполняет повторно, а отдаёт сохранённый ответ
+MUTATION_RETRIES = int(os.getenv("API_MUTATION_RETRIES", "2"))
+MUTATION_RETRY_DELAY = 1.0
+_READ_ONLY_POSTS = {"/users/batch", "/traffic"}
+
 def _build_session() -> ClientSession:
     connector = TCPConnector()
     return ClientSession(timeout=TIMEOUT, connector=connector)
 
 def _norm_base(base: Optional[str]) -> str:
-    b = (base or API_URL or "").strip()
+    b = norm(base) or next(iter(router.bases()), "")
     if not b:
         raise RuntimeError("API base URL is not configured")
-    return b.rstrip("/")
+    return b
 
 async def _read(r: aiohttp.ClientResponse, path: str):
     if r.status != 200:
@@ -35,57 +39,149 @@ async def _read(r: aiohttp.ClientResponse, path: str):
         return await r.json()
     return {"_error": f"{path} bad content-type {ct}"}
 
-async def api_post(path: str, payload: dict, base: Optional[str] = None):
+async def _send(method: str, url: str, path: str, **kw):
+    async with _build_session() as s:
+        async with s.request(method, url, **kw) as r:
+            return await _read(r, path), r.status
+
+async def _request(method: str, path: str, base: Optional[str], idem_key: Optional[str] = None, **kw):
+    """Для POST запрос несёт Idempotency-Key (один на весь логический вызов, включая ретраи).
+    Если мутация могла дойти до ноды (таймаут, обрыв, 5xx), на другую ноду она не уходит —
+    повторяем на той же с тем же ключом, иначе получим дубль подписки или двойную ротацию."""
+    tag = f"[api_{method.lower()}]"
+    mutation = method != "GET" and path not in _READ_ONLY_POSTS
+    if mutation:
+        idem_key = idem_key or uuid.uuid4().hex
+        kw["headers"] = {**kw.get("headers", {}), "Idempotency-Key": idem_key}
     bases = [ _norm_base(base) ] if base else await _preferred_bases()
+    if not bases:
+        return {"_error": "no API backends available", "_details": [], "_status": 0}
     errors = []
+    last_status = 0
     for b in bases:
+        if not router.allow(b):
+            errors.append(f"{b}: circuit open")
+            continue
         url = f"{b}{path}"
-        logging.info(f"[api_post] {url} payload={payload}")
+        logging.info(f"{tag} {url} {kw}")
+        attempts = 1 + (MUTATION_RETRIES if mutation else 0)
+        sent, err, ambiguous = False, None, False
         try:
-            async with _build_session() as s:
-                async with s.post(url, json=payload) as r:
-                    data = await _read(r, path)
-                    if isinstance(data, dict) and "_error" not in data:
-                        data.setdefault("_server", b)
-                        logging.info(f"[api_post] {url} -> OK via {b}")
-                        return data
-                    msg = data.get("_error") if isinstance(data, dict) else "non-dict response"
-                    errors.append(f"{b}: {msg}")
-                    logging.warning(f"[api_post] {url} error: {msg}")
-        except Exception as e:
-            errors.append(f"{b}: exception {e}")
-            logging.exception(f"[api_post] {url} failed")
-    return {"_error": f"{path} failed on all backends", "_details": errors}
-
-
-async def api_get(path: str, params: dict | None = None, base: Optional[str] = None):
-    bases = [ _norm_base(base) ] if base else await _preferred_bases()
-    errors = []
-    for b in bases:
-        url = f"{b}{path}"
-        logging.info(f"[api_get] {url} params={params}")
-        try:
-            async with _build_session() as s:
-                async with s.get(url, params=params) as r:
-                    data = await _read(r, path)
-                    if isinstance(data, dict) and "_error" not in data:
-                        data.setdefault("_server", b)
-                        logging.info(f"[api_get] {url} -> OK via {b}")
-                        return data
-                    msg = data.get("_error") if isinstance(data, dict) else "non-dict response"
-                    errors.append(f"{b}: {msg}")
-                    logging.warning(f"[api_get] {url} error: {msg}")
-        except Exception as e:
-            errors.append(f"{b}: exception {e}")
-            logging.exception(f"[api_get] {url} failed")
-    return {"_error": f"{path} failed on all backends", "_details": errors}
+            for attempt in range(attempts):
+                try:
+                    data, status = await _send(method, url, path, **kw)
+                    sent = True
+                    break
+                except aiohttp.ClientConnectorError as e:
+                    # соединение не установлено — запрос точно не дошёл, можно идти на следующую ноду
+                    err, ambiguous = e, False
+                    break
+                except Exception as e:
+                    err, ambiguous = e, mutation
+                    if not ambiguous or attempt + 1 >= attempts:
+                        break
+                    logging.warning(f"{tag} {url} failed: {err!r}, retry {attempt + 1} with same key")
+                    await asyncio.sleep(MUTATION_RETRY_DELAY * (attempt + 1))
+        except asyncio.CancelledError:
+            # отмена — не Exception: без этого нода в HALF_OPEN осталась бы с probing=True навсегда
+            router.release(b)
+            raise
+
+        if not sent:
+            # нода недоступна: размыкаем цепь, дальше она не тормозит горячий путь
+            router.record_failure(b, repr(err))
+            errors.append(f"{b}: exception {err!r}")
+            logging.warning(f"{tag} {url} failed: {err!r}")
+            if ambiguous:
+                break
+            continue
+
+        last_status = status
+        if status >= 500:
+            router.record_failure(b, f"HTTP {status}")
+        else:
+            router.record_success(b)
+        if isinstance(data, dict) and "_error" not in data:
+            data.setdefault("_server", b)
+            logging.info(f"{tag} {url} -> OK via {b}")
+            return data
+        msg = data.get("_error") if isinstance(data, dict) else "non-dict response"
+        errors.append(f"{b}: {msg}")
+        logging.warning(f"{tag} {url} error: {msg}")
+        if mutation and status >= 500:
+            break
+    return {"_error": f"{path} failed on all backends", "_details": errors, "_status": last_status}
+
+async def api_post(path: str, payload: dict, base: Optional[str] = None):
+    return await _request("POST", path, base, json=payload)
+
+
+# --- single-flight для GET: одинаковые параллельные запросы делят один поход на ноду ---
+# Результат общий для всех ожидающих — вызывающие не должны его менять.
+
+GET_CACHE_MAX = 256
+
+_INFLIGHT: dict[tuple, asyncio.Task] = {}
+_GET_CACHE: dict[tuple, tuple[float, dict]] = {}
+SF_STATS = {"requests": 0, "hits": 0, "coalesced": 0, "misses": 0}
+
+
+def _sf_key(path: str, params: dict | None, base: Optional[str]) -> tuple:
+    items = tuple(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+    return (norm(base) or None, path, items)
+
+
+def _cache_put(key: tuple, data: dict, ttl: float):
+    now = time.monotonic()
+    if len(_GET_CACHE) >= GET_CACHE_MAX:
+        for k in [k for k, (exp, _) in _GET_CACHE.items() if exp <= now]:
+            del _GET_CACHE[k]
+        if len(_GET_CACHE) >= GET_CACHE_MAX:
+            _GET_CACHE.pop(next(iter(_GET_CACHE)))
+    _GET_CACHE[key] = (now + ttl, data)
+
+
+async def api_get(path: str, params: dict | None = None, base: Optional[str] = None, ttl: float = 0.0):
+    """ttl > 0 — только для read-only эндпоинтов: ответ без ошибки живёт в кэше ttl секунд."""
+    SF_STATS["requests"] += 1
+    key = _sf_key(path, params, base)
+
+    if ttl > 0:
+        hit = _GET_CACHE.get(key)
+        if hit and hit[0] > time.monotonic():
+            SF_STATS["hits"] += 1
+            return hit[1]
+
+    task = _INFLIGHT.get(key)
+    if task is not None:
+        SF_STATS["coalesced"] += 1
+    else:
+        SF_STATS["misses"] += 1
+        task = asyncio.ensure_future(_request("GET", path, base, params=params))
+        _INFLIGHT[key] = task
+
+        def _done(t: asyncio.Task, key=key, ttl=ttl):
+            _INFLIGHT.pop(key, None)
+            if ttl > 0 and not t.cancelled() and t.exception() is None:
+                data = t.result()
+                if isinstance(data, dict) and not data.get("_error"):
+                    _cache_put(key, data, ttl)
+
+        task.add_done_callback(_done)
+
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+
+def singleflight_stats() -> dict:
+    return {**SF_STATS, "inflight": len(_INFLIGHT), "cached": len(_GET_CACHE)}
 
 
 
 
 async def _sessions_count(base: str) -> Optional[int]:
     try:
-        resp = await api_get("/sessions", {"window": "60", "include_ips": "true"}, base=base)
+        resp = await api_get("/sessions", {"window": "60", "include_ips": "true"}, base=base, ttl=5.0)
         if isinstance(resp, dict):
             if "total" in resp and isinstance(resp["total"], int):
                 return resp["total"]
@@ -97,86 +193,94 @@ async def _sessions_count(base: str) -> Optional[int]:
     except Exception:
         return None
 
-async def _choose_api_base() -> str:
-    primary = (API_URL or "").strip()
-    secondary = (API_URL_2 or "").strip()
-
-
-    if not secondary:
-        return _norm_base(primary)
-
-
-    c1 = await _sessions_count(primary)
-    if isinstance(c1, int) and API1_CAP > 0:
-        load1 = int(c1 * 100 / API1_CAP)
-        logging.info(f"[load] primary {primary} sessions={c1} load≈{load1}% (cap={API1_CAP})")
-        if load1 >= LOAD_THRESH:
-
-            c2 = await _sessions_count(secondary)
-            if isinstance(c2, int) and API2_CAP > 0:
-                load2 = int(c2 * 100 / API2_CAP)
-                logging.info(f"[load] secondary {secondary} sessions={c2} load≈{load2}% (cap={API2_CAP})")
-
-                return _norm_base(secondary)
-
-            return _norm_base(secondary)
-
-        return _norm_base(primary)
+async def _preferred_bases() -> list[str]:
+    # замеры нагрузки кэшируются в роутере (API_LOAD_TTL), так что это не запрос на каждый вызов
+    await router.refresh_load(_sessions_count)
+    # пусто — все ноды с разомкнутой цепью (или одна нода после сбоя): вызывающий отдаёт _error
+    return router.order()
 
-    c2 = await _sessions_count(secondary)
-    if isinstance(c2, int):
-        logging.info(f"[load] primary N/A, using secondary {secondary} sessions={c2}")
-        return _norm_base(secondary)
+async def _choose_api_base() -> Optional[str]:
+    return next(iter(await _preferred_bases()), None)
 
-    logging.info("[load] neither measured; using primary by default")
-    return _norm_base(primary)
+def _all_bases() -> list[str]:
+    return router.bases()
 
-async def _preferred_bases() -> list[str]:
-    best = (await _choose_api_base()).rstrip("/")
-    pri  = (API_URL or "").strip().rstrip("/")
-    sec  = (API_URL_2 or "").strip().rstrip("/")
-    order = [b for b in [best, pri, sec] if b]
-    # убираем дубликаты, сохраняя порядок
-    seen, uniq = set(), []
-    for b in order:
-        if b not in seen:
-            uniq.append(b); seen.add(b)
-    return uniq
-
-async def _bases_order() -> list[str]:
-    primary = (API_URL or "").strip()
-    secondary = (API_URL_2 or "").strip()
-    order: list[str] = []
+def all_bases() -> list[str]:
+    return _all_bases()
 
 
-    try:
-        best = await _choose_api_base()
-    except Exception:
-        best = (primary or secondary or "").strip()
+# --- операции над конкретным устройством идут строго на ноду, где оно создано ---
 
-    if best:
-        order.append(best.rstrip("/"))
+async def _device_call(method: str, path: str, ident: str, base: Optional[str], **kw):
+    owner = base or await adb.device_server_base(ident)
+    if not owner:
+        # старые устройства без server_base: находим ноду по нагрузке и запоминаем её
+        logging.warning(f"[route] {path} {ident}: no server_base, routing by load")
+        resp = await _request(method, path, None, **kw)
+        if isinstance(resp, dict) and not resp.get("_error") and resp.get("_server"):
+            await adb.backfill_device_server_base(ident, resp["_server"])
+        return resp
 
-    for b in (primary, secondary):
-        b = (b or "").strip()
-        if b and b.rstrip("/") not in order:
-            order.append(b.rstrip("/"))
+    resp = await _request(method, path, owner, **kw)
+    if isinstance(resp, dict) and resp.get("_status") == 404:
+        # устройство не нашлось на своей ноде — это ошибка маршрутизации, а не повод идти на соседнюю
+        logging.error(f"[route] miss: {path} {ident} not found on owner {owner}")
+    return resp
 
+LIST_PAGE = 1000
 
-    return [b for b in order if b]
+async def list_users_page(after: int = 0, limit: int = LIST_PAGE, base: Optional[str] = None):
+    # без кэша: страница из прошлого обхода может быть старше версии, от которой пойдёт /changes
+    return await api_get("/list", {"after": str(int(after)), "limit": str(int(limit))}, base=base)
 
 async def list_users(base: Optional[str] = None):
-    return await api_get("/list", base=base)
+    """Все подписки ноды постранично (keyset по id). Для регулярной синхронизации — UserMirror."""
+    items: list[dict] = []
+    after = 0
+    while True:
+        page = await list_users_page(after, base=base)
+        if not isinstance(page, dict) or page.get("_error"):
+            return page
+        items.extend(page.get("items") or [])
+        after = page.get("next_after")
+        if not after:
+            return items
+
+async def fetch_changes(since: int, limit: int = LIST_PAGE, base: Optional[str] = None):
+    return await api_get("/changes", {"since": str(int(since)), "limit": str(int(limit))}, base=base)
+
+async def user_by_uuid(user_uuid: str, base: Optional[str] = None):
+    return await api_get(f"/users/by-uuid/{quote(str(user_uuid), safe='')}", base=base)
+
+async def user_by_sub(sub_id: str, base: Optional[str] = None):
+    return await api_get(f"/users/by-sub/{quote(str(sub_id), safe='')}", base=base)
+
+async def users_by_name(name: str, base: Optional[str] = None) -> Optional[list[dict]]:
+    """Подписки с данным именем; без base опрашиваем все ноды и склеиваем.
+    None — если не ответила ни одна нода."""
+    bases = [base] if base else _all_bases()
+    items: list[dict] = []
+    answered = False
+    for b in bases:
+        resp = await api_get(f"/users/by-name/{quote(str(name), safe='')}", base=b)
+        if isinstance(resp, dict) and not resp.get("_error"):
+            answered = True
+            for u in resp.get("items") or []:
+                u.setdefault("_server", resp.get("_server"))
+                items.append(u)
+    return items if answered else None
+
+async def lookup_users(
+    uuids: list[str] | None = None,
+    sub_ids: list[str] | None = None,
+    names: list[str] | None = None,
+    base: Optional[str] = None,
+):
+    payload = {"uuids": list(uuids or []), "sub_ids": list(sub_ids or []), "names": list(names or [])}
+    return await api_post("/users/batch", payload, base=base)
 
 async def get_user_info(tg_id: int, base: Optional[str] = None):
-    users = await list_users(base=base)
-    if isinstance(users, list):
-        wanted = f"tg_{tg_id}"
-        for u in users:
-            if str(u.get("name")) == wanted:
-                return u
-        return {"_error": f"User {wanted} not found"}
-    return users
+    return await get_user_by_name(f"tg_{tg_id}", base=base)
 
 async def attach_ref(tg_id: int, referrer: int, base: Optional[str] = None):
     return await api_post("/ref/attach", {"tg_id": tg_id, "referrer_tg_id": referrer}, base=base)
@@ -191,44 +295,133 @@ async def admin_stats(base: Optional[str] = None):
     return await api_get("/admin/stats", base=base)
 
 async def get_user_by_name(name: str, base: Optional[str] = None):
-    users = await list_users(base=base)
-    if isinstance(users, list):
-        for u in users:
-            if str(u.get("name")) == name:
-                return u
-        return {"_error": f"user {name} not found"}
-    return users
+    items = await users_by_name(name, base=base)
+    if items is None:
+        return {"_error": f"/users/by-name/{name} failed on all backends"}
+    if items:
+        return items[0]
+    return {"_error": f"user {name} not found"}
 
 async def get_balance(tg_id: int) -> int:
-    balance_cents = db.get_balance_cents(tg_id)
+    balance_cents = await adb.get_balance_cents(tg_id)
     return balance_cents // 100
 
 async def refresh_by_sub_id(sub_id: str, base: Optional[str] = None):
-    return await api_post("/refresh", {"id": sub_id}, base=base)
+    return await _device_call("POST", "/refresh", sub_id, base, json={"id": sub_id})
 
 async def refresh_sub(identifier: str, base: Optional[str] = None):
     return await refresh_by_sub_id(identifier, base=base)
 
 async def resolve_sub_id_from_uuid(cur_uuid: str, base: Optional[str] = None) -> Optional[str]:
-    users = await list_users(base=base)
-    if isinstance(users, list):
-        for u in users:
-            if str(u.get("uuid")) == str(cur_uuid):
-                s = (u.get("sub_id") or "").strip()
-                return s or None
+    u = await _device_call("GET", f"/users/by-uuid/{quote(str(cur_uuid), safe='')}", cur_uuid, base)
+    if isinstance(u, dict) and not u.get("_error"):
+        s = (u.get("sub_id") or "").strip()
+        return s or None
     return None
 
 async def rotate_by_id(identifier: str, base: Optional[str] = None):
-    return await api_post("/rotate", {"id": identifier}, base=base)
+    return await _device_call("POST", "/rotate", identifier, base, json={"id": identifier})
 
 async def revoke(ident: str, base: Optional[str] = None):
-    return await api_post("/revoke", {"id": ident}, base=base)
+    return await _device_call("POST", "/revoke", ident, base, json={"id": ident})
 
 async def pause(identifier: str, base: Optional[str] = None):
-    return await api_post("/pause", {"id": identifier}, base=base)
+    return await _device_call("POST", "/pause", identifier, base, json={"id": identifier})
 
 async def resume(identifier: str, rotate: bool = True, base: Optional[str] = None):
-    return await api_post("/resume", {"id": identifier, "rotate": bool(rotate)}, base=base)
+    return await _device_call(
+        "POST", "/resume", identifier, base, json={"id": identifier, "rotate": bool(rotate)}
+    )
+
+BATCH_MAX = 1000
+NODE_CONCURRENCY = int(os.getenv("API_NODE_CONCURRENCY", "4"))
+
+async def batch(ops: list[dict], base: Optional[str] = None):
+    """ops: [{"op": "pause", "id": sub_or_uuid}, {"op": "resume", "id": ..., "rotate": False}, ...]"""
+    return await api_post("/batch", {"ops": ops}, base=base)
+
+def _retryable(resp) -> bool:
+    """Сбой ноды (нет ответа, 5xx, цепь разомкнута), а не отказ по существу (404, неизвестная операция)."""
+    if not isinstance(resp, dict) or not resp.get("_error"):
+        return False
+    return int(resp.get("_status") or 0) == 0 or int(resp.get("_status") or 0) >= 500
+
+async def _node_batch(base: str, ops: list[dict], idxs: list[int], results: list):
+    for start in range(0, len(idxs), BATCH_MAX):
+        chunk = idxs[start:start + BATCH_MAX]
+        payload = [{k: v for k, v in ops[i].items() if k != "base"} for i in chunk]
+        resp = await batch(payload, base=base)
+        items = resp.get("results") if isinstance(resp, dict) else None
+        if not isinstance(items, list) or len(items) != len(chunk):
+            err = resp.get("_error") if isinstance(resp, dict) else "bad response"
+            logging.warning(f"[batch] {base}: {len(chunk)} ops failed: {err}")
+            retry = _retryable(resp) or not isinstance(resp, dict)
+            items = [
+                {"op": ops[i]["op"], "id": ops[i]["id"], "ok": False, "error": err, "retryable": retry}
+                for i in chunk
+            ]
+        for i, item in zip(chunk, items):
+            item["_server"] = base
+            results[i] = item
+
+async def _single_op(op: dict) -> dict:
+    payload = {k: v for k, v in op.items() if k not in ("op", "base")}
+    resp = await _device_call("POST", f"/{op['op']}", op["id"], None, json=payload)
+    ok = isinstance(resp, dict) and not resp.get("_error")
+    return {"op": op["op"], "id": op["id"], "ok": ok, "retryable": not ok and _retryable(resp),
+            **(resp if isinstance(resp, dict) else {})}
+
+async def batch_by_node(ops: list[dict], retry: bool = True) -> list[dict]:
+    """Раскладывает операции по нодам-владельцам (op["base"] или devices.server_base)
+    и шлёт по одному /batch на ноду; ноды обрабатываются параллельно, не больше
+    NODE_CONCURRENCY одновременно. Результаты возвращаются в порядке ops.
+    retry=True: операции, не дошедшие из-за сбоя ноды, уходят в очередь повторов (node_ops_retry)."""
+    results: list[Optional[dict]] = [None] * len(ops)
+    unknown = [op["id"] for op in ops if not op.get("base")]
+    bases = await adb.device_server_bases(unknown) if unknown else {}
+
+    groups: dict[Optional[str], list[int]] = {}
+    for i, op in enumerate(ops):
+        groups.setdefault(op.get("base") or bases.get(op["id"]), []).append(i)
+
+    sem = asyncio.Semaphore(NODE_CONCURRENCY)
+
+    def _crashed(idxs: list[int], e: Exception):
+        logging.exception(f"[batch] dispatch error: {e!r}")
+        for i in idxs:
+            if results[i] is None:
+                results[i] = {"op": ops[i]["op"], "id": ops[i]["id"], "ok": False,
+                              "error": repr(e), "retryable": True}
+
+    async def node(base: str, idxs: list[int]):
+        async with sem:
+            try:
+                await _node_batch(base, ops, idxs, results)
+            except Exception as e:
+                _crashed(idxs, e)
+
+    async def single(i: int):
+        # устройства без server_base — поштучно, с поиском и запоминанием ноды
+        async with sem:
+            try:
+                results[i] = await _single_op(ops[i])
+            except Exception as e:
+                _crashed([i], e)
+
+    tasks = [node(base, idxs) for base, idxs in groups.items() if base is not None]
+    tasks += [single(i) for i in groups.get(None, [])]
+    await asyncio.gather(*tasks)
+
+    out = [r or {} for r in results]
+    if retry:
+        failed = [
+            {**ops[i], "error": str(r.get("error") or r.get("_error") or "")}
+            for i, r in enumerate(out) if r.get("retryable")
+        ]
+        if failed:
+            await adb.enqueue_node_ops(failed)
+            logging.warning(f"[batch] {len(failed)} ops queued for retry")
+    return out
 
 async def kick_multi_sessions(window: int = 60, min_sessions: int = 2, base: Optional[str] = None):
     params = {
@@ -240,10 +433,37 @@ async def kick_multi_sessions(window: int = 60, min_sessions: int = 2, base: Opt
         "require_persistence": "2",
         "cooldown_sec": "180",
     }
-    return await api_get("/sessions", params, base=base)
+    if base:
+        return await api_get("/sessions", params, base=base)
+
+    # сессии считаются на каждой ноде отдельно — обходим все
+    out = {"items": [], "offenders": [], "kicked": []}
+    for b in _all_bases():
+        resp = await api_get("/sessions", params, base=b)
+        if not isinstance(resp, dict) or resp.get("_error"):
+            continue
+        for key in out:
+            for item in resp.get(key) or []:
+                item.setdefault("_server", b)
+                out[key].append(item)
+    return out
+
+async def fetch_traffic_bulk(idents: list[str], base: Optional[str] = None) -> dict[str, tuple[int, int]]:
+    """(upload, download) по списку sub_id/uuid одним запросом к ноде; неизвестные ident пропускаются."""
+    idents = [i for i in idents if i]
+    if not idents:
+        return {}
+    resp = await api_post("/traffic", {"ids": idents}, base=base)
+    items = resp.get("items") if isinstance(resp, dict) and not resp.get("_error") else None
+    if not isinstance(items, dict):
+        return {}
+    return {
+        k: (int(v.get("upload") or 0), int(v.get("download") or 0))
+        for k, v in items.items() if isinstance(v, dict)
+    }
 
 async def fetch_live_traffic_by_ident(ident: str, base: Optional[str] = None) -> tuple[int, int]:
-    b = _norm_base(base)
+    b = _norm_base(base or await adb.device_server_base(ident))
     url = f"{b}/sub/{ident}?b64=0"
     try:
         timeout = ClientTimeout(total=5.0)
@@ -277,6 +497,8 @@ async def fetch_live_traffic_by_ident(ident: str, base: Optional[str] = None) ->
 
 async def create_user(name: str, days: int = 30) -> dict:
     base = await _choose_api_base()
+    if not base:
+        return {"_error": "no API backends available", "_details": [], "_status": 0}
     payload = {"name": name, "days": int(days)}
     resp = await api_post("/create", payload, base=base)
     if isinstance(resp, dict) and not resp.get("_error"):
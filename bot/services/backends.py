@@ -0,0 +1,201 @@
+import os
+import time
+import random
+import logging
+from typing import Awaitable, Callable, Optional
+
+# Список нод менеджера: "url[;weight=N][;cap=N], url2...".
+# Если не задан — собираем из старых API_URL/API_URL_2 + API1_CAP/API2_CAP.
+API_BACKENDS = os.getenv("API_BACKENDS", "").strip()
+API_URL = os.getenv("API_URL", "").strip()
+API_URL_2 = os.getenv("API_URL_2", "").strip()
+API1_CAP = int(os.getenv("API1_CAP", "200"))
+API2_CAP = int(os.getenv("API2_CAP", "200"))
+LOAD_THRESH = int(os.getenv("LOAD_THRESH", "75"))
+
+LOAD_TTL_SEC = float(os.getenv("API_LOAD_TTL", "15"))
+BREAKER_OPEN_SEC = float(os.getenv("API_BREAKER_OPEN_SEC", "10"))
+BREAKER_MAX_OPEN_SEC = float(os.getenv("API_BREAKER_MAX_OPEN_SEC", "300"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+def norm(base: Optional[str]) -> str:
+    return (base or "").strip().rstrip("/")
+
+
+class Backend:
+    __slots__ = (
+        "base", "weight", "cap",
+        "state", "open_for", "open_until", "probing",
+        "sessions", "sessions_ts",
+    )
+
+    def __init__(self, base: str, weight: float = 1.0, cap: int = 0):
+        self.base = norm(base)
+        self.weight = max(0.01, float(weight))
+        self.cap = max(0, int(cap))
+        self.state = CLOSED
+        self.open_for = 0.0
+        self.open_until = 0.0
+        self.probing = False
+        self.sessions: Optional[int] = None
+        self.sessions_ts = 0.0
+
+    def load_pct(self) -> Optional[int]:
+        if self.sessions is None or self.cap <= 0:
+            return None
+        return int(self.sessions * 100 / self.cap)
+
+    def score(self) -> float:
+        # доля занятой ёмкости; неизвестная нагрузка не лучше порога
+        pct = self.load_pct()
+        return (pct if pct is not None else LOAD_THRESH) / 100.0
+
+
+def parse_backends(spec: str) -> list[Backend]:
+    out: list[Backend] = []
+    for chunk in (spec or "").split(","):
+        parts = [p.strip() for p in chunk.split(";") if p.strip()]
+        if not parts:
+            continue
+        opts = dict(p.split("=", 1) for p in parts[1:] if "=" in p)
+        try:
+            out.append(Backend(parts[0], float(opts.get("weight", 1)), int(opts.get("cap", 0))))
+        except ValueError:
+            logging.warning("[backends] bad backend spec %r, skipped", chunk)
+    return out
+
+
+def _from_env() -> list[Backend]:
+    if API_BACKENDS:
+        return parse_backends(API_BACKENDS)
+    out = []
+    if API_URL:
+        out.append(Backend(API_URL, 1.0, API1_CAP))
+    if API_URL_2:
+        out.append(Backend(API_URL_2, 1.0, API2_CAP))
+    return out
+
+
+class Router:
+    """Weighted least-load выбор ноды (power of two choices) + circuit breaker на каждую ноду.
+
+    Нода уходит в OPEN после первой транспортной ошибки и не участвует в выборе,
+    пока не истечёт open_until; затем ровно один запрос проходит как проба (HALF_OPEN).
+    """
+
+    def __init__(self, backends: list[Backend]):
+        self.backends: dict[str, Backend] = {}
+        for b in backends:
+            if b.base and b.base not in self.backends:
+                self.backends[b.base] = b
+
+    def get(self, base: Optional[str]) -> Optional[Backend]:
+        return self.backends.get(norm(base))
+
+    def bases(self) -> list[str]:
+        return list(self.backends)
+
+    # --- circuit breaker ---
+
+    def _closed_or_due(self, b: Backend, now: float) -> bool:
+        if b.state == CLOSED:
+            return True
+        return now >= b.open_until and not b.probing
+
+    def allow(self, base: str) -> bool:
+        b = self.get(base)
+        if b is None or b.state == CLOSED:
+            return True
+        if time.monotonic() < b.open_until or b.probing:
+            return False
+        b.state = HALF_OPEN
+        b.probing = True
+        logging.info("[backends] %s half-open, probing", b.base)
+        return True
+
+    def release(self, base: str):
+        """Проба оборвалась без результата (отмена запроса): снять флаг, чтобы нода не выпала навсегда."""
+        b = self.get(base)
+        if b is not None:
+            b.probing = False
+
+    def record_success(self, base: str):
+        b = self.get(base)
+        if b is None:
+            return
+        if b.state != CLOSED:
+            logging.info("[backends] %s recovered, circuit closed", b.base)
+        b.state = CLOSED
+        b.open_for = 0.0
+        b.probing = False
+
+    def record_failure(self, base: str, err: str):
+        b = self.get(base)
+        if b is None:
+            return
+        was = b.state
+        b.open_for = min(BREAKER_MAX_OPEN_SEC, b.open_for * 2 if b.open_for else BREAKER_OPEN_SEC)
+        b.open_until = time.monotonic() + b.open_for
+        b.state = OPEN
+        b.probing = False
+        if was == CLOSED:
+            logging.warning("[backends] %s circuit open for %.0fs: %s", b.base, b.open_for, err)
+        else:
+            logging.info("[backends] %s probe failed, open for %.0fs", b.base, b.open_for)
+
+    # --- нагрузка ---
+
+    def set_sessions(self, base: str, sessions: Optional[int]):
+        b = self.get(base)
+        if b is not None and sessions is not None:
+            b.sessions = sessions
+            b.sessions_ts = time.monotonic()
+
+    def stale(self) -> list[Backend]:
+        now = time.monotonic()
+        return [
+            b for b in self.backends.values()
+            if b.cap > 0 and self._closed_or_due(b, now) and now - b.sessions_ts >= LOAD_TTL_SEC
+        ]
+
+    async def refresh_load(self, probe: Callable[[str], Awaitable[Optional[int]]]):
+        if len(self.backends) < 2:
+            return
+        for b in self.stale():
+            self.set_sessions(b.base, await probe(b.base))
+
+    # --- выбор ---
+
+    def _pick_weighted(self, pool: list[Backend]) -> Backend:
+        return random.choices(pool, weights=[b.weight for b in pool], k=1)[0]
+
+    def choose(self) -> Optional[Backend]:
+        now = time.monotonic()
+        pool = [b for b in self.backends.values() if self._closed_or_due(b, now)]
+        if not pool:
+            return None
+        fresh = [b for b in pool if (b.load_pct() or 0) < LOAD_THRESH]
+        pool = fresh or pool
+        if len(pool) == 1:
+            return pool[0]
+        a = self._pick_weighted(pool)
+        rest = [b for b in pool if b is not a]
+        c = self._pick_weighted(rest)
+        return a if a.score() <= c.score() else c
+
+    def order(self) -> list[str]:
+        """Порядок попыток: выбранная нода, затем остальные живые по нагрузке.
+        Открытые ноды сюда не попадают, пока не подойдёт время пробы."""
+        now = time.monotonic()
+        best = self.choose()
+        live = sorted(
+            (b for b in self.backends.values() if b is not best and self._closed_or_due(b, now)),
+            key=lambda b: b.score(),
+        )
+        head = [best] if best else []
+        return [b.base for b in head + live]
+
+
+router = Router(_from_env())
@@ -1,76 +1,112 @@
 import asyncio
-import time
-import random
 import logging
-from typing import Iterable, Dict, Any
-
 from bot.services import api
-from bot.services import db
+from bot.services import adb, db
+from bot.services.cache import TTLMap
+from bot.settings import DAILY_FEE_C
+
 
+# Guard работает по очереди balance_dirty (её ведёт триггер на users.balance_cents):
+# за проход — только пользователи, у которых баланс вырос или ушёл в ноль.
+#  - баланс <= 0: активные устройства, не оплаченные за сегодня, отзываются на ноде;
+#  - баланс > 0: на паузе возобновляется столько устройств (по порядку id), сколько
+#    баланс покроет на следующем списании вместе с уже активными.
+# Операции уходят одной пачкой на ноду; сбои ноды подхватывает очередь повторов (node_retry).
+# Пользователь снимается с очереди, только если все его операции прошли (ok или ушли в повторы);
+# отказ ноды оставляет его в очереди — повтор после cooldown, как при прежнем полном обходе.
 
-CHECK_INTERVAL_SEC = 120
-JITTER_SEC = 30
+CHECK_INTERVAL_SEC = 10
 COOLDOWN_SEC = 300
-ACTIONS_PER_PASS = 30
+USERS_PER_PASS = 500
 
-_last_action_ts: dict[str, float] = {}
+# uuid -> недавно трогали на ноде; записи сами истекают через COOLDOWN_SEC
+_recent_actions = TTLMap(maxsize=100_000, ttl=COOLDOWN_SEC)
 
 def _cooldown_ok(uuid: str) -> bool:
-    now = time.time()
-    ts = _last_action_ts.get(uuid, 0)
-    if now - ts >= COOLDOWN_SEC:
-        _last_action_ts[uuid] = now
-        return True
-    return False
-
-def _iter_devices() -> Iterable[Dict[str, Any]]:
-
-    with db.db() as con:
-        rows = con.execute(
-            """
-            SELECT d.uuid, d.tg_id, d.name, d.status, u.balance_cents
-            FROM devices d
-            JOIN users u ON u.tg_id = d.tg_id
-            WHERE d.status != 'deleted'
-            ORDER BY d.id
-            """
-        ).fetchall()
-        for r in rows:
-            yield dict(r)
+    return _recent_actions.claim(uuid)
+
+
+def _plan_user(u: dict, fee: int, sod: int) -> tuple[list[dict], bool]:
+    """Операции для одного пользователя и флаг "всё решено" (False — что-то ждёт cooldown)."""
+    balance = int(u["balance_cents"] or 0)
+    devices = u["devices"]
+    ops: list[dict] = []
+    settled = True
+
+    if balance <= 0:
+        targets = [d for d in devices if d["status"] == "active" and db.epoch_sec(d["last_billed"]) < sod]
+        op = {"op": "revoke"}
+    else:
+        active = sum(1 for d in devices if d["status"] == "active")
+        budget = max(0, balance // fee - active)
+        targets = [d for d in devices if d["status"] in ("paused", "pending")][:budget]
+        op = {"op": "resume", "rotate": False}
+
+    for d in targets:
+        if not _cooldown_ok(d["uuid"]):
+            settled = False
+            continue
+        ops.append({
+            **op,
+            "id": (d["sub_id"] or "").strip() or d["uuid"],
+            "base": (d["server_base"] or "").strip() or None,
+            "_uuid": d["uuid"],
+            "_tg": u["tg_id"],
+            "_bal": balance,
+        })
+    return ops, settled
+
+
+async def balance_guard_pass() -> dict:
+    batch = await adb.balance_dirty_batch(USERS_PER_PASS)
+    if not batch:
+        return {"users": 0, "kept": 0, "revoke": 0, "resume": 0}
+
+    fee = max(1, int(DAILY_FEE_C))
+    sod = db.now() // 86400 * 86400
+    ops: list[dict] = []
+    settled: list[dict] = []
+    for u in batch:
+        user_ops, done = _plan_user(u, fee, sod)
+        ops += user_ops
+        if done:
+            settled.append(u)
+
+    new_status: list[tuple[str, str]] = []
+    rejected: set[int] = set()
+    if ops:
+        for op in ops:
+            logging.info(f"[balance_guard] {op['op']} {op['_uuid']} (tg_id={op['_tg']}) bal_cents={op['_bal']}")
+        results = await api.batch_by_node([{k: v for k, v in op.items() if not k.startswith("_")} for op in ops])
+        for op, r in zip(ops, results):
+            # retryable — уже в очереди повторов, статус в боте меняем сразу
+            if r.get("ok") or r.get("retryable"):
+                new_status.append((op["_uuid"], "paused" if op["op"] == "revoke" else "active"))
+            else:
+                logging.warning(f"[balance_guard] {op['op']} {op['_uuid']} rejected: {r.get('error') or r.get('_error')}")
+                rejected.add(op["_tg"])
+
+    await adb.set_devices_status(new_status)
+    await adb.finish_balance_dirty([u for u in settled if u["tg_id"] not in rejected])
+    if rejected:
+        logging.warning(f"[balance_guard] kept in queue after node rejects: tg_id={sorted(rejected)}")
+        await adb.defer_balance_dirty(sorted(rejected))
+    return {
+        "users": len(batch),
+        "kept": len(rejected),
+        "revoke": sum(1 for op in ops if op["op"] == "revoke"),
+        "resume": sum(1 for op in ops if op["op"] == "resume"),
+    }
+
 
 async def run_balance_guard():
 
     while True:
         try:
-            actions = 0
-            for dev in _iter_devices():
-                uuid = dev["uuid"]
-                tg_id = int(dev["tg_id"])
-                status = str(dev["status"] or "")
-                balance_cents = int(dev["balance_cents"] or 0)
-
-
-                if balance_cents <= 0 and status == "active":
-                    if _cooldown_ok(uuid):
-                        logging.info(f"[balance_guard] revoke {uuid} (tg_id={tg_id}) bal_cents={balance_cents}")
-                        resp = await api.revoke(uuid)
-
-                        db.set_device_status(uuid, "paused")
-                        actions += 1
-
-
-                elif balance_cents > 0 and status in ("paused", "pending"):
-                    if _cooldown_ok(uuid):
-                        logging.info(f"[balance_guard] refresh {uuid} (tg_id={tg_id}) bal_cents={balance_cents}")
-                        resp = await api.refresh_uuid(uuid)
-                        db.set_device_status(uuid, "active")
-                        actions += 1
-
-                if actions >= ACTIONS_PER_PASS:
-                    break
-
+            res = await balance_guard_pass()
+            if res["revoke"] or res["resume"]:
+                logging.info(f"[balance_guard] {res}")
         except Exception as e:
             logging.exception(f"[balance_guard] loop error: {e}")
 
-
-        await asyncio.sleep(CHECK_INTERVAL_SEC + random.randint(-JITTER_SEC, JITTER_SEC))
+        await asyncio.sleep(CHECK_INTERVAL_SEC)
@@ -0,0 +1,193 @@
+import time
+import weakref
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_MISS = object()
+
+
+class TTLCache:
+    """Потокобезопасный кэш с TTL и вытеснением по LRU.
+
+    Защита от гонки "прочитали старое -> писатель инвалидировал -> положили старое":
+    load() запоминает поколение ключа до чтения и не кладёт результат,
+    если за время чтения ключ (или весь кэш) инвалидировали.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._gen: dict[Hashable, int] = {}
+        self._inflight: dict[Hashable, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISS)
+        if value is not _MISS:
+            return value
+        with self._lock:
+            self._inflight[key] = self._inflight.get(key, 0) + 1
+            token = (self._epoch, self._gen.get(key, 0))
+        try:
+            value = loader()
+            with self._lock:
+                if token == (self._epoch, self._gen.get(key, 0)):
+                    self._store(key, value)
+            return value
+        finally:
+            with self._lock:
+                n = self._inflight[key] - 1
+                if n:
+                    self._inflight[key] = n
+                else:
+                    del self._inflight[key]
+                    self._gen.pop(key, None)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+            if key in self._inflight:
+                self._gen[key] = self._gen.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._epoch += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+_ttl_maps: "weakref.WeakSet[TTLMap]" = weakref.WeakSet()
+
+
+class TTLMap:
+    """Потокобезопасный словарь с общим TTL и жёстким потолком размера.
+
+    Для флагов и отметок "было недавно" (cooldown, окна подтверждения): ключи живут
+    ttl секунд и исчезают сами. Записи хранятся в порядке записи, а при одном TTL
+    это и порядок истечения — просроченные срезаются с головы (амортизированно O(1)):
+    на каждой записи, на чтении не чаще раза в SWEEP_EVERY_SEC, а карты без обращений
+    чистит sweep_ttl_maps() из планировщика. Сверх maxsize вытесняются самые старые.
+    """
+
+    SWEEP_EVERY_SEC = 60.0
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        _ttl_maps.add(self)
+
+    def _sweep(self, now: float) -> int:
+        data = self._data
+        n = 0
+        while data:
+            key, item = next(iter(data.items()))
+            if item[0] > now:
+                break
+            del data[key]
+            n += 1
+        self._next_sweep = now + min(self.ttl, self.SWEEP_EVERY_SEC)
+        return n
+
+    def sweep(self) -> int:
+        """Удалить все просроченные записи; возвращает их число."""
+        with self._lock:
+            return self._sweep(time.monotonic())
+
+    def _store(self, key: Hashable, value: Any, now: float):
+        self._sweep(now)
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep(now)
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= now:
+                del self._data[key]
+                return default
+            return item[1]
+
+    def set(self, key: Hashable, value: Any = True):
+        with self._lock:
+            self._store(key, value, time.monotonic())
+
+    def claim(self, key: Hashable, value: Any = True) -> bool:
+        """Записать ключ, если его нет (или истёк). True — записали; False — ключ ещё жив."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                return False
+            self._store(key, value, now)
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= time.monotonic():
+                return default
+            return item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISS) is not _MISS
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._sweep(time.monotonic())
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def sweep_ttl_maps() -> int:
+    """Дочистить все живые TTLMap процесса (для карт, к которым давно не обращались)."""
+    return sum(m.sweep() for m in list(_ttl_maps))
@@ -1,20 +1,58 @@
+import json
+import atexit
+import calendar
+import hashlib
 import sqlite3
 import time
+import queue
+import logging
+import threading
 import contextlib
 from pathlib import Path
 from typing import Optional, Dict, Any
 import os
 
+from bot.views import migrations, sqlprof
+from bot.services.cache import TTLCache
+
 REF_BONUS_INVITER_CENTS = int(os.getenv("REF_BONUS_INVITER_CENTS", "3000"))
 REF_BONUS_FRIEND_CENTS  = int(os.getenv("REF_BONUS_FRIEND_CENTS",  "2000"))
 MAX_DEVICES_PER_USER = int(os.getenv("MAX_DEVICES_PER_USER", "3"))
 
 DB_PATH = Path(__file__).resolve().parent.parent / "bot.db"
 
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_STMT_CACHE = 256
+
+# Write-behind для events: строки копятся в очереди и пишутся одной транзакцией
+# раз в EVENTS_FLUSH_MS или по EVENTS_BATCH_MAX штук. Деньги сюда не ходят.
+EVENTS_FLUSH_SEC = int(os.getenv("DB_EVENTS_FLUSH_MS", "200")) / 1000
+EVENTS_BATCH_MAX = int(os.getenv("DB_EVENTS_BATCH_MAX", "500"))
+EVENTS_QUEUE_MAX = int(os.getenv("DB_EVENTS_QUEUE_MAX", "20000"))
+EVENTS_FLUSH_RETRIES = 3      # пачка повторяется с паузой 0.2, 0.4 с..., потом пишется построчно
+
+# Ретеншн events: "type=days,..."; "*" — для остальных типов, 0 — хранить вечно.
+# Старые строки переезжают в отдельный файл-архив пачками по EVENTS_ARCHIVE_BATCH.
+EVENTS_RETENTION_SPEC = os.getenv("EVENTS_RETENTION", "refresh=90,auto_pause=180,yk:create=400,*=180")
+EVENTS_ARCHIVE_PATH = os.getenv("EVENTS_ARCHIVE_PATH", "").strip()
+EVENTS_ARCHIVE_BATCH = int(os.getenv("EVENTS_ARCHIVE_BATCH", "500"))
+EVENTS_ARCHIVE_PAUSE_SEC = 0.05
+VACUUM_STEP_PAGES = int(os.getenv("DB_VACUUM_STEP_PAGES", "256"))
+
+# Очередь повторов операций на нодах (pause/revoke/...), не дошедших из-за сбоя ноды:
+# пауза между попытками растёт от NODE_RETRY_BASE_SEC до NODE_RETRY_MAX_SEC.
+NODE_RETRY_BASE_SEC = int(os.getenv("NODE_RETRY_BASE_SEC", "60"))
+NODE_RETRY_MAX_SEC = int(os.getenv("NODE_RETRY_MAX_SEC", "3600"))
+NODE_RETRY_MAX_ATTEMPTS = int(os.getenv("NODE_RETRY_MAX_ATTEMPTS", "30"))
+
+# Кэш состояния пользователя (баланс, username, welcome, устройства) для меню.
+# Мутаторы ниже помечают tg_id через _touch*, кэш чистится после коммита писателя.
+USER_CACHE_TTL = float(os.getenv("DB_USER_CACHE_TTL", "60"))
+USER_CACHE_MAX = int(os.getenv("DB_USER_CACHE_MAX", "20000"))
+user_cache = TTLCache(USER_CACHE_MAX, USER_CACHE_TTL)
+
+# Базовые таблицы; индексы и поздние колонки — в _v1_baseline (после ADD COLUMN).
 DDL = """
-PRAGMA journal_mode=WAL;
-PRAGMA foreign_keys=ON;
-
 CREATE TABLE IF NOT EXISTS users(
   tg_id          INTEGER PRIMARY KEY,
   created_at     INTEGER NOT NULL,
@@ -39,11 +77,6 @@ CREATE TABLE IF NOT EXISTS devices(
   FOREIGN KEY(tg_id) REFERENCES users(tg_id)
 );
 
-CREATE UNIQUE INDEX IF NOT EXISTS ux_devices_uuid ON devices(uuid);
-CREATE INDEX IF NOT EXISTS ix_devices_tg       ON devices(tg_id);
-CREATE INDEX IF NOT EXISTS ix_devices_status   ON devices(status);
-CREATE INDEX IF NOT EXISTS ix_devices_sub_id   ON devices(sub_id);
-
 CREATE TABLE IF NOT EXISTS payments(
   id             INTEGER PRIMARY KEY AUTOINCREMENT,
   tg_id          INTEGER NOT NULL,
@@ -53,8 +86,6 @@ CREATE TABLE IF NOT EXISTS payments(
   created_at     INTEGER NOT NULL,
   FOREIGN KEY(tg_id) REFERENCES users(tg_id)
 );
-CREATE INDEX IF NOT EXISTS ix_payments_tg      ON payments(tg_id);
-CREATE INDEX IF NOT EXISTS ix_payments_created ON payments(created_at);
 
 CREATE TABLE IF NOT EXISTS promos (
   code           TEXT PRIMARY KEY,
@@ -72,59 +103,415 @@ CREATE TABLE IF NOT EXISTS events(
 );
 """
 
+# Денормализованные счётчики устройств в users: dev_count (не удалённые), dev_active,
+# nearest_exp (MIN expires_at по активным). Держатся триггерами на devices —
+# пересчёт только строки затронутого пользователя по ix_devices_tg.
+
+def _user_counters_sql(ref: str) -> str:
+    return f"""
+    UPDATE users SET
+      dev_count   = (SELECT COUNT(*) FROM devices WHERE tg_id={ref} AND status!='deleted'),
+      dev_active  = (SELECT COUNT(*) FROM devices WHERE tg_id={ref} AND +status='active'),
+      nearest_exp = (SELECT MIN(expires_at) FROM devices
+                      WHERE tg_id={ref} AND +status='active' AND expires_at IS NOT NULL)
+    WHERE tg_id={ref};"""
+
+USER_COUNTER_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_devices_cnt_ins AFTER INSERT ON devices
+    BEGIN {_user_counters_sql("NEW.tg_id")} END""",
+
+    f"""CREATE TRIGGER IF NOT EXISTS trg_devices_cnt_del AFTER DELETE ON devices
+    BEGIN {_user_counters_sql("OLD.tg_id")} END""",
+
+    f"""CREATE TRIGGER IF NOT EXISTS trg_devices_cnt_upd AFTER UPDATE OF tg_id, status, expires_at ON devices
+    WHEN OLD.tg_id IS NOT NEW.tg_id OR OLD.status IS NOT NEW.status OR OLD.expires_at IS NOT NEW.expires_at
+    BEGIN
+      {_user_counters_sql("NEW.tg_id")}
+      {_user_counters_sql("OLD.tg_id")}
+    END""",
+]
+
+# Замена trg_devices_cnt_upd (шаг 7 миграций): старый пересчитывал и NEW, и OLD пользователя
+# даже без смены tg_id — на паузе/списании одна и та же строка users считалась дважды.
+USER_COUNTER_UPD_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS trg_devices_cnt_upd",
+
+    f"""CREATE TRIGGER IF NOT EXISTS trg_devices_cnt_upd2 AFTER UPDATE OF tg_id, status, expires_at ON devices
+    WHEN OLD.tg_id IS NOT NEW.tg_id OR OLD.status IS NOT NEW.status OR OLD.expires_at IS NOT NEW.expires_at
+    BEGIN {_user_counters_sql("NEW.tg_id")} END""",
+
+    f"""CREATE TRIGGER IF NOT EXISTS trg_devices_cnt_move AFTER UPDATE OF tg_id ON devices
+    WHEN OLD.tg_id IS NOT NEW.tg_id
+    BEGIN {_user_counters_sql("OLD.tg_id")} END""",
+]
+
+# Очередь для balance_guard: пользователи, чей баланс изменился так, что устройствам может
+# понадобиться пауза или возобновление — пополнение (любой источник, в т.ч. вебхук в другом
+# процессе) или уход в ноль. Обычное суточное списание с остатком > 0 сюда не попадает.
+BALANCE_DIRTY_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS trg_users_balance_dirty AFTER UPDATE OF balance_cents ON users
+    WHEN NEW.balance_cents > OLD.balance_cents OR (NEW.balance_cents <= 0 AND OLD.balance_cents > 0)
+    BEGIN
+      INSERT INTO balance_dirty(tg_id, changed_at) VALUES (NEW.tg_id, CAST(strftime('%s','now') AS INTEGER))
+      ON CONFLICT(tg_id) DO UPDATE SET seq = seq + 1, changed_at = excluded.changed_at;
+    END""",
+]
+
+# Агрегаты для админки. payments_daily — сумма и число платежей по (UTC-день, method),
+# ведётся триггером на INSERT в payments (леджер только дописывается; свёрнутые
+# месячные строки daily_month не считаются повторно). stats_totals — одна строка
+# с числом пользователей, устройств и суммой балансов.
+
+ROLLUP_DDL = [
+    """CREATE TABLE IF NOT EXISTS payments_daily(
+      day            INTEGER NOT NULL,          -- created_at / 86400
+      method         TEXT NOT NULL,
+      amount_cents   INTEGER NOT NULL DEFAULT 0,
+      cnt            INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(day, method)
+    ) WITHOUT ROWID""",
+
+    """CREATE TABLE IF NOT EXISTS stats_totals(
+      id             INTEGER PRIMARY KEY CHECK (id = 1),
+      users          INTEGER NOT NULL DEFAULT 0,
+      devices        INTEGER NOT NULL DEFAULT 0,   -- не удалённые
+      balance_cents  INTEGER NOT NULL DEFAULT 0
+    )""",
+]
+
+ROLLUP_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS trg_payments_daily_ins AFTER INSERT ON payments
+    WHEN NEW.method != 'daily_month'
+    BEGIN
+      INSERT INTO payments_daily(day, method, amount_cents, cnt)
+      VALUES (NEW.created_at / 86400, NEW.method, NEW.amount_cents, 1)
+      ON CONFLICT(day, method) DO UPDATE SET
+        amount_cents = amount_cents + excluded.amount_cents,
+        cnt = cnt + 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_users_ins AFTER INSERT ON users
+    BEGIN
+      UPDATE stats_totals SET users = users + 1, balance_cents = balance_cents + NEW.balance_cents WHERE id = 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_users_del AFTER DELETE ON users
+    BEGIN
+      UPDATE stats_totals SET users = users - 1, balance_cents = balance_cents - OLD.balance_cents WHERE id = 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_users_bal AFTER UPDATE OF balance_cents ON users
+    WHEN OLD.balance_cents IS NOT NEW.balance_cents
+    BEGIN
+      UPDATE stats_totals SET balance_cents = balance_cents + NEW.balance_cents - OLD.balance_cents WHERE id = 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_devices_ins AFTER INSERT ON devices
+    WHEN NEW.status != 'deleted'
+    BEGIN
+      UPDATE stats_totals SET devices = devices + 1 WHERE id = 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_devices_del AFTER DELETE ON devices
+    WHEN OLD.status != 'deleted'
+    BEGIN
+      UPDATE stats_totals SET devices = devices - 1 WHERE id = 1;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS trg_totals_devices_upd AFTER UPDATE OF status ON devices
+    WHEN (OLD.status = 'deleted') != (NEW.status = 'deleted')
+    BEGIN
+      UPDATE stats_totals SET devices = devices + (CASE WHEN NEW.status = 'deleted' THEN -1 ELSE 1 END) WHERE id = 1;
+    END""",
+]
+
+# Долгоживущие соединения: один писатель (все записи процесса идут через него по очереди)
+# и небольшой пул читателей. PRAGMA выставляются один раз при открытии.
+
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.RLock()
+_writer_depth = 0
+_dirty_users: set[int] = set()
+_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+
+
+def _connect() -> sqlite3.Connection:
+    con = sqlite3.connect(
+        DB_PATH, timeout=10.0, check_same_thread=False, cached_statements=DB_STMT_CACHE,
+        factory=sqlprof.connection_factory(),
+    )
+    con.row_factory = sqlite3.Row
+    # действует только для новой базы (до первой таблицы); старую переводит enable_incremental_vacuum()
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    con.execute("PRAGMA foreign_keys=ON;")
+    con.execute("PRAGMA busy_timeout=5000;")
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    return con
+
+
 @contextlib.contextmanager
 def db():
-    con = sqlite3.connect(DB_PATH, timeout=10.0)
-    con.row_factory = sqlite3.Row
+    """Соединение-писатель. Коммит на выходе из внешнего блока, откат при исключении.
+    Вложенные блоки в том же потоке работают в транзакции внешнего.
+    Внутри блока нельзя делать await — соединение держится до выхода."""
+    global _writer, _writer_depth
+    with _writer_lock:
+        if _writer is None:
+            _writer = _connect()
+        con = _writer
+        _writer_depth += 1
+        try:
+            yield con
+            if _writer_depth == 1:
+                con.commit()
+        except BaseException:
+            if _writer_depth == 1:
+                con.rollback()
+            raise
+        finally:
+            _writer_depth -= 1
+            if _writer_depth == 0 and _dirty_users:
+                for tg_id in _dirty_users:
+                    user_cache.invalidate(tg_id)
+                _dirty_users.clear()
+
+
+@contextlib.contextmanager
+def db_read():
+    """Соединение из пула читателей — только для SELECT. В WAL читатели не ждут писателя."""
+    try:
+        con = _readers.get_nowait()
+    except queue.Empty:
+        con = _connect()
     try:
-        con.execute("PRAGMA foreign_keys=ON;")
-        con.execute("PRAGMA busy_timeout=5000;")
-        con.execute("PRAGMA journal_mode=WAL;")
-        con.execute("PRAGMA synchronous=NORMAL;")
         yield con
-        con.commit()
     finally:
-        con.close()
+        if con.in_transaction:
+            con.rollback()
+        if _readers.qsize() < DB_READERS:
+            _readers.put(con)
+        else:
+            con.close()
+
+
+def _touch(*tg_ids):
+    """Пометить пользователей изменёнными (вызывать внутри db())."""
+    for t in tg_ids:
+        if t:
+            _dirty_users.add(int(t))
+
+def _touch_device(con: sqlite3.Connection, ident) -> None:
+    for r in con.execute("SELECT tg_id FROM devices WHERE uuid=? OR sub_id=?", (ident, ident)):
+        _touch(r[0])
+
+def _touch_device_id(con: sqlite3.Connection, device_id: int) -> None:
+    for r in con.execute("SELECT tg_id FROM devices WHERE id=?", (device_id,)):
+        _touch(r[0])
+
+def forget_user(tg_id: int):
+    """Сбросить кэш пользователя, если его строку поменяли мимо db.py (другой процесс)."""
+    user_cache.invalidate(int(tg_id))
+
+
+def close():
+    global _writer
+    flush_events()
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
 
 def init():
-    with db() as con:
-        con.executescript(DDL)
     migrate()
+    if os.getenv("DB_ENABLE_INCREMENTAL_VACUUM") == "1":
+        enable_incremental_vacuum()
 
 def migrate():
     with db() as con:
-        def _try(sql: str):
-            try:
-                con.execute(sql)
-            except Exception:
-                pass
-
-
-        _try("ALTER TABLE users ADD COLUMN username TEXT")
-        _try("ALTER TABLE devices ADD COLUMN expires_at TEXT")
-        _try("ALTER TABLE devices ADD COLUMN sub_id TEXT")
-
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_tg ON devices(tg_id)")
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_status ON devices(status)")
-        _try("CREATE INDEX IF NOT EXISTS ix_payments_tg ON payments(tg_id)")
-        _try("CREATE INDEX IF NOT EXISTS ix_payments_created ON payments(created_at)")
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_sub_id ON devices(sub_id)")
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_last_billed   ON devices(last_billed)")
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_activated_at ON devices(activated_at)")
-        _try("ALTER TABLE devices ADD COLUMN server_base TEXT")
-        _try("CREATE INDEX IF NOT EXISTS ix_devices_server_base ON devices(server_base)")
-        _try("CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_card_ref ON payments(ref) WHERE method='card'")
-        _try("CREATE INDEX IF NOT EXISTS ix_payments_method_id ON payments(method, id)")
-
-        _try("CREATE INDEX IF NOT EXISTS ix_payments_referral_ref ON payments(ref) WHERE method='referral'")
-
-
-        _try(
-            "CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_promo_unique "
-            "ON payments(tg_id, method, ref) "
-            "WHERE method='promo'"
-        )
+        migrations.apply(con, MIGRATIONS, "bot")
+
+
+# Шаги схемы по порядку; номер шага = PRAGMA user_version. Только дописывать в конец.
+# Шаги 1-6 повторяют то, что раньше migrate() делал на каждом старте, поэтому
+# идемпотентны: базы без версии проходят их все и получают user_version = 6.
+
+def _v1_baseline(con: sqlite3.Connection):
+    for sql in DDL.split(";"):
+        if sql.strip():
+            con.execute(sql)
+
+    migrations.add_column(con, "users", "username", "TEXT")
+    migrations.add_column(con, "devices", "expires_at", "TEXT")
+    migrations.add_column(con, "devices", "sub_id", "TEXT")
+    migrations.add_column(con, "devices", "server_base", "TEXT")
+
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_tg ON devices(tg_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_status ON devices(status)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_sub_id ON devices(sub_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_payments_tg ON payments(tg_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_payments_created ON payments(created_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_last_billed ON devices(last_billed)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_activated_at ON devices(activated_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_devices_server_base ON devices(server_base)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_payments_method_id ON payments(method, id)")
+    con.execute("CREATE INDEX IF NOT EXISTS ix_payments_referral_ref ON payments(ref) WHERE method='referral'")
+
+    # на старых базах уникальность могла быть уже нарушена — раньше ошибка молча глоталась,
+    # теперь пишем в лог и идём дальше: без индекса бот работал и до этого
+    for sql in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_devices_uuid ON devices(uuid)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_card_ref ON payments(ref) WHERE method='card'",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_promo_unique "
+        "ON payments(tg_id, method, ref) WHERE method='promo'",
+    ):
+        try:
+            con.execute(sql)
+        except sqlite3.IntegrityError as e:
+            logging.warning("[migrate:bot] %s: %s", sql.split(" ON ")[0], e)
+
+
+def _v2_user_counters(con: sqlite3.Connection):
+    con.execute("CREATE INDEX IF NOT EXISTS ix_users_created ON users(created_at)")
+    if migrations.add_column(con, "users", "dev_count", "INTEGER NOT NULL DEFAULT 0"):
+        con.execute("ALTER TABLE users ADD COLUMN dev_active INTEGER NOT NULL DEFAULT 0")
+        con.execute("ALTER TABLE users ADD COLUMN nearest_exp TEXT")
+        # разовый бэкфилл, дальше счётчики ведут триггеры
+        con.execute(_user_counters_sql("users.tg_id"))
+    for sql in USER_COUNTER_TRIGGERS:
+        con.execute(sql)
+
 
+def _v3_yk_payments(con: sqlite3.Connection):
+    if migrations.has_table(con, "yk_payments"):
+        return
+    con.execute("""
+        CREATE TABLE yk_payments(
+          payment_id     TEXT PRIMARY KEY,
+          tg_id          INTEGER NOT NULL,
+          amount_cents   INTEGER,
+          order_id       TEXT,
+          status         TEXT NOT NULL DEFAULT 'pending',   -- pending|succeeded
+          created_at     INTEGER NOT NULL
+        )
+    """)
+    # разовый перенос старых записей yk:create из events (payload — JSON с payment_id)
+    con.execute("""
+        INSERT OR IGNORE INTO yk_payments(payment_id, tg_id, amount_cents, order_id, created_at)
+        SELECT COALESCE(json_extract(payload, '$.payment_id'), json_extract(payload, '$.id')),
+               tg_id,
+               CAST(json_extract(payload, '$.amount_rub') AS INTEGER) * 100,
+               json_extract(payload, '$.order_id'),
+               created_at
+        FROM events
+        WHERE type='yk:create' AND tg_id IS NOT NULL AND json_valid(payload)
+          AND COALESCE(json_extract(payload, '$.payment_id'), json_extract(payload, '$.id')) IS NOT NULL
+        ORDER BY id
+    """)
+
+
+def _v5_rollups(con: sqlite3.Connection):
+    has_rollup = migrations.has_table(con, "payments_daily")
+    for sql in ROLLUP_DDL:
+        con.execute(sql)
+    if not has_rollup:
+        # разовый бэкфилл агрегатов из леджера, дальше их ведут триггеры
+        con.execute("""
+            INSERT INTO payments_daily(day, method, amount_cents, cnt)
+            SELECT created_at / 86400, method, SUM(amount_cents), COUNT(*)
+            FROM payments WHERE method != 'daily_month'
+            GROUP BY 1, 2
+        """)
+        con.execute("""
+            INSERT OR REPLACE INTO stats_totals(id, users, devices, balance_cents)
+            SELECT 1,
+                   (SELECT COUNT(*) FROM users),
+                   (SELECT COUNT(*) FROM devices WHERE status != 'deleted'),
+                   (SELECT COALESCE(SUM(balance_cents), 0) FROM users)
+        """)
+    for sql in ROLLUP_TRIGGERS:
+        con.execute(sql)
+
+
+def _v11_balance_dirty(con: sqlite3.Connection):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS balance_dirty(
+          tg_id          INTEGER PRIMARY KEY,
+          seq            INTEGER NOT NULL DEFAULT 1,   -- растёт на каждое изменение, см. finish_balance_dirty
+          changed_at     INTEGER NOT NULL
+        )
+    """)
+    for sql in BALANCE_DIRTY_TRIGGERS:
+        con.execute(sql)
+    # разово: всех с устройствами — guard один раз сверит текущее состояние
+    con.execute("""
+        INSERT OR IGNORE INTO balance_dirty(tg_id, changed_at)
+        SELECT DISTINCT tg_id, CAST(strftime('%s','now') AS INTEGER)
+        FROM devices WHERE status != 'deleted'
+    """)
+
+
+MIGRATIONS: list[migrations.Step] = [
+    _v1_baseline,
+    _v2_user_counters,
+    _v3_yk_payments,
+    "CREATE INDEX IF NOT EXISTS ix_events_type_created ON events(type, created_at)",
+    _v5_rollups,
+    [
+        """CREATE TABLE IF NOT EXISTS ledger_compactions(
+          id             INTEGER PRIMARY KEY AUTOINCREMENT,
+          tg_id          INTEGER NOT NULL,
+          month          TEXT NOT NULL,             -- YYYY-MM (UTC)
+          rows           INTEGER NOT NULL,
+          amount_cents   INTEGER NOT NULL,
+          first_id       INTEGER NOT NULL,
+          last_id        INTEGER NOT NULL,
+          checksum       TEXT NOT NULL,             -- sha256 по свёрнутым строкам, см. ledger_checksum()
+          compacted_at   INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_ledger_compactions_tg ON ledger_compactions(tg_id, month)",
+        "CREATE INDEX IF NOT EXISTS ix_payments_daily_tg ON payments(tg_id, created_at) WHERE method='daily'",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_payments_daily_month ON payments(tg_id, ref) WHERE method='daily_month'",
+    ],
+    USER_COUNTER_UPD_TRIGGERS,
+    [
+        """CREATE TABLE IF NOT EXISTS node_ops_retry(
+          ident          TEXT PRIMARY KEY,          -- sub_id или uuid; на устройство одна операция — последняя
+          op             TEXT NOT NULL,             -- pause|resume|revoke|...
+          base           TEXT,
+          payload        TEXT,                      -- JSON доп. полей операции (rotate и т.п.)
+          attempts       INTEGER NOT NULL DEFAULT 0,
+          next_at        INTEGER NOT NULL,
+          last_error     TEXT,
+          created_at     INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_node_ops_retry_next ON node_ops_retry(next_at)",
+    ],
+    """CREATE TABLE IF NOT EXISTS jobs(
+      name           TEXT PRIMARY KEY,
+      last_window    INTEGER,                   -- начало последнего успешно отработанного окна (epoch)
+      last_started   INTEGER,
+      last_finished  INTEGER,
+      last_ms        INTEGER,
+      last_error     TEXT,                      -- NULL, если последний запуск успешен
+      runs           INTEGER NOT NULL DEFAULT 0,
+      failures       INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS notifications(
+      kind           TEXT NOT NULL,             -- low_balance|...
+      day            INTEGER NOT NULL,          -- UTC-день (epoch / 86400)
+      tg_id          INTEGER NOT NULL,
+      status         TEXT NOT NULL,             -- sending|sent|blocked|failed
+      updated_at     INTEGER NOT NULL,
+      PRIMARY KEY(kind, day, tg_id)
+    ) WITHOUT ROWID""",
+    _v11_balance_dirty,
+]
 
 
 def now() -> int:
@@ -140,20 +527,53 @@ def ensure_user(tg_id: int, username: Optional[str] = None) -> Dict[str, Any]:
                 "INSERT INTO users(tg_id, created_at, balance_cents, username) VALUES(?,?,?,?)",
                 (tg_id, now(), 0, (username or None))
             )
+            _touch(tg_id)
             r = con.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,)).fetchone()
         else:
             if username:
                 cur = (r["username"] or "")
                 if cur != username:
                     con.execute("UPDATE users SET username=? WHERE tg_id=?", (username, tg_id))
+                    _touch(tg_id)
                     r = con.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,)).fetchone()
         return dict(r)
 
 def update_username(tg_id: int, username: Optional[str]):
-    if not username:
+    if not username or user_state(tg_id)["username"] == username:
         return
     with db() as con:
         con.execute("UPDATE users SET username=? WHERE tg_id=?", (username, tg_id))
+        _touch(tg_id)
+
+def _load_user_state(tg_id: int) -> Dict[str, Any]:
+    with db_read() as con:
+        u = con.execute(
+            "SELECT balance_cents, username, got_welcome FROM users WHERE tg_id=?",
+            (tg_id,)
+        ).fetchone()
+        devs = con.execute(
+            "SELECT * FROM devices WHERE tg_id=? AND status!='deleted' ORDER BY id",
+            (tg_id,)
+        ).fetchall()
+    return {
+        "balance_cents": int(u["balance_cents"] or 0) if u else 0,
+        "username": (u["username"] or None) if u else None,
+        "got_welcome": bool(u and u["got_welcome"]),
+        "devices": [dict(x) for x in devs],
+    }
+
+def user_state(tg_id: int) -> Dict[str, Any]:
+    """Баланс, username, welcome и устройства одним чтением; отдаётся из user_cache.
+    Результат общий для всех читателей — не изменять."""
+    return user_cache.load(tg_id, lambda: _load_user_state(tg_id))
+
+def get_username(tg_id: int) -> Optional[str]:
+    return user_state(tg_id)["username"]
+
+def all_user_ids() -> list[int]:
+    with db_read() as con:
+        rows = con.execute("SELECT DISTINCT tg_id FROM users").fetchall()
+    return [int(r[0]) for r in rows if r and r[0]]
 
 def set_referrer(tg_id: int, referrer: int):
     if not referrer or referrer == tg_id:
@@ -163,20 +583,18 @@ def set_referrer(tg_id: int, referrer: int):
             "UPDATE users SET referrer=? WHERE tg_id=? AND (referrer IS NULL OR referrer=0)",
             (referrer, tg_id)
         )
+        _touch(tg_id)
 
 def set_welcome_given(tg_id: int):
     with db() as con:
         con.execute("UPDATE users SET got_welcome=1 WHERE tg_id=?", (tg_id,))
+        _touch(tg_id)
 
 def got_welcome(tg_id: int) -> bool:
-    with db() as con:
-        r = con.execute("SELECT got_welcome FROM users WHERE tg_id=?", (tg_id,)).fetchone()
-        return bool(r and r[0])
+    return user_state(tg_id)["got_welcome"]
 
 def get_balance_cents(tg_id: int) -> int:
-    with db() as con:
-        r = con.execute("SELECT balance_cents FROM users WHERE tg_id=?", (tg_id,)).fetchone()
-        return int(r[0]) if r else 0
+    return user_state(tg_id)["balance_cents"]
 
 def add_balance(tg_id: int, amount_cents: int, method: str, ref: Optional[str] = None):
     with db() as con:
@@ -191,6 +609,7 @@ def add_balance_con(con: sqlite3.Connection, tg_id: int, amount_cents: int, meth
         "INSERT INTO payments(tg_id, amount_cents, method, ref, created_at) VALUES(?,?,?,?,?)",
         (tg_id, int(amount_cents), method, ref, now())
     )
+    _touch(tg_id)
 
 def burn_balance(tg_id: int, cents: int) -> bool:
     cents = int(cents)
@@ -202,16 +621,12 @@ def burn_balance(tg_id: int, cents: int) -> bool:
         if cur < cents:
             return False
         con.execute("UPDATE users SET balance_cents=? WHERE tg_id=?", (cur - cents, tg_id))
+        _touch(tg_id)
         return True
 
 
 def list_devices(tg_id: int) -> list[Dict[str, Any]]:
-    with db() as con:
-        rows = con.execute(
-            "SELECT * FROM devices WHERE tg_id=? AND status!='deleted' ORDER BY id",
-            (tg_id,)
-        ).fetchall()
-        return [dict(x) for x in rows]
+    return [dict(d) for d in user_state(tg_id)["devices"]]
 
 def add_device(
     tg_id: int,
@@ -225,10 +640,12 @@ def add_device(
 ):
     with db() as con:
 
-        row = con.execute(
-            "SELECT COUNT(*) FROM devices WHERE tg_id=? AND status!='deleted'",
-            (tg_id,)
-        ).fetchone()
+        row = con.execute("SELECT dev_count FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+        if row is None:
+            row = con.execute(
+                "SELECT COUNT(*) FROM devices WHERE tg_id=? AND status!='deleted'",
+                (tg_id,)
+            ).fetchone()
         if int(row[0] or 0) >= MAX_DEVICES_PER_USER:
             raise ValueError("device_limit_reached")
 
@@ -237,6 +654,7 @@ def add_device(
                VALUES(?,?,?,?,?,?,?,?,?)""",
             (tg_id, uuid, name, os, status, now(), expires_at, sub_id, server_base)
         )
+        _touch(tg_id)
         if server_base:
             con.execute("UPDATE devices SET server_base=? WHERE uuid=? AND (server_base IS NULL OR server_base='')",
                         (server_base, uuid))
@@ -245,14 +663,17 @@ def add_device(
 def set_device_status(uuid: str, status: str):
     with db() as con:
         con.execute("UPDATE devices SET status=? WHERE uuid=?", (status, uuid))
+        _touch_device(con, uuid)
 
 def set_device_expires(uuid: str, expires_at: Optional[str]):
     with db() as con:
         con.execute("UPDATE devices SET expires_at=? WHERE uuid=?", (expires_at, uuid))
+        _touch_device(con, uuid)
 
 def set_device_sub_id(uuid: str, sub_id: str):
     with db() as con:
         con.execute("UPDATE devices SET sub_id=? WHERE uuid=?", (sub_id, uuid))
+        _touch_device(con, uuid)
 
 def set_device_activated(uuid: str, ts: Optional[int] = None):
     with db() as con:
@@ -262,31 +683,256 @@ def set_device_activated(uuid: str, ts: Optional[int] = None):
             "WHERE uuid=? AND (activated_at IS NULL OR activated_at=0)",
             (t, t, uuid)
         )
+        _touch_device(con, uuid)
+
 def set_device_server_base(uuid: str, server_base: Optional[str]):
     with db() as con:
         con.execute("UPDATE devices SET server_base=? WHERE uuid=?", (server_base, uuid))
+        _touch_device(con, uuid)
 
-def device_by_uuid(uuid: str) -> Optional[Dict[str, Any]]:
+def device_server_base(ident: str) -> Optional[str]:
+    """Нода, на которой создано устройство (ident — sub_id или uuid)."""
+    with db_read() as con:
+        r = con.execute(
+            "SELECT server_base FROM devices WHERE sub_id=? OR uuid=? LIMIT 1",
+            (ident, ident)
+        ).fetchone()
+    return (r[0] or None) if r else None
+
+def backfill_device_server_base(ident: str, server_base: str):
     with db() as con:
+        con.execute(
+            "UPDATE devices SET server_base=? "
+            "WHERE (sub_id=? OR uuid=?) AND (server_base IS NULL OR server_base='')",
+            (server_base, ident, ident)
+        )
+        _touch_device(con, ident)
+
+def devices_without_server_base() -> list[Dict[str, Any]]:
+    """Старые устройства без записанной ноды (их владельца ищет mirror)."""
+    with db_read() as con:
+        rows = con.execute(
+            "SELECT id, sub_id, uuid FROM devices "
+            "WHERE (server_base IS NULL OR server_base='') AND status != 'deleted'"
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def backfill_device_server_bases(pairs: list[tuple[int, str]]):
+    """backfill_device_server_base пачкой: [(devices.id, server_base)]."""
+    with db() as con:
+        for device_id, server_base in pairs:
+            con.execute(
+                "UPDATE devices SET server_base=? "
+                "WHERE id=? AND (server_base IS NULL OR server_base='')",
+                (server_base, device_id)
+            )
+            _touch_device_id(con, device_id)
+
+def device_server_bases(idents: list[str]) -> dict[str, Optional[str]]:
+    """device_server_base для пачки: {ident: server_base или None}."""
+    out: dict[str, Optional[str]] = {i: None for i in idents}
+    wanted = [i for i in out if i]
+    with db_read() as con:
+        for start in range(0, len(wanted), 500):
+            chunk = wanted[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            for r in con.execute(
+                f"SELECT sub_id, uuid, server_base FROM devices "
+                f"WHERE sub_id IN ({marks}) OR uuid IN ({marks})",
+                chunk + chunk
+            ):
+                for key in (r["sub_id"], r["uuid"]):
+                    if key in out and r["server_base"]:
+                        out[key] = r["server_base"]
+    return out
+
+def device_by_uuid(uuid: str) -> Optional[Dict[str, Any]]:
+    with db_read() as con:
         r = con.execute("SELECT * FROM devices WHERE uuid=?", (uuid,)).fetchone()
         return dict(r) if r else None
 
 def device_by_id(device_id: int) -> Optional[Dict[str, Any]]:
-    with db() as con:
+    with db_read() as con:
         r = con.execute("SELECT * FROM devices WHERE id=?", (device_id,)).fetchone()
         return dict(r) if r else None
 
+def user_device(tg_id: int, field: str, value) -> Optional[Dict[str, Any]]:
+    """Устройство пользователя по id/uuid/name/sub_id (удалённые не возвращаются)."""
+    if field not in ("id", "uuid", "name", "sub_id"):
+        raise ValueError(f"bad device field: {field}")
+    with db_read() as con:
+        r = con.execute(
+            f"SELECT * FROM devices WHERE {field}=? AND tg_id=? AND status!='deleted'",
+            (value, tg_id)
+        ).fetchone()
+        return dict(r) if r else None
+
+def device_by_sub_id(sub_id: str) -> Optional[Dict[str, Any]]:
+    with db_read() as con:
+        r = con.execute(
+            "SELECT uuid, tg_id, name FROM devices WHERE sub_id=? LIMIT 1",
+            (sub_id,)
+        ).fetchone()
+        return dict(r) if r else None
+
+def devices_for_users(tg_ids: list[int]) -> list[Dict[str, Any]]:
+    if not tg_ids:
+        return []
+    marks = ",".join("?" * len(tg_ids))
+    with db_read() as con:
+        rows = con.execute(
+            f"SELECT tg_id, sub_id, uuid, server_base FROM devices "
+            f"WHERE tg_id IN ({marks}) AND status != 'deleted'",
+            list(tg_ids)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def set_device_sub_id_by_id(device_id: int, sub_id: str):
+    with db() as con:
+        con.execute("UPDATE devices SET sub_id=? WHERE id=?", (sub_id, device_id))
+        _touch_device_id(con, device_id)
+
+def replace_device_uuid(device_id: int, tg_id: int, old_uuid: str, new_uuid: str):
+    with db() as con:
+        con.execute("UPDATE devices SET uuid=? WHERE id=?", (new_uuid, device_id))
+        _touch(tg_id)
+    log_event(tg_id, "refresh", f"old={old_uuid} new={new_uuid}")
+
+def replace_device_uuid_by_sub(sub_id: str, old_uuid: str, new_uuid: str) -> Optional[Dict[str, Any]]:
+    """Меняет uuid устройства после ротации на ноде. Возвращает (tg_id, name) устройства или None."""
+    with db() as con:
+        dev = con.execute(
+            "SELECT tg_id, name FROM devices WHERE sub_id=? AND uuid=?",
+            (sub_id, old_uuid)
+        ).fetchone()
+        if not dev:
+            return None
+        con.execute(
+            "UPDATE devices SET uuid=? WHERE sub_id=? AND uuid=?",
+            (new_uuid, sub_id, old_uuid)
+        )
+        _touch(dev["tg_id"])
+        return dict(dev)
+
+def balance_dirty_batch(limit: int = 500) -> list[Dict[str, Any]]:
+    """Пользователи из очереди balance_dirty с балансом и их не удалённые устройства:
+    [{"tg_id", "seq", "balance_cents", "devices": [...]}]."""
+    with db_read() as con:
+        users = con.execute("""
+            SELECT q.tg_id, q.seq, COALESCE(u.balance_cents, 0) AS balance_cents
+            FROM balance_dirty q LEFT JOIN users u ON u.tg_id = q.tg_id
+            ORDER BY q.changed_at
+            LIMIT ?
+        """, (int(limit),)).fetchall()
+        out = {r["tg_id"]: {**dict(r), "devices": []} for r in users}
+        if out:
+            marks = ",".join("?" * len(out))
+            for d in con.execute(
+                f"SELECT id, uuid, sub_id, tg_id, status, server_base, last_billed FROM devices "
+                f"WHERE tg_id IN ({marks}) AND status != 'deleted' ORDER BY id",
+                list(out)
+            ):
+                out[d["tg_id"]]["devices"].append(dict(d))
+    return list(out.values())
+
+def finish_balance_dirty(items: list[Dict[str, Any]]):
+    """Снять пользователей с очереди. Если баланс успел измениться ещё раз (seq вырос), строка остаётся."""
+    with db() as con:
+        con.executemany(
+            "DELETE FROM balance_dirty WHERE tg_id=? AND seq=?",
+            [(it["tg_id"], it["seq"]) for it in items]
+        )
+
+def defer_balance_dirty(tg_ids: list[int]):
+    """Оставить пользователей в очереди, но переставить в конец (changed_at = сейчас), чтобы не занимали голову пачки."""
+    if not tg_ids:
+        return
+    with db() as con:
+        con.executemany("UPDATE balance_dirty SET changed_at=? WHERE tg_id=?", [(now(), int(t)) for t in tg_ids])
+
+def set_devices_status(pairs: list[tuple[str, str]]):
+    """Пачкой: [(uuid, status), ...]."""
+    if not pairs:
+        return
+    with db() as con:
+        con.executemany("UPDATE devices SET status=? WHERE uuid=?", [(st, u) for u, st in pairs])
+        for u, _ in pairs:
+            _touch_device(con, u)
+
+# Отметки времени в devices исторически бывают и в миллисекундах — приводим к секундам.
+def epoch_sec(x) -> int:
+    try:
+        v = int(x or 0)
+    except (TypeError, ValueError):
+        return 0
+    return v // 1000 if v > 100000000000 else v
+
+def _epoch_sec_sql(col: str) -> str:
+    return f"(CASE WHEN COALESCE({col}, 0) > 100000000000 THEN {col} / 1000 ELSE COALESCE({col}, 0) END)"
+
+_BILLING_DUE_SQL = f"""
+    WITH due AS (
+      SELECT id, uuid, tg_id, sub_id, server_base,
+             ROW_NUMBER() OVER (PARTITION BY tg_id ORDER BY id) AS n
+      FROM devices
+      WHERE status='active' AND activated_at IS NOT NULL
+        AND {_epoch_sec_sql("activated_at")} BETWEEN 1 AND :sod
+        AND {_epoch_sec_sql("last_billed")} < :sod
+    )
+    SELECT due.id, due.uuid, due.tg_id, due.sub_id, due.server_base,
+           due.n <= MAX(COALESCE(u.balance_cents, 0), 0) / :fee AS paid
+    FROM due LEFT JOIN users u ON u.tg_id = due.tg_id
+    ORDER BY due.id
+"""
+
+def bill_daily(charge_cents: int, sod: int) -> Dict[str, Any]:
+    """Суточное списание за все активные устройства одной транзакцией.
+
+    Пользователь платит за столько своих устройств (по порядку id), на сколько хватает
+    баланса; остальные его устройства ставятся на паузу. Возвращает
+    {"charged": устройств, "users": пользователей, "cents": списано, "paused": [строки devices]}."""
+    fee = int(charge_cents)
+    with db() as con:
+        # запись сразу: баланс не должен поменяться между расчётом и списанием
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(_BILLING_DUE_SQL, {"sod": sod, "fee": fee}).fetchall()
+
+        paid = [r for r in rows if r["paid"]]
+        unpaid = [dict(r) for r in rows if not r["paid"]]
+
+        per_user: dict[int, int] = {}
+        for r in paid:
+            per_user[r["tg_id"]] = per_user.get(r["tg_id"], 0) + fee
+
+        con.executemany(
+            "UPDATE users SET balance_cents = balance_cents - ? WHERE tg_id=?",
+            [(cents, tg_id) for tg_id, cents in per_user.items()]
+        )
+        con.executemany(
+            "INSERT INTO payments(tg_id, amount_cents, method, ref, created_at) VALUES(?,?,?,?,?)",
+            [
+                (r["tg_id"], -fee, "daily", f"uuid:{r['uuid']}" if r["uuid"] else f"dev:{r['id']}", sod)
+                for r in paid
+            ]
+        )
+        con.executemany("UPDATE devices SET last_billed=? WHERE id=?", [(sod, r["id"]) for r in paid])
+        con.executemany("UPDATE devices SET status='paused' WHERE id=?", [(r["id"],) for r in unpaid])
+
+        _touch(*per_user, *(r["tg_id"] for r in unpaid))
+
+    for r in unpaid:
+        log_event(r["tg_id"], "auto_pause", f"uuid={r['uuid']}")
+    return {"charged": len(paid), "users": len(per_user), "cents": fee * len(paid), "paused": unpaid}
+
 def mark_billed(uuid: str, ts_day_start: int):
     with db() as con:
         con.execute("UPDATE devices SET last_billed=? WHERE uuid=?", (int(ts_day_start), uuid))
+        _touch_device(con, uuid)
 
 def nearest_expiry_for_user(tg_id: int) -> Optional[str]:
-    with db() as con:
-        r = con.execute(
-            "SELECT MIN(expires_at) FROM devices "
-            "WHERE tg_id=? AND status='active' AND expires_at IS NOT NULL",
-            (tg_id,)
-        ).fetchone()
+    with db_read() as con:
+        r = con.execute("SELECT nearest_exp FROM users WHERE tg_id=?", (tg_id,)).fetchone()
     return r[0] if r and r[0] else None
 
 
@@ -346,6 +992,7 @@ def activate_device_and_maybe_referral(uuid: str, bonus_cents: int = 2000) -> Di
         )
 
         tg_id = int(dev["tg_id"])
+        _touch(tg_id)
 
         r = con.execute(
             "SELECT COUNT(*) FROM devices WHERE tg_id=? AND activated_at IS NOT NULL",
@@ -375,13 +1022,42 @@ def create_promo(code: str, amount_cents: int, uses_left: int = 1):
         )
 
 def fetch_promo(code: str) -> Optional[Dict[str, Any]]:
-    with db() as con:
+    with db_read() as con:
         r = con.execute(
             "SELECT code, amount_cents, uses_left FROM promos WHERE code=?",
             (code,)
         ).fetchone()
         return dict(r) if r else None
 
+def redeem_promo_code(tg_id: int, code: str) -> tuple[str, int]:
+    """Списывает одно использование и зачисляет номинал одной транзакцией.
+    Возвращает (статус, сумма): ok | already_used | not_found | exhausted."""
+    with db() as con:
+        used = con.execute(
+            "SELECT 1 FROM payments WHERE tg_id=? AND method='promo' AND ref=? LIMIT 1",
+            (tg_id, code)
+        ).fetchone()
+        if used:
+            return "already_used", 0
+
+        row = con.execute(
+            "SELECT amount_cents, uses_left FROM promos WHERE code=?",
+            (code,)
+        ).fetchone()
+        if not row or int(row["uses_left"]) <= 0:
+            return "not_found", 0
+
+        cur = con.execute(
+            "UPDATE promos SET uses_left = uses_left - 1 WHERE code=? AND uses_left > 0",
+            (code,)
+        )
+        if cur.rowcount == 0:
+            return "exhausted", 0
+
+        amount_cents = int(row["amount_cents"])
+        add_balance_con(con, tg_id, amount_cents, "promo", code)
+        return "ok", amount_cents
+
 def decrement_promo_use(code: str) -> bool:
     with db() as con:
         r = con.execute("SELECT uses_left FROM promos WHERE code=? AND uses_left>0", (code,)).fetchone()
@@ -392,22 +1068,22 @@ def decrement_promo_use(code: str) -> bool:
 
 
 def counts_summary() -> Dict[str, int]:
-    with db() as con:
-        u = con.execute("SELECT COUNT(*) FROM users").fetchone()[0] or 0
-        d = con.execute("SELECT COUNT(*) FROM devices WHERE status!='deleted'").fetchone()[0] or 0
-        bal = con.execute("SELECT COALESCE(SUM(balance_cents),0) FROM users").fetchone()[0] or 0
-    return {"users": u, "devices": d, "balance_total_cents": bal}
+    with db_read() as con:
+        r = con.execute("SELECT users, devices, balance_cents FROM stats_totals WHERE id=1").fetchone()
+    if not r:
+        return {"users": 0, "devices": 0, "balance_total_cents": 0}
+    return {"users": int(r["users"]), "devices": int(r["devices"]), "balance_total_cents": int(r["balance_cents"])}
 
 def users_page(offset: int, limit: int = 20) -> list[Dict[str, Any]]:
-    with db() as con:
+    with db_read() as con:
         rows = con.execute(
             """
           SELECT
             u.tg_id,
             COALESCE(u.username, '') AS username,
             u.balance_cents,
-            (SELECT COUNT(*) FROM devices d WHERE d.tg_id=u.tg_id AND d.status!='deleted') AS devs,
-            (SELECT MIN(expires_at) FROM devices d WHERE d.tg_id=u.tg_id AND d.status='active' AND d.expires_at IS NOT NULL) AS nearest_exp
+            u.dev_count AS devs,
+            u.nearest_exp
           FROM users u
           ORDER BY u.created_at DESC
           LIMIT ? OFFSET ?
@@ -416,22 +1092,36 @@ def users_page(offset: int, limit: int = 20) -> list[Dict[str, Any]]:
         ).fetchall()
     return [dict(r) for r in rows]
 
+def payments_by_day(day_from: int, day_to: int, method: Optional[str] = None) -> list[Dict[str, Any]]:
+    """Строки payments_daily за дни [day_from, day_to] (день = epoch // 86400)."""
+    sql = "SELECT day, method, amount_cents, cnt FROM payments_daily WHERE day BETWEEN ? AND ?"
+    args: list = [int(day_from), int(day_to)]
+    if method:
+        sql += " AND method=?"
+        args.append(method)
+    with db_read() as con:
+        rows = con.execute(sql + " ORDER BY day, method", args).fetchall()
+    return [dict(r) for r in rows]
+
 def payments_sum_since(ts_from: int, method: Optional[str] = None) -> int:
-    with db() as con:
-        if method:
-            r = con.execute(
-                "SELECT COALESCE(SUM(amount_cents),0) FROM payments WHERE created_at>=? AND method=?",
-                (int(ts_from), method)
-            ).fetchone()
-        else:
-            r = con.execute(
-                "SELECT COALESCE(SUM(amount_cents),0) FROM payments WHERE created_at>=?",
-                (int(ts_from),)
-            ).fetchone()
-    return int(r[0] or 0)
+    """Целые дни — из payments_daily, хвост неполного первого дня — из payments по created_at."""
+    ts_from = int(ts_from)
+    first_full_day = -(-ts_from // 86400)
+    m_sql = " AND method=?" if method else " AND method!='daily_month'"
+    m_arg = [method] if method else []
+    with db_read() as con:
+        full = con.execute(
+            "SELECT COALESCE(SUM(amount_cents),0) FROM payments_daily WHERE day>=?" + m_sql,
+            [first_full_day, *m_arg]
+        ).fetchone()[0]
+        head = con.execute(
+            "SELECT COALESCE(SUM(amount_cents),0) FROM payments WHERE created_at>=? AND created_at<?" + m_sql,
+            [ts_from, first_full_day * 86400, *m_arg]
+        ).fetchone()[0]
+    return int(full or 0) + int(head or 0)
 
 def users_count_low_balance(threshold_cents: int = 1000) -> int:
-    with db() as con:
+    with db_read() as con:
         r = con.execute(
             "SELECT COUNT(*) FROM users WHERE balance_cents < ?",
             (int(threshold_cents),)
@@ -439,29 +1129,545 @@ def users_count_low_balance(threshold_cents: int = 1000) -> int:
         return int(r[0] or 0)
 
 
-def log_event(tg_id: int, etype: str, payload: str):
+def low_balance_users(threshold_cents: int, kind: Optional[str] = None, day: int = 0) -> list[Dict[str, Any]]:
+    """Пользователи с балансом ниже порога и хотя бы одним активным устройством.
+    kind/day — пропустить тех, кому уведомление kind за день day уже ушло (или уходит).
+    +d.status — чтобы планировщик брал ix_devices_tg, а не почти бесполезный ix_devices_status."""
+    with db_read() as con:
+        rows = con.execute("""
+            SELECT u.tg_id, u.balance_cents
+            FROM users u
+            WHERE u.balance_cents < ?
+              AND EXISTS (
+                  SELECT 1 FROM devices d
+                  WHERE d.tg_id = u.tg_id AND +d.status = 'active'
+              )
+              AND NOT EXISTS (
+                  SELECT 1 FROM notifications n
+                  WHERE n.kind = ? AND n.day = ? AND n.tg_id = u.tg_id
+              )
+        """, (int(threshold_cents), kind or "", int(day))).fetchall()
+    return [dict(r) for r in rows]
+
+def max_payment_id(method: str) -> int:
+    with db_read() as con:
+        r = con.execute(
+            "SELECT COALESCE(MAX(id),0) FROM payments WHERE method=?",
+            (method,)
+        ).fetchone()
+        return int(r[0] or 0)
+
+def payments_after(method: str, after_id: int, limit: int) -> list[Dict[str, Any]]:
+    with db_read() as con:
+        rows = con.execute(
+            """
+            SELECT id, tg_id, amount_cents, ref, created_at
+            FROM payments
+            WHERE method=? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+            """,
+            (method, int(after_id), int(limit))
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def grant_first_traffic_bonus(invitee_tg: int, bonus_cents: int) -> Optional[int]:
+    """Бонус за первое подключение приглашённому и его рефереру. Возвращает tg_id реферера."""
     with db() as con:
-        con.execute(
+        row = con.execute(
+            "SELECT referrer FROM users WHERE tg_id=? LIMIT 1",
+            (invitee_tg,)
+        ).fetchone()
+        referrer_tg = int(row["referrer"]) if (row and row["referrer"]) else None
+
+        con.execute("UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE tg_id=?",
+                    (bonus_cents, invitee_tg))
+        if referrer_tg:
+            con.execute("UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE tg_id=?",
+                        (bonus_cents, referrer_tg))
+        _touch(invitee_tg, referrer_tg)
+        return referrer_tg
+
+
+_events: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=EVENTS_QUEUE_MAX)
+_events_thread: Optional[threading.Thread] = None
+_events_thread_lock = threading.Lock()
+
+
+def _insert_events(rows: list[tuple]):
+    with db() as con:
+        con.executemany(
             "INSERT INTO events(tg_id, type, payload, created_at) VALUES(?,?,?,?)",
-            (tg_id, etype, payload, now())
+            rows
         )
 
+
+def _write_events(rows: list[tuple]):
+    """Пачка одной транзакцией. Сбой (обычно database is locked, пока писатель занят)
+    повторяем с растущей паузой; не вышло — пишем построчно, чтобы одна плохая строка
+    не утащила всю пачку."""
+    for attempt in range(EVENTS_FLUSH_RETRIES):
+        if attempt:
+            time.sleep(EVENTS_FLUSH_SEC * 2 ** (attempt - 1))
+        try:
+            _insert_events(rows)
+            return
+        except Exception as e:
+            logging.warning("[db] events flush failed (attempt %d, %d rows): %s", attempt + 1, len(rows), e)
+    lost = 0
+    for row in rows:
+        try:
+            _insert_events([row])
+        except Exception as e:
+            lost += 1
+            logging.warning("[db] event %r lost: %s", row[:2], e)
+    if lost:
+        logging.warning("[db] events flush: %d of %d rows lost", lost, len(rows))
+
+
+def _events_writer():
+    while True:
+        item = _events.get()
+        if item is None:
+            return
+        rows = [item]
+        deadline = time.monotonic() + EVENTS_FLUSH_SEC
+        stop = False
+        while len(rows) < EVENTS_BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                item = _events.get(timeout=left)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            rows.append(item)
+        _write_events(rows)
+        if stop:
+            return
+
+
+def _ensure_events_thread():
+    global _events_thread
+    if _events_thread is not None and _events_thread.is_alive():
+        return
+    with _events_thread_lock:
+        if _events_thread is None or not _events_thread.is_alive():
+            _events_thread = threading.Thread(target=_events_writer, name="db-events", daemon=True)
+            _events_thread.start()
+
+
+def flush_events():
+    """Дописать всё из очереди events и остановить фоновый поток (перезапустится сам)."""
+    global _events_thread
+    with _events_thread_lock:
+        t = _events_thread
+        if t is None or not t.is_alive():
+            return
+        _events.put(None)
+        t.join()
+        _events_thread = None
+
+
+# бот дописывает очередь в adb.shutdown(), а вебхук ЮKassa, notify-сервер и скрипты — только здесь
+atexit.register(flush_events)
+
+
+def log_event(tg_id: int, etype: str, payload: str):
+    """Событие в журнал — асинхронно, групповым коммитом (задержка до EVENTS_FLUSH_MS).
+    Если событие должно попасть в ту же транзакцию, что и изменение, — log_event_con."""
+    row = (tg_id, etype, payload, now())
+    _ensure_events_thread()
+    try:
+        _events.put_nowait(row)
+    except queue.Full:
+        # писатель не успевает — пишем сами, чем теряем событие
+        _write_events([row])
+
 def log_event_con(con: sqlite3.Connection, tg_id: int, etype: str, payload: str):
     con.execute(
         "INSERT INTO events(tg_id, type, payload, created_at) VALUES(?,?,?,?)",
         (tg_id, etype, payload, now())
     )
 
-def find_event_by_payment(payment_id: str):
+def record_yk_payment(payment_id: str, tg_id: int, amount_cents: int, order_id: Optional[str] = None):
     with db() as con:
+        con.execute(
+            "INSERT OR IGNORE INTO yk_payments(payment_id, tg_id, amount_cents, order_id, created_at) "
+            "VALUES(?,?,?,?,?)",
+            (payment_id, tg_id, int(amount_cents), order_id, now())
+        )
+
+def yk_payment(payment_id: str) -> Optional[Dict[str, Any]]:
+    with db_read() as con:
         r = con.execute(
-            "SELECT tg_id, type, payload, created_at FROM events WHERE type='yk:create' AND payload LIKE ? ORDER BY id DESC LIMIT 1",
-            (f'%"{payment_id}"%',)
+            "SELECT payment_id, tg_id, amount_cents, order_id, status, created_at "
+            "FROM yk_payments WHERE payment_id=?",
+            (payment_id,)
         ).fetchone()
         return dict(r) if r else None
 
-def card_payment_exists(ref: str) -> bool:
+def set_yk_payment_status_con(con: sqlite3.Connection, payment_id: str, status: str):
+    con.execute("UPDATE yk_payments SET status=? WHERE payment_id=?", (status, payment_id))
+
+def find_event_by_payment(payment_id: str):
+    """Запись о создании платежа в прежнем формате события yk:create."""
+    p = yk_payment(payment_id)
+    if not p:
+        return None
+    payload = json.dumps({
+        "payment_id": p["payment_id"],
+        "amount_rub": (p["amount_cents"] or 0) // 100,
+        "order_id": p["order_id"],
+    })
+    return {"tg_id": p["tg_id"], "type": "yk:create", "payload": payload, "created_at": p["created_at"]}
+
+# --- очередь повторов операций на нодах ---
+
+def enqueue_node_ops(items: list[Dict[str, Any]]):
+    """Поставить не дошедшие до ноды операции в очередь повторов.
+    items: {"op", "id", "base", "error", ...доп. поля операции}.
+    На устройство хранится одна, последняя операция: новая pause вытесняет старую resume."""
+    ts = now()
+    rows = []
+    for it in items:
+        extra = {k: v for k, v in it.items() if k not in ("op", "id", "base", "error")}
+        rows.append((
+            it["id"], it["op"], it.get("base"), json.dumps(extra) if extra else None,
+            ts + NODE_RETRY_BASE_SEC, it.get("error"), ts,
+        ))
     with db() as con:
+        con.executemany("""
+            INSERT INTO node_ops_retry(ident, op, base, payload, attempts, next_at, last_error, created_at)
+            VALUES(?,?,?,?,0,?,?,?)
+            ON CONFLICT(ident) DO UPDATE SET
+              op = excluded.op, base = excluded.base, payload = excluded.payload,
+              attempts = CASE WHEN node_ops_retry.op = excluded.op THEN node_ops_retry.attempts ELSE 0 END,
+              next_at = excluded.next_at, last_error = excluded.last_error
+        """, rows)
+
+def due_node_ops(limit: int = 500) -> list[Dict[str, Any]]:
+    """Операции, которым пора повторяться, с текущим статусом устройства (dev_status)."""
+    with db_read() as con:
+        rows = con.execute("""
+            SELECT q.ident, q.op, q.base, q.payload, q.attempts,
+                   (SELECT status FROM devices WHERE sub_id=q.ident OR uuid=q.ident LIMIT 1) AS dev_status
+            FROM node_ops_retry q
+            WHERE q.next_at <= ?
+            ORDER BY q.next_at
+            LIMIT ?
+        """, (now(), int(limit))).fetchall()
+    return [dict(r) for r in rows]
+
+def finish_node_ops(items: list[Dict[str, Any]]):
+    """Убрать из очереди (items — строки due_node_ops). Если за это время для устройства
+    поставили другую операцию, она остаётся."""
+    with db() as con:
+        con.executemany(
+            "DELETE FROM node_ops_retry WHERE ident=? AND op=?",
+            [(it["ident"], it["op"]) for it in items]
+        )
+
+def postpone_node_ops(items: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+    """Новая попытка позже (items — строки due_node_ops с "error"). Исчерпавшие
+    NODE_RETRY_MAX_ATTEMPTS удаляются и возвращаются."""
+    ts = now()
+    dropped = []
+    with db() as con:
+        for it in items:
+            attempts = int(it["attempts"]) + 1
+            if attempts >= NODE_RETRY_MAX_ATTEMPTS:
+                con.execute("DELETE FROM node_ops_retry WHERE ident=? AND op=?", (it["ident"], it["op"]))
+                dropped.append(it)
+                continue
+            delay = min(NODE_RETRY_BASE_SEC * 2 ** attempts, NODE_RETRY_MAX_SEC)
+            con.execute(
+                "UPDATE node_ops_retry SET attempts=?, next_at=?, last_error=? WHERE ident=? AND op=?",
+                (attempts, ts + delay, it.get("error"), it["ident"], it["op"])
+            )
+    for it in dropped:
+        log_event(None, "node_op_dropped", json.dumps(
+            {"op": it["op"], "id": it["ident"], "base": it["base"], "error": it.get("error")}
+        ))
+    return dropped
+
+def node_ops_backlog() -> Dict[str, int]:
+    with db_read() as con:
+        r = con.execute(
+            "SELECT COUNT(*), COALESCE(SUM(next_at <= ?), 0) FROM node_ops_retry", (now(),)
+        ).fetchone()
+    return {"queued": int(r[0]), "due": int(r[1])}
+
+
+# --- периодические задачи (bot/services/scheduler.py) ---
+
+def job_states() -> Dict[str, Dict[str, Any]]:
+    with db_read() as con:
+        rows = con.execute("SELECT * FROM jobs").fetchall()
+    return {r["name"]: dict(r) for r in rows}
+
+def record_job_run(name: str, window: int, started: int, duration_ms: int, error: Optional[str] = None):
+    """Итог запуска задачи. Окно считается отработанным только при успехе."""
+    ok = error is None
+    with db() as con:
+        con.execute("""
+            INSERT INTO jobs(name, last_window, last_started, last_finished, last_ms, last_error, runs, failures)
+            VALUES(?,?,?,?,?,?,1,?)
+            ON CONFLICT(name) DO UPDATE SET
+              last_window   = COALESCE(excluded.last_window, jobs.last_window),
+              last_started  = excluded.last_started,
+              last_finished = excluded.last_finished,
+              last_ms       = excluded.last_ms,
+              last_error    = excluded.last_error,
+              runs          = jobs.runs + 1,
+              failures      = jobs.failures + excluded.failures
+        """, (name, window if ok else None, started, now(), int(duration_ms), error, 0 if ok else 1))
+
+
+# --- уведомления: не больше одного вида на пользователя в день ---
+
+def claim_notification(kind: str, day: int, tg_id: int) -> bool:
+    """Занять отправку до send_message. False — уже отправлено или отправляется.
+    Занятая, но не завершённая (падение процесса) отправка не повторяется: лучше
+    потерять одно напоминание, чем прислать его дважды."""
+    with db() as con:
+        res = con.execute(
+            "INSERT OR IGNORE INTO notifications(kind, day, tg_id, status, updated_at) "
+            "VALUES(?,?,?,'sending',?)",
+            (kind, int(day), int(tg_id), now())
+        )
+        return res.rowcount == 1
+
+def finish_notification(kind: str, day: int, tg_id: int, status: Optional[str]):
+    """status: sent|blocked|failed; None — снять занятость, чтобы следующий проход повторил."""
+    with db() as con:
+        if status is None:
+            con.execute(
+                "DELETE FROM notifications WHERE kind=? AND day=? AND tg_id=? AND status='sending'",
+                (kind, int(day), int(tg_id))
+            )
+        else:
+            con.execute(
+                "UPDATE notifications SET status=?, updated_at=? WHERE kind=? AND day=? AND tg_id=?",
+                (status, now(), kind, int(day), int(tg_id))
+            )
+
+def purge_notifications(keep_days: int = 30) -> int:
+    with db() as con:
+        res = con.execute("DELETE FROM notifications WHERE day < ?", (now() // 86400 - int(keep_days),))
+        return res.rowcount
+
+
+# --- ретеншн и архив events ---
+
+EVENTS_ARCHIVE_DDL = """
+CREATE TABLE IF NOT EXISTS arch.events(
+  id             INTEGER PRIMARY KEY,
+  tg_id          INTEGER,
+  type           TEXT NOT NULL,
+  payload        TEXT,
+  created_at     INTEGER NOT NULL,
+  archived_at    INTEGER NOT NULL
+)
+"""
+
+
+def parse_retention(spec: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for chunk in (spec or "").split(","):
+        if "=" not in chunk:
+            continue
+        etype, days = chunk.rsplit("=", 1)
+        try:
+            out[etype.strip()] = int(days)
+        except ValueError:
+            logging.warning("[db] bad events retention entry %r, skipped", chunk)
+    return out
+
+
+def events_archive_path() -> Path:
+    if EVENTS_ARCHIVE_PATH:
+        return Path(EVENTS_ARCHIVE_PATH)
+    return DB_PATH.with_name(DB_PATH.stem + "_events_archive.db")
+
+
+def archive_old_events(max_batches: int = 200) -> int:
+    """Переносит просроченные по политике события в архивную базу.
+    Отдельное соединение и короткие транзакции по EVENTS_ARCHIVE_BATCH строк,
+    так что писатель бота ждёт максимум одно удаление пачки. Возвращает число перенесённых строк."""
+    policy = parse_retention(EVENTS_RETENTION_SPEC)
+    default_days = policy.get("*", 0)
+    con = _connect()
+    moved = 0
+    batches = 0
+    try:
+        con.execute("ATTACH DATABASE ? AS arch", (str(events_archive_path()),))
+        con.execute(EVENTS_ARCHIVE_DDL)
+        con.commit()
+        types = [r[0] for r in con.execute("SELECT DISTINCT type FROM main.events")]
+        for etype in types:
+            days = policy.get(etype, default_days)
+            if days <= 0:
+                continue
+            cutoff = now() - days * 86400
+            while batches < max_batches:
+                batches += 1
+                # Две транзакции, каждая пишет в один файл: в WAL коммит через ATTACH
+                # не атомарен между базами, и сбой мог бы применить DELETE без INSERT.
+                # Сначала копия в архив (id сохраняется — повтор не задвоит), потом удаление
+                # из main только того, что уже лежит в архиве. Сбой между ними — следующий
+                # проход скопирует пачку ещё раз (OR IGNORE) и удалит.
+                con.execute("BEGIN")
+                try:
+                    ids = [r[0] for r in con.execute(
+                        "SELECT id FROM main.events WHERE type=? AND created_at<? "
+                        "ORDER BY created_at LIMIT ?",
+                        (etype, cutoff, EVENTS_ARCHIVE_BATCH)
+                    )]
+                    marks = ",".join("?" * len(ids))
+                    if ids:
+                        con.execute(
+                            f"INSERT OR IGNORE INTO arch.events(id, tg_id, type, payload, created_at, archived_at) "
+                            f"SELECT id, tg_id, type, payload, created_at, ? FROM main.events WHERE id IN ({marks})",
+                            [now(), *ids]
+                        )
+                    con.commit()
+                    if ids:
+                        con.execute("BEGIN IMMEDIATE")
+                        con.execute(
+                            f"DELETE FROM main.events WHERE id IN ({marks}) "
+                            f"AND id IN (SELECT id FROM arch.events WHERE id IN ({marks}))",
+                            ids + ids
+                        )
+                        con.commit()
+                except BaseException:
+                    con.rollback()
+                    raise
+                moved += len(ids)
+                if len(ids) < EVENTS_ARCHIVE_BATCH:
+                    break
+                time.sleep(EVENTS_ARCHIVE_PAUSE_SEC)
+    finally:
+        con.close()
+    if moved:
+        logging.info("[db] archived %d events to %s", moved, events_archive_path())
+    return moved
+
+
+def incremental_vacuum(max_steps: int = 100) -> int:
+    """Возвращает свободные страницы ОС по VACUUM_STEP_PAGES за раз, отпуская писателя между шагами."""
+    freed = 0
+    for _ in range(max_steps):
+        with db() as con:
+            if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return freed
+            free = int(con.execute("PRAGMA freelist_count").fetchone()[0])
+            if free <= 0:
+                break
+            step = min(free, VACUUM_STEP_PAGES)
+            # execute() делает один sqlite3_step (= одна страница); скрипт прогоняет прагму до конца.
+            # Транзакции писателя тут нет — неявный COMMIT executescript ничего не задевает.
+            con.executescript(f"PRAGMA incremental_vacuum({step});")
+        freed += step
+    return freed
+
+
+def enable_incremental_vacuum():
+    """Разовый перевод старой базы в auto_vacuum=INCREMENTAL (полный VACUUM, блокирует базу)."""
+    with db() as con:
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        con.commit()
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        logging.info("[db] auto_vacuum switched to INCREMENTAL")
+
+
+# --- свёртка суточных списаний ---
+
+LEDGER_COMPACT_GROUPS_PER_TX = 100
+
+
+def _month_start(ts: int) -> int:
+    t = time.gmtime(ts)
+    return calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+
+
+def _month_bounds(month: str) -> tuple[int, int]:
+    y, m = map(int, month.split("-"))
+    ny, nm = (y + 1, 1) if m == 12 else (y, m + 1)
+    return calendar.timegm((y, m, 1, 0, 0, 0)), calendar.timegm((ny, nm, 1, 0, 0, 0))
+
+
+def ledger_checksum(rows) -> str:
+    """sha256 по строкам (id, amount_cents, ref, created_at) в порядке id —
+    по бэкапу леджера можно пересчитать и сверить с ledger_compactions."""
+    h = hashlib.sha256()
+    for r in rows:
+        h.update(f"{r[0]}|{r[1]}|{r[2] or ''}|{r[3]}\n".encode())
+    return h.hexdigest()
+
+
+def _compact_group(con: sqlite3.Connection, tg_id: int, month: str) -> int:
+    lo, hi = _month_bounds(month)
+    rows = con.execute(
+        "SELECT id, amount_cents, ref, created_at FROM payments "
+        "WHERE tg_id=? AND method='daily' AND created_at>=? AND created_at<? ORDER BY id",
+        (tg_id, lo, hi)
+    ).fetchall()
+    if not rows:
+        return 0
+    total = sum(int(r[1]) for r in rows)
+    ref = f"month:{month}"
+    cur = con.execute(
+        "UPDATE payments SET amount_cents = amount_cents + ? "
+        "WHERE tg_id=? AND method='daily_month' AND ref=?",
+        (total, tg_id, ref)
+    )
+    if cur.rowcount == 0:
+        con.execute(
+            "INSERT INTO payments(tg_id, amount_cents, method, ref, created_at) VALUES(?,?,?,?,?)",
+            (tg_id, total, "daily_month", ref, lo)
+        )
+    con.execute(
+        "DELETE FROM payments WHERE tg_id=? AND method='daily' AND created_at>=? AND created_at<? AND id<=?",
+        (tg_id, lo, hi, rows[-1][0])
+    )
+    con.execute(
+        "INSERT INTO ledger_compactions(tg_id, month, rows, amount_cents, first_id, last_id, checksum, compacted_at) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        (tg_id, month, len(rows), total, rows[0][0], rows[-1][0], ledger_checksum(rows), now())
+    )
+    return len(rows)
+
+
+def compact_daily_ledger(max_groups: int = 5000) -> Dict[str, int]:
+    """Сворачивает method='daily' закрытых месяцев в одну строку daily_month на (tg_id, месяц).
+    Строки card/promo/referral и текущий месяц не трогаются. Транзакция на
+    LEDGER_COMPACT_GROUPS_PER_TX групп — писатель занят недолго."""
+    cutoff = _month_start(now())
+    with db_read() as con:
+        groups = con.execute(
+            "SELECT tg_id, strftime('%Y-%m', created_at, 'unixepoch') AS month "
+            "FROM payments WHERE method='daily' AND created_at<? "
+            "GROUP BY tg_id, month LIMIT ?",
+            (cutoff, int(max_groups))
+        ).fetchall()
+    folded = 0
+    for i in range(0, len(groups), LEDGER_COMPACT_GROUPS_PER_TX):
+        with db() as con:
+            for g in groups[i:i + LEDGER_COMPACT_GROUPS_PER_TX]:
+                folded += _compact_group(con, int(g["tg_id"]), g["month"])
+    if groups:
+        logging.info("[db] ledger compaction: %d daily rows folded into %d month rows", folded, len(groups))
+    return {"groups": len(groups), "rows": folded}
+
+
+def card_payment_exists(ref: str) -> bool:
+    with db_read() as con:
         r = con.execute(
             "SELECT 1 FROM payments WHERE method='card' AND ref=? LIMIT 1",
             (ref,)
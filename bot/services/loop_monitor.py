@@ -0,0 +1,49 @@
+import os
+import asyncio
+import logging
+import time
+
+# Замер задержки event loop: спим INTERVAL и смотрим, на сколько позже проснулись.
+# Всё, что больше нуля, — время, когда loop был занят синхронным кодом (sqlite, json, ...).
+
+LOOP_LAG_INTERVAL_SEC = float(os.getenv("LOOP_LAG_INTERVAL_SEC", "0.25"))
+LOOP_LAG_REPORT_SEC = float(os.getenv("LOOP_LAG_REPORT_SEC", "300"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
+LAG_STATS = {"samples": 0, "total_ms": 0.0, "max_ms": 0.0, "over_warn": 0}
+
+
+def loop_lag_stats() -> dict:
+    s = dict(LAG_STATS)
+    s["avg_ms"] = round(s["total_ms"] / s["samples"], 2) if s["samples"] else 0.0
+    return s
+
+
+def _reset():
+    LAG_STATS.update(samples=0, total_ms=0.0, max_ms=0.0, over_warn=0)
+
+
+async def run_loop_lag_monitor():
+    last_report = time.monotonic()
+    while True:
+        t0 = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SEC)
+        lag_ms = max(0.0, (time.monotonic() - t0 - LOOP_LAG_INTERVAL_SEC) * 1000)
+
+        LAG_STATS["samples"] += 1
+        LAG_STATS["total_ms"] += lag_ms
+        if lag_ms > LAG_STATS["max_ms"]:
+            LAG_STATS["max_ms"] = lag_ms
+        if lag_ms >= LOOP_LAG_WARN_MS:
+            LAG_STATS["over_warn"] += 1
+            logging.warning("[loop] event loop stalled for %.0f ms", lag_ms)
+
+        now = time.monotonic()
+        if now - last_report >= LOOP_LAG_REPORT_SEC:
+            s = loop_lag_stats()
+            logging.info(
+                "[loop] lag avg=%.2fms max=%.0fms stalls>=%.0fms: %d (samples=%d)",
+                s["avg_ms"], s["max_ms"], LOOP_LAG_WARN_MS, s["over_warn"], s["samples"],
+            )
+            _reset()
+            last_report = now
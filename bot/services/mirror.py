@@ -0,0 +1,152 @@
+import os
+import logging
+from typing import Optional
+
+from bot.services import adb, api
+
+# Локальные копии подписок всех нод менеджера (первый проход — /list, дальше /changes).
+# Чем пользуемся:
+#  - owner(): на какой ноде живёт sub_id/uuid — для старых устройств без server_base
+#    нода дописывается в devices после синхронизации, и их операции идут одной пачкой
+#    на свою ноду, а не поштучно с выбором ноды по нагрузке;
+#  - users_by_name(): найденная в копии подписка — готовый ответ без опроса всех нод
+#    (промах не окончательный: копия отстаёт на интервал синхронизации).
+# Запускается планировщиком (scheduler.py, задача mirror_sync).
+
+MIRROR_SYNC_INTERVAL_SEC = int(os.getenv("MIRROR_SYNC_INTERVAL_SEC", "60"))
+
+
+class UserMirror:
+    """Локальная копия подписок одной ноды менеджера.
+
+    Первый sync() выкачивает /list постранично и запоминает версию изменений,
+    дальше тянутся только записи из /changes?since=<version>.
+    """
+
+    def __init__(self, base: str):
+        self.base = base
+        self.version: Optional[int] = None
+        self.users: dict[str, dict] = {}      # sub_id -> запись
+        self._by_uuid: dict[str, str] = {}    # uuid -> sub_id
+        self._by_name: dict[str, set[str]] = {}
+
+    def by_sub(self, sub_id: str) -> Optional[dict]:
+        return self.users.get(sub_id)
+
+    def by_uuid(self, user_uuid: str) -> Optional[dict]:
+        sub_id = self._by_uuid.get(user_uuid)
+        return self.users.get(sub_id) if sub_id else None
+
+    def by_name(self, name: str) -> list[dict]:
+        return [self.users[s] for s in self._by_name.get(name, ())]
+
+    def _unindex(self, u: dict):
+        if self._by_uuid.get(u.get("uuid")) == u["sub_id"]:
+            del self._by_uuid[u["uuid"]]
+        subs = self._by_name.get(u.get("name"))
+        if subs is not None:
+            subs.discard(u["sub_id"])
+            if not subs:
+                del self._by_name[u["name"]]
+
+    def _apply(self, u: dict):
+        sub_id = u.get("sub_id")
+        if not sub_id:
+            return
+        old = self.users.pop(sub_id, None)
+        if old is not None:
+            self._unindex(old)
+        if u.get("status") == "deleted":
+            return
+        self.users[sub_id] = u
+        if u.get("uuid"):
+            self._by_uuid[u["uuid"]] = sub_id
+        self._by_name.setdefault(u.get("name"), set()).add(sub_id)
+
+    async def _full_load(self) -> bool:
+        users: list[dict] = []
+        version: Optional[int] = None
+        after = 0
+        while True:
+            page = await api.list_users_page(after, base=self.base)
+            if not isinstance(page, dict) or page.get("_error"):
+                logging.warning("[mirror] %s full load failed: %s", self.base, page)
+                return False
+            if version is None:
+                version = int(page.get("version") or 0)
+            users += page.get("items") or []
+            after = page.get("next_after")
+            if not after:
+                break
+        self.users, self._by_uuid, self._by_name = {}, {}, {}
+        for u in users:
+            self._apply(u)
+        self.version = version
+        return True
+
+    async def sync(self) -> bool:
+        if self.version is None:
+            return await self._full_load()
+        while True:
+            resp = await api.fetch_changes(self.version, base=self.base)
+            if not isinstance(resp, dict) or resp.get("_error"):
+                logging.warning("[mirror] %s changes failed: %s", self.base, resp)
+                return False
+            for u in resp.get("items") or []:
+                self._apply(u)
+            self.version = int(resp.get("version") or self.version)
+            if not resp.get("has_more"):
+                return True
+
+
+_mirrors: dict[str, UserMirror] = {}
+
+
+def mirrors() -> list[UserMirror]:
+    for b in api.all_bases():
+        if b not in _mirrors:
+            _mirrors[b] = UserMirror(b)
+    return list(_mirrors.values())
+
+
+def owner(ident: str) -> Optional[str]:
+    """Нода, на которой есть подписка с таким sub_id или uuid (по последней синхронизации)."""
+    for m in _mirrors.values():
+        if m.by_sub(ident) is not None or m.by_uuid(ident) is not None:
+            return m.base
+    return None
+
+
+def users_by_name(name: str) -> list[dict]:
+    items: list[dict] = []
+    for m in _mirrors.values():
+        items += [{**u, "_server": m.base} for u in m.by_name(name)]
+    return items
+
+
+async def _backfill_server_bases() -> int:
+    pairs = []
+    for d in await adb.devices_without_server_base():
+        base = owner((d["sub_id"] or "").strip()) or owner((d["uuid"] or "").strip())
+        if base:
+            pairs.append((d["id"], base))
+    if pairs:
+        await adb.backfill_device_server_bases(pairs)
+    return len(pairs)
+
+
+async def mirror_sync_tick():
+    changed = False
+    failed = []
+    for m in mirrors():
+        before = m.version
+        if not await m.sync():
+            failed.append(m.base)
+        changed = changed or m.version != before
+    # новых владельцев можно узнать только из новых записей — без изменений не сканируем devices
+    if changed:
+        n = await _backfill_server_bases()
+        if n:
+            logging.info("[mirror] server_base backfilled for %d devices", n)
+    if failed:
+        raise RuntimeError(f"mirror sync failed for {', '.join(failed)}")
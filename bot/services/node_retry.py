@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+
+from bot.services import adb, api
+
+# Повтор операций на нодах (pause/revoke/resume...), которые не дошли из-за сбоя ноды.
+# Очередь — таблица node_ops_retry, её пополняет api.batch_by_node.
+# Перед повтором сверяемся с текущим статусом устройства: если пользователь
+# за это время пополнил баланс и устройство снова active, старая pause уже не нужна.
+# Запускается планировщиком (scheduler.py, задача node_ops_retry).
+
+NODE_RETRY_INTERVAL_SEC = int(os.getenv("NODE_RETRY_INTERVAL_SEC", "60"))
+NODE_RETRY_BATCH = 500
+
+_PAUSING_OPS = {"pause", "revoke"}
+
+
+def _stale(item: dict) -> bool:
+    status = item.get("dev_status")
+    if item["op"] in _PAUSING_OPS:
+        return status == "active"
+    if item["op"] == "resume":
+        return status != "active"
+    return False
+
+
+async def retry_node_ops_tick() -> dict:
+    due = await adb.due_node_ops(NODE_RETRY_BATCH)
+    if not due:
+        return {"sent": 0, "done": 0, "stale": 0, "postponed": 0, "dropped": 0}
+
+    stale = [d for d in due if _stale(d)]
+    live = [d for d in due if not _stale(d)]
+
+    results = []
+    if live:
+        ops = [
+            {"op": d["op"], "id": d["ident"], "base": d["base"], **json.loads(d["payload"] or "{}")}
+            for d in live
+        ]
+        results = await api.batch_by_node(ops, retry=False)
+
+    done, failed = list(stale), []
+    for d, r in zip(live, results):
+        if r.get("ok"):
+            done.append(d)
+        elif r.get("retryable"):
+            failed.append({**d, "error": str(r.get("error") or r.get("_error") or "")})
+        else:
+            # нода ответила отказом по существу (устройства нет и т.п.) — повтор не поможет
+            logging.warning("[node_retry] %s %s rejected: %s", d["op"], d["ident"], r.get("error") or r.get("_error"))
+            done.append(d)
+
+    if done:
+        await adb.finish_node_ops(done)
+    dropped = await adb.postpone_node_ops(failed) if failed else []
+    for d in dropped:
+        logging.error("[node_retry] giving up on %s %s after %d attempts: %s",
+                      d["op"], d["ident"], int(d["attempts"]) + 1, d.get("error"))
+
+    res = {"sent": len(live), "done": len(done), "stale": len(stale),
+           "postponed": len(failed) - len(dropped), "dropped": len(dropped)}
+    logging.info("[node_retry] %s", res)
+    return res
@@ -1,6 +1,6 @@
 from aiohttp import web
 import json, logging
-from bot.services import db
+from bot.services import adb
 
 BONUS_CENTS = 2000
 
@@ -19,11 +19,7 @@ async def make_app(bot):
             return web.json_response({"ok": False, "error": "missing sub_id"}, status=400)
 
         # находим устройство по sub_id
-        with db.db() as con:
-            dev = con.execute(
-                "SELECT uuid, tg_id, name FROM devices WHERE sub_id=? LIMIT 1",
-                (sub_id,)
-            ).fetchone()
+        dev = await adb.device_by_sub_id(sub_id)
         if not dev:
             return web.json_response({"ok": False, "error": "device for sub_id not found"}, status=404)
 
@@ -31,25 +27,12 @@ async def make_app(bot):
         invitee_tg = int(dev["tg_id"])
 
 
-        result = db.activate_device_and_maybe_referral(uuid)
+        result = await adb.activate_device_and_maybe_referral(uuid)
         granted = bool(result.get("granted"))
 
         if granted:
 
-            with db.db() as con:
-                row = con.execute(
-                    "SELECT referrer FROM users WHERE tg_id=? LIMIT 1",
-                    (invitee_tg,)
-                ).fetchone()
-                referrer_tg = int(row["referrer"]) if (row and row["referrer"]) else None
-
-
-                con.execute("UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE tg_id=?",
-                            (BONUS_CENTS, invitee_tg))
-                if referrer_tg:
-                    con.execute("UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE tg_id=?",
-                                (BONUS_CENTS, referrer_tg))
-                con.commit()
+            referrer_tg = await adb.grant_first_traffic_bonus(invitee_tg, BONUS_CENTS)
 
 
             try:
@@ -0,0 +1,23 @@
+import os
+import logging
+
+from bot.services import adb, db
+
+# Фоновое обслуживание базы: перенос старых events в архив, свёртка суточных
+# списаний закрытых месяцев, чистка журнала уведомлений и incremental vacuum.
+# Вся работа — в DB-потоках через adb, event loop не блокируется.
+# Запускается планировщиком (scheduler.py, задача events_maintenance).
+
+RETENTION_INTERVAL_SEC = int(os.getenv("EVENTS_RETENTION_INTERVAL_SEC", "3600"))
+
+
+async def events_maintenance_tick():
+    moved = await adb.run(db.archive_old_events)
+    folded = await adb.run(db.compact_daily_ledger)
+    await adb.run(db.purge_notifications)
+    freed = await adb.run(db.incremental_vacuum)
+    if moved or folded["rows"] or freed:
+        logging.info(
+            "[retention] archived=%d events, folded=%d daily rows, freed=%d pages",
+            moved, folded["rows"], freed,
+        )
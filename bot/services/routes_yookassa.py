@@ -10,6 +10,7 @@ TEST_MODE          = os.getenv("YKASSA_TEST_MODE", "0") == "1"
 
 
 from bot.services import db as dbsvc
+from bot.services import adb
 
 # Конфигурация YooKassa
 if YKASSA_ACCOUNT_ID and YKASSA_SECRET_KEY:
@@ -22,6 +23,16 @@ app = FastAPI()
 async def health():
     return {"ok": True, "service": "yookassa-webhook"}
 
+def _credit_payment(tg_id: int, amount_cents: int, payment_id: str):
+    with dbsvc.db() as con:
+        con.execute(
+            "INSERT OR IGNORE INTO users(tg_id, created_at, balance_cents) VALUES(?,?,?)",
+            (tg_id, dbsvc.now(), 0)
+        )
+        dbsvc.set_yk_payment_status_con(con, payment_id, "succeeded")
+        dbsvc.add_balance_con(con, tg_id, amount_cents, "card", payment_id)
+
+
 @app.post("/yookassa/webhook")
 @app.post("/payhook")
 async def yookassa_webhook(req: Request):
@@ -58,6 +69,9 @@ async def yookassa_webhook(req: Request):
 
     meta = dict(getattr(pay, "metadata", {}) or {})
     tg_id = int(meta.get("tg_id") or 0)
+    if tg_id <= 0:
+        known = await adb.yk_payment(payment_id)
+        tg_id = int(known["tg_id"]) if known else 0
     if tg_id <= 0:
         logging.warning(f"[yk] no tg_id in metadata for {payment_id}")
         return {"ok": True}
@@ -71,12 +85,7 @@ async def yookassa_webhook(req: Request):
         return {"ok": True}
 
     try:
-        with dbsvc.db() as con:
-            con.execute(
-                "INSERT OR IGNORE INTO users(tg_id, created_at, balance_cents) VALUES(?,?,?)",
-                (tg_id, dbsvc.now(), 0)
-            )
-        dbsvc.add_balance(tg_id, amount_cents, method="card", ref=payment_id)
+        await adb.run(_credit_payment, tg_id, amount_cents, payment_id)
     except sqlite3.IntegrityError:
         # уже зачислено ранее
         pass
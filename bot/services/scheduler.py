@@ -1,16 +1,55 @@
+import os
+import time
 import asyncio
 import logging
+from typing import Any, Awaitable, Callable, Optional
 from aiogram import Bot
 
-from bot.services import db, api
+from bot.services import db, adb, api
+from bot.services.retention import events_maintenance_tick, RETENTION_INTERVAL_SEC
+from bot.services.node_retry import retry_node_ops_tick, NODE_RETRY_INTERVAL_SEC
+from bot.services.mirror import mirror_sync_tick, MIRROR_SYNC_INTERVAL_SEC
+from bot.services.cache import sweep_ttl_maps
+from bot.services.sender import TelegramSender, permanent_failure
 from bot.settings import MONTHLY_FEE, DAILY_FEE_C
 
 LOW_BALANCE_CENTS = 1000  # 10 ₽
-_last_notif_day = 0
-
-
-async def mark_activated_if_ready():
-    return
+LOW_BALANCE_KIND = "low_balance"
+
+# Периодические задачи с окнами, привязанными к часам: окно job — [k*period + offset, +period).
+# Отработанное окно пишется в таблицу jobs, поэтому рестарт не сдвигает расписание и не
+# повторяет уже сделанное, а пропущенное (простой, падение) окно догоняется один раз при старте.
+BILLING_OFFSET_SEC = int(os.getenv("BILLING_UTC_OFFSET_SEC", "60"))                     # 00:01 UTC
+LOW_BALANCE_OFFSET_SEC = int(os.getenv("LOW_BALANCE_NOTIFY_UTC_OFFSET_SEC", "600"))    # после списания
+JOB_RETRY_SEC = 300        # упавшая задача повторяется через столько (но в пределах своего периода)
+JOB_MAX_SLEEP_SEC = 300    # дольше не спим — сверяемся с часами (перевод времени, suspend)
+TTL_SWEEP_SEC = 60
+
+
+class Job:
+    """after — задача, которая должна успешно отработать своё окно, покрывающее начало
+    окна этой (для суточных — тот же день), прежде чем эта запустится."""
+    __slots__ = ("name", "period", "offset", "fn", "after")
+
+    def __init__(
+        self, name: str, period: int, offset: int, fn: Callable[[], Awaitable[Any]],
+        after: Optional["Job"] = None,
+    ):
+        self.name = name
+        self.period = max(1, int(period))
+        self.offset = int(offset) % self.period
+        self.fn = fn
+        self.after = after
+
+    def window(self, ts: float) -> int:
+        """Начало окна, в которое попадает ts."""
+        return int(ts - (ts - self.offset) % self.period)
+
+    def next_run(self, last_window: Optional[int], now: float) -> float:
+        cur = self.window(now)
+        if last_window is None or last_window < cur:
+            return now
+        return cur + self.period
 
 
 def _start_of_utc_day(ts: int | None = None) -> int:
@@ -18,14 +57,6 @@ def _start_of_utc_day(ts: int | None = None) -> int:
     return ts - (ts % 86400)
 
 
-def _sec(x) -> int:
-    try:
-        v = int(x or 0)
-    except Exception:
-        return 0
-    return v // 1000 if v > 10**11 else v
-
-
 async def daily_billing_tick():
     try:
         charge_cents = int(DAILY_FEE_C() if callable(DAILY_FEE_C) else DAILY_FEE_C)
@@ -38,108 +69,153 @@ async def daily_billing_tick():
         logging.info("[billing] skip: fee is 0")
         return
 
-    with db.db() as con:
-        rows = con.execute("""
-            SELECT id, uuid, tg_id, status, activated_at, last_billed, sub_id
-            FROM devices
-            WHERE status='active' AND activated_at IS NOT NULL
-            ORDER BY id
-        """).fetchall()
-    logging.info("[billing] candidates=%d", len(rows))
-
-    for r in rows:
-        uuid   = (r["uuid"]   or "").strip()
-        sub_id = (r["sub_id"] or "").strip()
-        tg_id  = int(r["tg_id"])
-
-        activated_at = _sec(r["activated_at"])
-        last_billed  = _sec(r["last_billed"])
-
-
-        if activated_at <= 0 or activated_at > sod or last_billed >= sod:
-            continue
-
-        charged = False
-        with db.db() as con:
-            cur = con.execute("SELECT balance_cents FROM users WHERE tg_id=?", (tg_id,)).fetchone()
-            cur_cents = int(cur["balance_cents"] if cur else 0)
-
-            if cur_cents >= charge_cents:
-
-                res = con.execute(
-                    "UPDATE users SET balance_cents = balance_cents - ? "
-                    "WHERE tg_id=? AND balance_cents >= ?",
-                    (charge_cents, tg_id, charge_cents)
-                )
-                if res.rowcount == 1:
-
-                    ref = f"uuid:{uuid}" if uuid else f"dev:{r['id']}"
-                    con.execute(
-                        "INSERT INTO payments(tg_id, amount_cents, method, ref, created_at) "
-                        "VALUES(?,?,?,?,?)",
-                        (tg_id, -charge_cents, "daily", ref, sod)
-                    )
-
-                    con.execute("UPDATE devices SET last_billed=? WHERE uuid=?", (sod, uuid))
-                    charged = True
-                    logging.info("[billing] charged uuid=%s tg=%s -%dc", uuid, tg_id, charge_cents)
-
-        if charged:
-            continue
-
-
-        with db.db() as con:
-            con.execute("UPDATE devices SET status='paused' WHERE uuid=?", (uuid,))
-            db.log_event_con(con, tg_id, "auto_pause", f"uuid={uuid}")
-        ident = sub_id or uuid
-        logging.info("[billing] paused uuid=%s tg=%s (insufficient balance)", uuid, tg_id)
+    res = await adb.bill_daily(charge_cents, sod)
+    logging.info(
+        "[billing] charged %d devices of %d users (-%dc), paused %d",
+        res["charged"], res["users"], res["cents"], len(res["paused"]),
+    )
+
+    to_pause: list[dict] = []
+    for r in res["paused"]:
+        uuid = (r["uuid"] or "").strip()
+        ident = (r["sub_id"] or "").strip() or uuid
+        logging.info("[billing] paused uuid=%s tg=%s (insufficient balance)", uuid, r["tg_id"])
         if ident:
-            try:
-                await api.pause(ident)
-            except Exception as e:
-                logging.warning("[billing] api.pause failed for %s: %s", ident, e)
+            to_pause.append({"op": "pause", "id": ident, "base": (r["server_base"] or "").strip() or None})
 
+    if to_pause:
+        # одна пачка на ноду вместо отдельного запроса (и рестарта xray) на каждое устройство
+        try:
+            results = await api.batch_by_node(to_pause)
+        except Exception as e:
+            logging.warning("[billing] batch pause failed for %d devices: %s", len(to_pause), e)
+        else:
+            for r in results:
+                # сбои ноды уже в очереди повторов (node_retry), здесь — только отказы по существу
+                if not r.get("ok") and not r.get("retryable"):
+                    logging.warning("[billing] api pause failed for %s: %s", r.get("id"), r.get("error") or r.get("_error"))
 
 
-async def send_low_balance_notifications(bot: Bot):
-    global _last_notif_day
-    start_of_day = _start_of_utc_day()
 
-    if _last_notif_day == start_of_day:
+async def send_low_balance_notifications(bot: Bot):
+    """Одно напоминание в UTC-день на пользователя. Проход возобновляемый: кому уже
+    отправлено (или отправляется), таблица notifications отсекает ещё в запросе."""
+    day = db.now() // 86400
+    rows = await adb.low_balance_users(LOW_BALANCE_CENTS, LOW_BALANCE_KIND, day)
+    if not rows:
         return
-    _last_notif_day = start_of_day
-
-    with db.db() as con:
-        rows = con.execute("""
-            SELECT u.tg_id, u.balance_cents
-            FROM users u
-            WHERE u.balance_cents < ?
-              AND EXISTS (
-                  SELECT 1 FROM devices d
-                  WHERE d.tg_id = u.tg_id AND d.status = 'active'
-              )
-        """, (LOW_BALANCE_CENTS,)).fetchall()
 
     daily_rub = max(1, round(MONTHLY_FEE / 30))
-    for r in rows:
-        tg_id = r["tg_id"]
+    sender = TelegramSender(bot)
+
+    async def notify(r: dict) -> str:
+        tg_id = int(r["tg_id"])
+        if not await adb.claim_notification(LOW_BALANCE_KIND, day, tg_id):
+            return "skipped"
         bal_rub = r["balance_cents"] // 100
         try:
-            await bot.send_message(
+            await sender.send(
                 tg_id,
                 f"⚠️ Баланс {bal_rub} ₽ — меньше 10 ₽.\n"
                 f"Списание ~{daily_rub} ₽/день. Пополните баланс, иначе подписка уйдёт на паузу."
             )
         except Exception as e:
+            status = permanent_failure(e)
+            await adb.finish_notification(LOW_BALANCE_KIND, day, tg_id, status)
             logging.warning("low-balance notify failed for %s: %s", tg_id, e)
+            return status or "retry"
+        await adb.finish_notification(LOW_BALANCE_KIND, day, tg_id, "sent")
+        return "sent"
+
+    stats = await sender.fan_out(rows, notify)
+    logging.info("[low_balance] %d recipients: %s", len(rows), stats)
+    left = stats.get("retry", 0) + stats.get("error", 0)
+    if left:
+        # задача не отмечает окно отработанным и повторит проход — уже отправленных он пропустит
+        raise RuntimeError(f"{left} low-balance notifications left unsent")
+
+
+async def ttl_sweep_tick():
+    # cooldown-карты (balance_guard, vpn), к которым давно не обращались, сами не чистятся
+    n = sweep_ttl_maps()
+    if n:
+        logging.debug("[ttl_sweep] expired %d entries", n)
+
+
+def scheduled_jobs(bot: Bot) -> list[Job]:
+    billing = Job("billing", 86400, BILLING_OFFSET_SEC, daily_billing_tick)
+    return [
+        billing,
+        # балансы для напоминаний — только после списания за этот день
+        Job("low_balance_notify", 86400, LOW_BALANCE_OFFSET_SEC, lambda: send_low_balance_notifications(bot),
+            after=billing),
+        Job("events_maintenance", RETENTION_INTERVAL_SEC, 0, events_maintenance_tick),
+        Job("node_ops_retry", NODE_RETRY_INTERVAL_SEC, 0, retry_node_ops_tick),
+        Job("mirror_sync", MIRROR_SYNC_INTERVAL_SEC, 0, mirror_sync_tick),
+        Job("ttl_sweep", TTL_SWEEP_SEC, 0, ttl_sweep_tick),
+    ]
+
+
+async def _after_done(job: Job, window: int) -> bool:
+    dep = job.after
+    last = (await adb.job_states()).get(dep.name, {}).get("last_window")
+    return last is not None and last >= dep.window(window)
+
+
+async def _run_job(job: Job, state: dict):
+    last_window = state.get("last_window")
+    retry_at: Optional[float] = None
+    while True:
+        now = time.time()
+        due = retry_at if retry_at is not None else job.next_run(last_window, now)
+        if due > now:
+            await asyncio.sleep(min(due - now, JOB_MAX_SLEEP_SEC))
+            continue
+
+        window = job.window(now)
+        if job.after is not None:
+            try:
+                ready = await _after_done(job, window)
+            except Exception as e:
+                logging.warning("[jobs] %s: can't check %s: %s", job.name, job.after.name, e)
+                ready = False
+            if not ready:
+                logging.info("[jobs] %s waits for %s", job.name, job.after.name)
+                retry_at = time.time() + min(JOB_RETRY_SEC, job.period)
+                continue
+
+        started = int(now)
+        t0 = time.monotonic()
+        error = None
+        try:
+            await job.fn()
+        except Exception as e:
+            error = repr(e)
+            logging.exception("[jobs] %s failed: %s", job.name, e)
+        ms = int((time.monotonic() - t0) * 1000)
+
+        try:
+            await adb.record_job_run(job.name, window, started, ms, error)
+        except Exception as e:
+            logging.warning("[jobs] %s: can't record run: %s", job.name, e)
+
+        if error is None:
+            last_window, retry_at = window, None
+        else:
+            retry_at = time.time() + min(JOB_RETRY_SEC, job.period)
 
 
 async def run_scheduler(bot: Bot):
     while True:
         try:
-            await mark_activated_if_ready()
-            await daily_billing_tick()
-            await send_low_balance_notifications(bot)
+            states = await adb.job_states()
+            break
         except Exception as e:
-            logging.exception("scheduler error: %s", e)
-        await asyncio.sleep(3600)
+            logging.warning("[jobs] can't load job states: %s", e)
+            await asyncio.sleep(5)
+
+    jobs = scheduled_jobs(bot)
+    for j in jobs:
+        nxt = j.next_run(states.get(j.name, {}).get("last_window"), time.time())
+        logging.info("[jobs] %s: every %ds, next in %ds", j.name, j.period, max(0, int(nxt - time.time())))
+    await asyncio.gather(*(_run_job(j, states.get(j.name, {})) for j in jobs))
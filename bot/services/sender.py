@@ -0,0 +1,109 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+# Рассылка в Telegram с учётом лимитов: не больше TG_SEND_RATE сообщений в секунду на бота
+# (у Telegram ~30/с) и не чаще раза в TG_CHAT_INTERVAL_SEC в один чат. На 429 (RetryAfter)
+# встаёт на паузу вся рассылка, а не один воркер — иначе остальные добивают тот же лимит.
+#
+#   sender = TelegramSender(bot)
+#   stats = await sender.fan_out(items, lambda it: sender.send(it["tg_id"], text))
+
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE", "25"))
+TG_CHAT_INTERVAL_SEC = float(os.getenv("TG_CHAT_INTERVAL_SEC", "1.0"))
+TG_SEND_CONCURRENCY = int(os.getenv("TG_SEND_CONCURRENCY", "8"))
+TG_RETRY_AFTER_MAX = 3     # сколько раз повторяем одно сообщение после 429
+
+
+class RateLimiter:
+    """Равномерно не чаще rate событий в секунду; block() — общая пауза (на 429)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / max(0.001, float(rate))
+        self._next = 0.0
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, sec: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + float(sec))
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            at = max(self._next, self._blocked_until, now)
+            self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+class TelegramSender:
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = TG_SEND_RATE,
+        chat_interval: float = TG_CHAT_INTERVAL_SEC,
+        concurrency: int = TG_SEND_CONCURRENCY,
+    ):
+        self.bot = bot
+        self.limiter = RateLimiter(rate)
+        self.chat_interval = float(chat_interval)
+        self.concurrency = max(1, int(concurrency))
+        self._chat_next: dict[int, float] = {}
+
+    async def _wait_chat(self, chat_id: int):
+        now = time.monotonic()
+        at = max(self._chat_next.get(chat_id, 0.0), now)
+        self._chat_next[chat_id] = at + self.chat_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        """send_message в рамках лимитов. 429 пережидает сам; прочие ошибки Telegram пробрасывает."""
+        for attempt in range(TG_RETRY_AFTER_MAX + 1):
+            await self._wait_chat(chat_id)
+            await self.limiter.wait()
+            try:
+                return await self.bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                delay = max(1, int(getattr(e, "retry_after", 5)))
+                logging.warning("[sender] 429, pause %ss (chat %s)", delay, chat_id)
+                self.limiter.block(delay)
+                if attempt >= TG_RETRY_AFTER_MAX:
+                    raise
+
+    async def fan_out(self, items: Iterable[Any], fn: Callable[[Any], Awaitable[Optional[str]]]) -> dict:
+        """Обработать items в concurrency воркеров. fn возвращает итог (строку) — он идёт в счётчики."""
+        q: asyncio.Queue = asyncio.Queue()
+        for it in items:
+            q.put_nowait(it)
+        stats: dict[str, int] = {}
+
+        async def worker():
+            while True:
+                try:
+                    it = q.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    outcome = await fn(it) or "done"
+                except Exception as e:
+                    logging.warning("[sender] item failed: %r", e)
+                    outcome = "error"
+                stats[outcome] = stats.get(outcome, 0) + 1
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return stats
+
+
+def permanent_failure(e: Exception) -> Optional[str]:
+    """Итог для ошибок, после которых слать этому чату бессмысленно; None — можно повторить позже."""
+    if isinstance(e, TelegramForbiddenError):
+        return "blocked"
+    if isinstance(e, TelegramBadRequest):
+        return "failed"
+    return None
@@ -1,9 +1,12 @@
-from bot.services import api
+from bot.services import api, mirror
 
 async def is_first_time(tg_id: int) -> bool:
 
-    users = await api.list_users()
-    if isinstance(users, list):
-        name = f"tg_{tg_id}"
-        return all(u.get("name") != name for u in users)
-    return False
\ No newline at end of file
+    name = f"tg_{tg_id}"
+    # подписка в копии — точно не первый раз; промах проверяем на нодах (копия может отставать)
+    if mirror.users_by_name(name):
+        return False
+    users = await api.users_by_name(name)
+    if users is None:
+        return False
+    return not users
@@ -0,0 +1,78 @@
+import logging
+import sqlite3
+from typing import Callable, Sequence, Union
+
+# Версионные миграции схемы SQLite. Номер версии хранится в PRAGMA user_version
+# (заголовок файла базы): шаг N применяется один раз, в своей транзакции,
+# вместе с user_version = N. Если схема актуальна, старт — одно чтение версии.
+#
+# Только stdlib — модуль используют и бот (db.py), и xray_manager; лежит рядом с менеджером,
+# потому что на ноды тот ставится вместе с ним, без пакета bot.
+#
+#   STEPS = [_v1_baseline, "CREATE INDEX ...", [...]]
+#   migrations.apply(con, STEPS, "bot")
+#
+# Шаги только дописываются в конец: менять или удалять уже выпущенный шаг нельзя.
+# Первый шаг каждой базы — baseline, идемпотентный: он же принимает старые базы,
+# созданные до появления версий.
+
+Step = Union[str, Sequence[str], Callable[[sqlite3.Connection], None]]
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return int(con.execute("PRAGMA user_version").fetchone()[0])
+
+
+def has_table(con: sqlite3.Connection, name: str) -> bool:
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+    ).fetchone() is not None
+
+
+def has_column(con: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(r[1] == column for r in con.execute(f"PRAGMA table_info({table})"))
+
+
+def add_column(con: sqlite3.Connection, table: str, column: str, decl: str) -> bool:
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет. True — если добавили."""
+    if has_column(con, table, column):
+        return False
+    con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+
+def _run_step(con: sqlite3.Connection, step: Step):
+    if callable(step):
+        step(con)
+    elif isinstance(step, str):
+        con.execute(step)
+    else:
+        for sql in step:
+            con.execute(sql)
+
+
+def apply(con: sqlite3.Connection, steps: Sequence[Step], name: str = "db") -> int:
+    """Довести схему до версии len(steps). Возвращает итоговую версию.
+    Вызывать вне транзакции: каждый шаг сам открывает BEGIN IMMEDIATE."""
+    target = len(steps)
+    current = schema_version(con)
+    if current >= target:
+        return current
+
+    for version in range(current + 1, target + 1):
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            # другой процесс мог успеть раньше — перепроверяем под блокировкой
+            if schema_version(con) >= version:
+                con.rollback()
+                continue
+            _run_step(con, steps[version - 1])
+            con.execute(f"PRAGMA user_version = {version}")
+            con.commit()
+        except BaseException:
+            con.rollback()
+            logging.exception("[migrate:%s] step %d failed", name, version)
+            raise
+        logging.info("[migrate:%s] schema version %d", name, version)
+
+    return schema_version(con)
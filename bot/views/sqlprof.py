@@ -0,0 +1,218 @@
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from typing import Any, Optional
+
+# Профилирование SQLite по форме запроса (литералы -> ?, списки IN -> (...)):
+# число вызовов, суммарное/максимальное время, гистограмма задержек, строки на выходе.
+# Запросы медленнее DB_SLOW_MS пишутся в лог вместе с EXPLAIN QUERY PLAN.
+#
+# Включается DB_PROFILE=1: соединение открывается с factory=ProfiledConnection.
+# Выключено — ни одной лишней инструкции на запрос. Только stdlib: модуль
+# используют и бот (db.py), и xray_manager, с которым он и ставится на ноды.
+#
+# Время execute() — это первый шаг запроса (для SQLite обычно основная работа:
+# сортировка, агрегаты, первый поиск по индексу); время fetch* добавляется к той же форме.
+
+ENABLED = os.getenv("DB_PROFILE", "0") == "1"
+SLOW_MS = float(os.getenv("DB_SLOW_MS", "50"))
+PLAN_EVERY_SEC = 600           # план одной и той же формы — не чаще раза в 10 минут
+MAX_SHAPES = 2000
+
+# верхние границы корзин гистограммы, мс; последняя — всё, что дольше
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+_lock = threading.Lock()
+_stats: dict[str, dict] = {}
+_shape_cache: dict[str, str] = {}
+
+_RE_STR = re.compile(r"'(?:[^']|'')*'")
+_RE_NUM = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_RE_IN = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_RE_WS = re.compile(r"\s+")
+_EXPLAINABLE = {"SELECT", "WITH", "INSERT", "REPLACE", "UPDATE", "DELETE"}
+
+
+def shape(sql: str) -> str:
+    """Нормализованная форма запроса: по ней группируется статистика."""
+    s = _shape_cache.get(sql)
+    if s is None:
+        s = _RE_WS.sub(" ", sql).strip()
+        s = _RE_STR.sub("?", s)
+        s = _RE_NUM.sub("?", s)
+        s = _RE_IN.sub("IN (...)", s)
+        if len(_shape_cache) < MAX_SHAPES * 4:
+            _shape_cache[sql] = s
+    return s
+
+
+def _entry(key: str) -> Optional[dict]:
+    st = _stats.get(key)
+    if st is None:
+        if len(_stats) >= MAX_SHAPES:
+            return None
+        st = _stats[key] = {
+            "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+            "hist": [0] * (len(BUCKETS_MS) + 1), "slow": 0, "plan_ts": 0.0,
+        }
+    return st
+
+
+def _bucket(ms: float) -> int:
+    for i, edge in enumerate(BUCKETS_MS):
+        if ms <= edge:
+            return i
+    return len(BUCKETS_MS)
+
+
+def _record_call(key: str, ms: float) -> bool:
+    """Учесть вызов. True — если пора показать план (медленный и давно не показывали)."""
+    with _lock:
+        st = _entry(key)
+        if st is None:
+            return False
+        st["calls"] += 1
+        st["total_ms"] += ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        st["hist"][_bucket(ms)] += 1
+        if ms < SLOW_MS:
+            return False
+        st["slow"] += 1
+        now = time.monotonic()
+        if now - st["plan_ts"] < PLAN_EVERY_SEC:
+            return False
+        st["plan_ts"] = now
+        return True
+
+
+def _record_fetch(key: str, ms: float, rows: int):
+    with _lock:
+        st = _stats.get(key)
+        if st is not None:
+            st["total_ms"] += ms
+            st["rows"] += rows
+
+
+def _explain(con: sqlite3.Connection, sql: str, params: Any) -> str:
+    verb = (sql.split(None, 1) or [""])[0].upper()
+    if verb not in _EXPLAINABLE:
+        return ""
+    try:
+        # обычный курсор, чтобы сам EXPLAIN не попал в статистику
+        cur = sqlite3.Cursor(con)
+        rows = cur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return "\n".join(f"  {r[3]}" for r in rows)
+    except sqlite3.Error as e:
+        return f"  (no plan: {e})"
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    _shape: Optional[str] = None
+
+    def _timed(self, method, sql: str, params: Any, plan_params: Any):
+        t0 = time.perf_counter()
+        try:
+            return method(self, sql, params)
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            self._shape = key = shape(sql)
+            if _record_call(key, ms):
+                logging.warning(
+                    "[sql] slow %.1f ms: %s\n%s",
+                    ms, key[:500], _explain(self.connection, sql, plan_params),
+                )
+
+    def execute(self, sql: str, params: Any = ()):
+        return self._timed(sqlite3.Cursor.execute, sql, params, params)
+
+    def executemany(self, sql: str, seq_of_params):
+        seq = seq_of_params if isinstance(seq_of_params, (list, tuple)) else list(seq_of_params)
+        return self._timed(sqlite3.Cursor.executemany, sql, seq, seq[0] if seq else ())
+
+    def _fetched(self, t0: float, rows: int):
+        if self._shape is not None:
+            _record_fetch(self._shape, (time.perf_counter() - t0) * 1000, rows)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(t0, row is not None)
+        return row
+
+    def fetchmany(self, size: int = -1):
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size) if size >= 0 else super().fetchmany()
+        self._fetched(t0, len(rows))
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(t0, len(rows))
+        return rows
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        row = super().__next__()
+        self._fetched(t0, 1)
+        return row
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=ProfiledConnection): все курсоры — ProfiledCursor."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, params: Any = ()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql: str, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def connection_factory():
+    """factory для sqlite3.connect: ProfiledConnection, если профилирование включено."""
+    return ProfiledConnection if ENABLED else sqlite3.Connection
+
+
+def _percentile(hist: list[int], calls: int, q: float) -> Optional[float]:
+    """Верхняя граница корзины, в которую попал q-й перцентиль (оценка сверху).
+    None — перцентиль в последней, открытой корзине (> BUCKETS_MS[-1])."""
+    need = calls * q
+    acc = 0
+    for i, n in enumerate(hist):
+        acc += n
+        if acc >= need:
+            return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+    return None
+
+
+def top(limit: int = 10, order: str = "total_ms") -> list[dict]:
+    """Худшие формы запросов: order = total_ms | max_ms | calls | rows | slow."""
+    with _lock:
+        items = [(k, dict(v, hist=list(v["hist"]))) for k, v in _stats.items()]
+    items.sort(key=lambda kv: kv[1].get(order, 0), reverse=True)
+    out = []
+    for key, st in items[:limit]:
+        calls = st["calls"] or 1
+        out.append({
+            "sql": key,
+            "calls": st["calls"],
+            "total_ms": round(st["total_ms"], 1),
+            "avg_ms": round(st["total_ms"] / calls, 3),
+            "p95_ms": _percentile(st["hist"], st["calls"], 0.95),
+            "max_ms": round(st["max_ms"], 1),
+            "rows": st["rows"],
+            "slow": st["slow"],
+            "hist": dict(zip([f"<={b}" for b in BUCKETS_MS] + ["inf"], st["hist"])),
+        })
+    return out
+
+
+def reset():
+    with _lock:
+        _stats.clear()
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import datetime
 import json
@@ -13,9 +14,20 @@ import threading
 import requests
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from urllib.parse import quote
 
+# Менеджер ставится на ноды отдельно от бота, пакета bot там нет: рядом с
+# xray_manager.py кладутся его stdlib-модули (migrations.py, sqlprof.py).
+# В дереве репозитория они берутся из bot.views.
+try:
+    from bot.views import migrations, sqlprof
+except ImportError:
+    import migrations
+    import sqlprof
+
 
 
 CONF            = os.environ.get("XRAY_CONF", "/usr/local/etc/xray/config.json")
@@ -36,8 +48,6 @@ BOT_NOTIFY_URL  = os.environ.get("BOT_NOTIFY_URL", "http://127.0.0.1:8081/notify
 
 _PBK_ENV        = (os.environ.get("XRAY_REALITY_PBK") or "").strip() or None
 
-_VIOL_TICKS: dict[str, int] = {}
-_LAST_KICK_TS: dict[str, float] = {}
 XRAY_SLOT_FILE   = "/var/lib/xraymgr/active_slot"
 XRAY_CFG_A       = "/etc/xray/config-a.json"
 XRAY_CFG_B       = "/etc/xray/config-b.json"
@@ -50,68 +60,115 @@ ACCESS_LOGS      = ["/var/log/xray/access-a.log", "/var/log/xray/access-b.log"]
 
 SUB_PREFIX      = os.environ.get("XRAY_SUB_PREFIX", "api").strip("/")
 
+IDEM_TTL_SEC    = int(os.environ.get("XRAY_IDEM_TTL_SEC", "86400"))
+IDEM_PATHS      = {"/create", "/refresh", "/rotate", "/revoke", "/pause", "/resume", "/setname", "/batch"}
+
 
 def _db():
-    conn = sqlite3.connect(DB)
+    conn = sqlite3.connect(DB, factory=sqlprof.connection_factory())
     conn.row_factory = sqlite3.Row
     return conn
 
-def _init_db():
-    os.makedirs(os.path.dirname(DB), exist_ok=True)
-    with _db() as conn:
-
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            sub_id      TEXT UNIQUE,
-            name        TEXT NOT NULL,
-            created_at  TEXT NOT NULL,
-            expires_at  TEXT NOT NULL,
-            status      TEXT NOT NULL,
-            uuid        TEXT NOT NULL
-        )
-        """)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS devices(
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            tg_id       TEXT,
-            uuid        TEXT NOT NULL UNIQUE,
-            name        TEXT NOT NULL,
-            os          TEXT,
-            status      TEXT NOT NULL,
-            created_at  TEXT NOT NULL,
-            expires_at  TEXT NOT NULL
-        )
-        """)
-
-
-        cols = [r[1] for r in conn.execute("PRAGMA table_info(users)")]
-        if "upload_bytes" not in cols:
-            conn.execute("ALTER TABLE users ADD COLUMN upload_bytes INTEGER NOT NULL DEFAULT 0")
-        if "download_bytes" not in cols:
-            conn.execute("ALTER TABLE users ADD COLUMN download_bytes INTEGER NOT NULL DEFAULT 0")
-        if "total_quota_bytes" not in cols:
-            conn.execute("ALTER TABLE users ADD COLUMN total_quota_bytes INTEGER NOT NULL DEFAULT 0")
-
-        if "first_traffic_notified" not in cols:
-            conn.execute("ALTER TABLE users ADD COLUMN first_traffic_notified INTEGER NOT NULL DEFAULT 0")
-
-
-        conn.execute("CREATE INDEX IF NOT EXISTS ix_users_uuid ON users(uuid)")
-        conn.execute("CREATE INDEX IF NOT EXISTS ix_users_sub_id ON users(sub_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS ix_users_status ON users(status)")
+# Шаги схемы менеджера по порядку; номер шага = PRAGMA user_version, только дописывать в конец.
+# Шаг 1 повторяет прежний _init_db и идемпотентен — старые базы без версии проходят его как есть.
+
+def _v1_baseline(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        sub_id      TEXT UNIQUE,
+        name        TEXT NOT NULL,
+        created_at  TEXT NOT NULL,
+        expires_at  TEXT NOT NULL,
+        status      TEXT NOT NULL,
+        uuid        TEXT NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS devices(
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id       TEXT,
+        uuid        TEXT NOT NULL UNIQUE,
+        name        TEXT NOT NULL,
+        os          TEXT,
+        status      TEXT NOT NULL,
+        created_at  TEXT NOT NULL,
+        expires_at  TEXT NOT NULL
+    )
+    """)
+
+    migrations.add_column(conn, "users", "upload_bytes", "INTEGER NOT NULL DEFAULT 0")
+    migrations.add_column(conn, "users", "download_bytes", "INTEGER NOT NULL DEFAULT 0")
+    migrations.add_column(conn, "users", "total_quota_bytes", "INTEGER NOT NULL DEFAULT 0")
+    migrations.add_column(conn, "users", "first_traffic_notified", "INTEGER NOT NULL DEFAULT 0")
+
+    # версия изменений: растёт на каждой мутации подписки, для /changes?since=
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_seq(
+        id          INTEGER PRIMARY KEY CHECK (id = 1),
+        version     INTEGER NOT NULL
+    )
+    """)
+    if migrations.add_column(conn, "users", "version", "INTEGER NOT NULL DEFAULT 0"):
+        conn.execute("UPDATE users SET version = id")
+    conn.execute(
+        "INSERT OR IGNORE INTO change_seq(id, version) "
+        "SELECT 1, COALESCE(MAX(version), 0) FROM users"
+    )
+    # счётчики трафика сюда не входят — они меняются каждую минуту и отдаются через /traffic
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_version_ins AFTER INSERT ON users
+    BEGIN
+        UPDATE change_seq SET version = version + 1 WHERE id = 1;
+        UPDATE users SET version = (SELECT version FROM change_seq WHERE id = 1) WHERE id = NEW.id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_version_upd
+    AFTER UPDATE OF sub_id, name, expires_at, status, uuid ON users
+    BEGIN
+        UPDATE change_seq SET version = version + 1 WHERE id = 1;
+        UPDATE users SET version = (SELECT version FROM change_seq WHERE id = 1) WHERE id = NEW.id;
+    END
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_users_uuid ON users(uuid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_users_sub_id ON users(sub_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_users_status ON users(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_users_name ON users(name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_users_version ON users(version)")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS idem(
+        key         TEXT PRIMARY KEY,
+        status      INTEGER NOT NULL,
+        body        BLOB NOT NULL,
+        created_at  INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_idem_created ON idem(created_at)")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS traffic_cursor(
+        uuid        TEXT PRIMARY KEY,
+        last_up     INTEGER NOT NULL DEFAULT 0,
+        last_down   INTEGER NOT NULL DEFAULT 0,
+        updated_at  TEXT NOT NULL
+    )
+    """)
 
 
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS traffic_cursor(
-            uuid        TEXT PRIMARY KEY,
-            last_up     INTEGER NOT NULL DEFAULT 0,
-            last_down   INTEGER NOT NULL DEFAULT 0,
-            updated_at  TEXT NOT NULL
-        )
-        """)
+MIGRATIONS: List[migrations.Step] = [
+    _v1_baseline,
+]
 
-        conn.commit()
+def _init_db():
+    os.makedirs(os.path.dirname(DB), exist_ok=True)
+    conn = _db()
+    try:
+        migrations.apply(conn, MIGRATIONS, "xray")
+    finally:
+        conn.close()
 
 
 
@@ -215,6 +272,30 @@ def switch_live_without_downtime():
     subprocess.run(["/usr/local/bin/xray-promote", idle], check=True)
 
 
+_switch_lock = threading.Lock()
+_switch_pending = False
+
+def _switch_after_commit() -> bool:
+    """switch после уже закоммиченной мутации. Ошибку не пробрасываем: 5xx не попадёт в idem,
+    и ретрай с тем же Idempotency-Key применил бы мутацию второй раз (повторная ротация).
+    Неудачный switch повторяет _stats_loop; конфиг строится из базы целиком, так что
+    повтор подхватит и эту мутацию. False — изменение пока не в живом конфиге."""
+    global _switch_pending
+    with _switch_lock:
+        try:
+            switch_live_without_downtime()
+            _switch_pending = False
+            return True
+        except Exception as e:
+            _switch_pending = True
+            print(f"[XRAY] switch failed, will retry: {e!r}")
+            return False
+
+def _retry_pending_switch():
+    if _switch_pending:
+        _switch_after_commit()
+
+
 def _load_cfg() -> dict:
     with open(CONF, "r") as f:
         return json.load(f)
@@ -384,6 +465,66 @@ def _notify_first_traffic(sub_id: str, total_bytes: int):
 
 app = FastAPI()
 
+
+_idem_locks: Dict[str, asyncio.Lock] = {}
+
+def _idem_get(key: str) -> Optional[sqlite3.Row]:
+    with _db() as conn:
+        return conn.execute(
+            "SELECT status, body FROM idem WHERE key=? AND created_at>=?",
+            (key, int(time.time()) - IDEM_TTL_SEC)
+        ).fetchone()
+
+def _idem_put(key: str, status: int, body: bytes):
+    with _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO idem(key, status, body, created_at) VALUES(?,?,?,?)",
+            (key, status, body, int(time.time()))
+        )
+        conn.commit()
+
+def _idem_purge():
+    with _db() as conn:
+        conn.execute("DELETE FROM idem WHERE created_at<?", (int(time.time()) - IDEM_TTL_SEC,))
+        conn.commit()
+
+
+@app.middleware("http")
+async def _idempotency(request, call_next):
+    """POST с Idempotency-Key выполняется один раз: повтор (ретрай бота после таймаута)
+    получает сохранённый ответ, без второго create/ротации и лишнего switch конфига.
+    Одновременные запросы с одним ключом ждут друг друга. 5xx не сохраняем — поэтому
+    после коммита мутации хендлеры не падают на switch (см. _switch_after_commit)."""
+    key = request.headers.get("idempotency-key")
+    if request.method != "POST" or not key or request.url.path not in IDEM_PATHS:
+        return await call_next(request)
+
+    scoped = f"{request.url.path}:{key}"
+    lock = _idem_locks.setdefault(scoped, asyncio.Lock())
+    try:
+        async with lock:
+            hit = await run_in_threadpool(_idem_get, scoped)
+            if hit:
+                return Response(
+                    bytes(hit["body"]), status_code=int(hit["status"]),
+                    media_type="application/json", headers={"Idempotent-Replay": "true"},
+                )
+            resp = await call_next(request)
+            body = b"".join([chunk async for chunk in resp.body_iterator])
+            if resp.status_code < 500:
+                await run_in_threadpool(_idem_put, scoped, resp.status_code, body)
+            return Response(
+                body, status_code=resp.status_code,
+                headers={k: v for k, v in resp.headers.items() if k.lower() != "content-length"},
+                media_type=resp.media_type,
+            )
+    finally:
+        if not lock.locked():
+            _idem_locks.pop(scoped, None)
+
+# gzip — снаружи идемпотентности, чтобы в idem лежали несжатые ответы
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 class CreateReq(BaseModel):
     name: Optional[str] = None
     days: Optional[int] = None
@@ -420,6 +561,24 @@ class SetNameReq(BaseModel):
     uuid: Optional[str] = None
     name: str
 
+class BatchOp(BaseModel):
+    op: str                       # pause|resume|revoke|rotate|refresh
+    id: Optional[str] = None
+    sub_id: Optional[str] = None
+    uuid: Optional[str] = None
+    rotate: Optional[bool] = True  # только для resume
+
+class BatchReq(BaseModel):
+    ops: List[BatchOp]
+
+class TrafficReq(BaseModel):
+    ids: List[str]                # sub_id или uuid
+
+class UsersBatchReq(BaseModel):
+    uuids: List[str] = []
+    sub_ids: List[str] = []
+    names: List[str] = []
+
 @app.on_event("startup")
 def _startup():
     _init_db()
@@ -432,6 +591,11 @@ def _stats_loop():
             pull_stats_for_all_users()
         except Exception as e:
             print(f"[stats] pull failed: {e}")
+        try:
+            _idem_purge()
+        except Exception as e:
+            print(f"[idem] purge failed: {e}")
+        _retry_pending_switch()
         time.sleep(60)
 
 
@@ -505,7 +669,7 @@ def create(r: CreateReq):
         )
         conn.commit()
 
-    switch_live_without_downtime()
+    switched = _switch_after_commit()
 
     return {
         "sub_id": sub_id,
@@ -513,7 +677,8 @@ def create(r: CreateReq):
         "name": name,
         "expires_at": FAR_FUTURE,
         "reality": _reality_link(user_uuid, "Нидерланды 🇳🇱"),
-        "sub_link": _sub_link(sub_id, b64=1)
+        "sub_link": _sub_link(sub_id, b64=1),
+        "switch_pending": not switched,
     }
 
 
@@ -539,13 +704,14 @@ def refresh(req: RefreshReq):
         conn.execute("UPDATE users SET uuid=? WHERE sub_id=?", (new_uid, sub_id))
         conn.commit()
 
-    switch_live_without_downtime()
+    switched = _switch_after_commit()
 
     return {
         "ok": True,
         "uuid": new_uid,
         "reality": _reality_link(new_uid, name),
-        "sub_link": _sub_link(sub_id, b64=1)
+        "sub_link": _sub_link(sub_id, b64=1),
+        "switch_pending": not switched,
     }
 
 
@@ -571,13 +737,14 @@ def rotate_any(req: RotateAnyReq):
         conn.execute("UPDATE users SET uuid=? WHERE sub_id=?", (new_uid, sub_id))
         conn.commit()
 
-    switch_live_without_downtime()
+    switched = _switch_after_commit()
 
     return {
         "ok": True,
         "uuid": new_uid,
         "reality": _reality_link(new_uid, name),
-        "sub_link": _sub_link(sub_id, b64=1)
+        "sub_link": _sub_link(sub_id, b64=1),
+        "switch_pending": not switched,
     }
 
 
@@ -602,27 +769,175 @@ def revoke(req: RevokeReq):
         conn.execute("UPDATE users SET status='deleted' WHERE sub_id=?", (sub_id,))
         conn.commit()
 
-    switch_live_without_downtime()
+    switched = _switch_after_commit()
+
+    return {"ok": True, "sub_id": sub_id, "uuid": uuid_, "switch_pending": not switched}
+
+_USER_COLS = """
+    id, sub_id, uuid, name, created_at, expires_at, status,
+    upload_bytes, download_bytes,
+    (upload_bytes + download_bytes) AS total_bytes,
+    version
+"""
+
+USERS_BATCH_MAX = 500
+LIST_PAGE_MAX = 5000
+
+
+def _current_version(con: sqlite3.Connection) -> int:
+    r = con.execute("SELECT version FROM change_seq WHERE id = 1").fetchone()
+    return int(r[0]) if r else 0
 
-    return {"ok": True, "sub_id": sub_id, "uuid": uuid_}
 
 @app.get("/list")
-def list_users():
+def list_users(
+    after: int = Query(0, ge=0, description="id последней записи предыдущей страницы"),
+    limit: int = Query(0, ge=0, le=LIST_PAGE_MAX, description="Размер страницы (0 = весь список массивом)"),
+):
     with _db() as con:
+        if not limit:
+            rows = con.execute(
+                f"SELECT {_USER_COLS} FROM users WHERE status!='deleted' ORDER BY id"
+            ).fetchall()
+            return [dict(r) for r in rows]
+
+        # версия берётся до страницы: всё, что изменится после, придёт через /changes?since=version
+        version = _current_version(con)
         rows = con.execute(
-            """
-            SELECT
-                id, sub_id, uuid, name, created_at, expires_at, status,
-                upload_bytes, download_bytes,
-                (upload_bytes + download_bytes) AS total_bytes
-            FROM users
-            WHERE status!='deleted'
-            ORDER BY id
-            """
+            f"SELECT {_USER_COLS} FROM users WHERE status!='deleted' AND id > ? ORDER BY id LIMIT ?",
+            (after, limit)
         ).fetchall()
+    items = [dict(r) for r in rows]
+    return {
+        "items": items,
+        "next_after": items[-1]["id"] if len(items) == limit else None,
+        "version": version,
+    }
+
+
+@app.get("/changes")
+def changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=LIST_PAGE_MAX),
+):
+    """Подписки, изменённые после версии since (включая удалённые — status='deleted')."""
+    with _db() as con:
+        rows = con.execute(
+            f"SELECT {_USER_COLS} FROM users WHERE version > ? ORDER BY version LIMIT ?",
+            (since, limit)
+        ).fetchall()
+        current = _current_version(con)
+    items = [dict(r) for r in rows]
+    return {
+        "items": items,
+        "version": items[-1]["version"] if items else since,
+        "current": current,
+        "has_more": len(items) == limit,
+    }
+
+
+_DBSTATS_ORDERS = ("total_ms", "max_ms", "calls", "rows", "slow")
+
+@app.get("/debug/dbstats")
+def debug_dbstats(
+    limit: int = Query(20, ge=1, le=200),
+    order: str = Query("total_ms"),
+    reset: bool = Query(False),
+):
+    """Худшие формы SQL этого процесса (при DB_PROFILE=1). reset=true — сбросить после выдачи."""
+    if order not in _DBSTATS_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order must be one of {', '.join(_DBSTATS_ORDERS)}")
+    items = sqlprof.top(limit, order) if sqlprof.ENABLED else []
+    if reset:
+        sqlprof.reset()
+    return {"enabled": sqlprof.ENABLED, "slow_ms": sqlprof.SLOW_MS, "order": order, "items": items}
+
+
+def _users_where(con: sqlite3.Connection, column: str, values: List[str]) -> list[dict]:
+    vals = [v.strip() for v in values if v and v.strip()]
+    if not vals:
+        return []
+    marks = ",".join("?" * len(vals))
+    rows = con.execute(
+        f"SELECT {_USER_COLS} FROM users WHERE status!='deleted' AND {column} IN ({marks}) ORDER BY id",
+        vals
+    ).fetchall()
     return [dict(r) for r in rows]
 
 
+@app.get("/users/by-uuid/{user_uuid}")
+def user_by_uuid(user_uuid: str):
+    with _db() as con:
+        items = _users_where(con, "uuid", [user_uuid])
+    if not items:
+        raise HTTPException(status_code=404, detail="user not found")
+    return items[0]
+
+
+@app.get("/users/by-sub/{sub_id}")
+def user_by_sub(sub_id: str):
+    with _db() as con:
+        items = _users_where(con, "sub_id", [sub_id])
+    if not items:
+        raise HTTPException(status_code=404, detail="user not found")
+    return items[0]
+
+
+@app.get("/users/by-name/{name}")
+def users_by_name(name: str):
+    # одно имя (tg_<id>) может быть у нескольких подписок — по одной на устройство
+    with _db() as con:
+        items = _users_where(con, "name", [name])
+    return {"name": name, "count": len(items), "items": items}
+
+
+@app.post("/users/batch")
+def users_batch(req: UsersBatchReq):
+    total = len(req.uuids) + len(req.sub_ids) + len(req.names)
+    if total > USERS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"too many keys (max {USERS_BATCH_MAX})")
+    with _db() as con:
+        return {
+            "by_uuid": {u["uuid"]: u for u in _users_where(con, "uuid", req.uuids)},
+            "by_sub":  {u["sub_id"]: u for u in _users_where(con, "sub_id", req.sub_ids)},
+            "by_name": _group_by_name(_users_where(con, "name", req.names)),
+        }
+
+
+@app.post("/traffic")
+def traffic_bulk(req: TrafficReq):
+    """Трафик по списку sub_id/uuid из счётчиков в БД (их обновляет _stats_loop раз в минуту),
+    без вызовов xray api на каждый запрос — в отличие от /sub/{id}."""
+    ids = [i.strip() for i in req.ids if i and i.strip()]
+    if len(ids) > USERS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"too many ids (max {USERS_BATCH_MAX})")
+    items: Dict[str, dict] = {}
+    if ids:
+        marks = ",".join("?" * len(ids))
+        with _db() as con:
+            rows = con.execute(
+                f"SELECT sub_id, uuid, upload_bytes, download_bytes FROM users "
+                f"WHERE sub_id IN ({marks}) OR uuid IN ({marks})",
+                ids + ids
+            ).fetchall()
+        wanted = set(ids)
+        for r in rows:
+            up = int(r["upload_bytes"] or 0)
+            down = int(r["download_bytes"] or 0)
+            rec = {"upload": up, "download": down, "total": up + down}
+            for key in (r["sub_id"], r["uuid"]):
+                if key in wanted:
+                    items[key] = rec
+    return {"items": items}
+
+
+def _group_by_name(items: list[dict]) -> Dict[str, list[dict]]:
+    out: Dict[str, list[dict]] = {}
+    for u in items:
+        out.setdefault(u["name"], []).append(u)
+    return out
+
+
 
 
 _active_sessions_cache: Dict[str, List[tuple[float, Optional[str]]]] = {}
@@ -717,7 +1032,8 @@ def _kick_uuid_by_sub(sub_id: str, old_uuid: str, reason: str = "multi_session")
         conn.commit()
 
 
-    switch_live_without_downtime()
+    # uuid уже сменён в базе — бот должен узнать о нём, даже если switch не удался
+    _switch_after_commit()
 
     try:
         _notify_bot(sub_id, old_uuid, new_uuid, reason=reason)
@@ -850,9 +1166,9 @@ def pause(req: PauseReq):
         conn.execute("UPDATE users SET status='paused' WHERE sub_id=?", (sub_id,))
         conn.commit()
 
-    switch_live_without_downtime()
+    switched = _switch_after_commit()
 
-    return {"ok": True, "sub_id": sub_id, "uuid": uuid_}
+    return {"ok": True, "sub_id": sub_id, "uuid": uuid_, "switch_pending": not switched}
 
 
 @app.post("/resume")
@@ -878,26 +1194,109 @@ def resume(req: ResumeReq):
         with _db() as conn:
             conn.execute("UPDATE users SET uuid=?, status='active' WHERE sub_id=?", (new_uuid, sub_id))
             conn.commit()
-        switch_live_without_downtime()
+        switched = _switch_after_commit()
         return {
             "ok": True,
             "uuid": new_uuid,
             "reality": _reality_link(new_uuid, name),
-            "sub_link": _sub_link(sub_id, b64=1)
+            "sub_link": _sub_link(sub_id, b64=1),
+            "switch_pending": not switched,
         }
     else:
         with _db() as conn:
             conn.execute("UPDATE users SET status='active' WHERE sub_id=?", (sub_id,))
             conn.commit()
-        switch_live_without_downtime()
+        switched = _switch_after_commit()
         return {
             "ok": True,
             "uuid": old,
             "reality": _reality_link(old, name),
-            "sub_link": _sub_link(sub_id, b64=1)
+            "sub_link": _sub_link(sub_id, b64=1),
+            "switch_pending": not switched,
         }
 
 
+BATCH_MAX = int(os.environ.get("XRAY_BATCH_MAX", "1000"))
+_BATCH_OPS = {"pause", "resume", "revoke", "rotate", "refresh"}
+
+
+@app.post("/batch")
+def batch(req: BatchReq):
+    """Пачка pause/resume/revoke/rotate/refresh: всё в одной транзакции и один switch конфига.
+    Ошибка отдельной операции не откатывает остальные — она просто попадает в results."""
+    if len(req.ops) > BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"too many ops (max {BATCH_MAX})")
+
+    idents = [(o.id or o.sub_id or o.uuid or "").strip() for o in req.ops]
+    wanted = sorted({i for i in idents if i})
+    results: list[dict] = []
+    changed = False
+
+    with _db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        by_key: Dict[str, dict] = {}
+        if wanted:
+            marks = ",".join("?" * len(wanted))
+            rows = conn.execute(
+                f"SELECT sub_id, uuid, name, status FROM users "
+                f"WHERE sub_id IN ({marks}) OR uuid IN ({marks})",
+                wanted + wanted
+            ).fetchall()
+            for r in rows:
+                u = dict(r)
+                by_key[u["sub_id"]] = u
+                by_key[u["uuid"]] = u
+
+        for op, ident in zip(req.ops, idents):
+            kind = (op.op or "").strip().lower()
+            res: Dict[str, Any] = {"op": kind, "id": ident}
+            results.append(res)
+            if kind not in _BATCH_OPS:
+                res.update(ok=False, error="unknown op")
+                continue
+            u = by_key.get(ident)
+            if not ident or u is None:
+                res.update(ok=False, error="sub_or_uuid not found")
+                continue
+
+            sub_id = u["sub_id"]
+            if kind == "pause":
+                conn.execute("UPDATE users SET status='paused' WHERE sub_id=?", (sub_id,))
+                u["status"] = "paused"
+            elif kind == "revoke":
+                conn.execute("UPDATE users SET status='deleted' WHERE sub_id=?", (sub_id,))
+                u["status"] = "deleted"
+            elif kind == "resume" and not op.rotate:
+                conn.execute("UPDATE users SET status='active' WHERE sub_id=?", (sub_id,))
+                u["status"] = "active"
+            else:
+                # rotate / refresh / resume с ротацией — новый uuid
+                new_uuid = str(uuid.uuid4())
+                if kind == "resume":
+                    conn.execute("UPDATE users SET uuid=?, status='active' WHERE sub_id=?", (new_uuid, sub_id))
+                    u["status"] = "active"
+                else:
+                    conn.execute("UPDATE users SET uuid=? WHERE sub_id=?", (new_uuid, sub_id))
+                by_key.pop(u["uuid"], None)
+                u["uuid"] = new_uuid
+                by_key[new_uuid] = u
+
+            changed = True
+            res.update(ok=True, sub_id=sub_id, uuid=u["uuid"], status=u["status"],
+                       sub_link=_sub_link(sub_id, b64=1))
+        conn.commit()
+
+    switched = _switch_after_commit() if changed else True
+
+    return {
+        "ok": True,
+        "switch_pending": not switched,
+        "applied": sum(1 for r in results if r.get("ok")),
+        "failed": sum(1 for r in results if not r.get("ok")),
+        "results": results,
+    }
+
+
 def _xray_stats_get(name: str) -> int:
     XRAY = XRAY_BIN
     def query_one(port: int, metric: str) -> int:
@@ -0,0 +1,132 @@
+"""Суточное списание: прежний цикл по устройствам (транзакция на устройство) против
+db.bill_daily (одна транзакция на всё). Обе версии прогоняются на копиях одной базы,
+итоговое состояние (балансы, устройства, платежи) сравнивается по sha256.
+
+    python scripts/bench_billing.py [--users 50000] [--devices 100000] [--fee 200]
+
+База — во временном каталоге, рабочая bot.db не трогается.
+"""
+import argparse
+import hashlib
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot.services import db  # noqa: E402
+
+
+def seed(path: Path, users: int, devices: int, sod: int):
+    db.DB_PATH = path
+    db.init()
+    rnd = random.Random(1)
+    created = sod - 30 * 86400
+    with db.db() as con:
+        con.executemany(
+            "INSERT INTO users(tg_id, created_at, balance_cents) VALUES(?,?,?)",
+            [(u, created, rnd.choice((0, 100, 200, 500, 1000, 5000))) for u in range(1, users + 1)],
+        )
+        rows = []
+        for i in range(devices):
+            activated = sod - rnd.randint(2, 20) * 86400
+            last_billed = sod - 86400
+            if rnd.random() < 0.1:
+                # старые записи хранят время в миллисекундах
+                activated, last_billed = activated * 1000, last_billed * 1000
+            status = "active" if rnd.random() < 0.8 else "paused"
+            rows.append((rnd.randint(1, users), f"u{i}", f"dev{i}", status, created, activated, last_billed, f"s{i}"))
+        con.executemany(
+            "INSERT INTO devices(tg_id, uuid, name, status, created_at, activated_at, last_billed, sub_id) "
+            "VALUES(?,?,?,?,?,?,?,?)",
+            rows,
+        )
+    db.close()
+
+
+# --- прежняя версия: billing_candidates + charge_daily / pause_unpaid_device ---
+
+def old_billing(fee: int, sod: int) -> int:
+    with db.db_read() as con:
+        rows = [dict(r) for r in con.execute(
+            "SELECT id, uuid, tg_id, activated_at, last_billed FROM devices "
+            "WHERE status='active' AND activated_at IS NOT NULL ORDER BY id"
+        )]
+    charged = 0
+    for r in rows:
+        activated_at = db.epoch_sec(r["activated_at"])
+        last_billed = db.epoch_sec(r["last_billed"])
+        if activated_at <= 0 or activated_at > sod or last_billed >= sod:
+            continue
+        uuid, tg_id = r["uuid"], int(r["tg_id"])
+        with db.db() as con:
+            res = con.execute(
+                "UPDATE users SET balance_cents = balance_cents - ? WHERE tg_id=? AND balance_cents >= ?",
+                (fee, tg_id, fee),
+            )
+            if res.rowcount == 1:
+                con.execute(
+                    "INSERT INTO payments(tg_id, amount_cents, method, ref, created_at) VALUES(?,?,?,?,?)",
+                    (tg_id, -fee, "daily", f"uuid:{uuid}", sod),
+                )
+                con.execute("UPDATE devices SET last_billed=? WHERE uuid=?", (sod, uuid))
+                charged += 1
+                continue
+        with db.db() as con:
+            con.execute("UPDATE devices SET status='paused' WHERE uuid=?", (uuid,))
+        db.log_event(tg_id, "auto_pause", f"uuid={uuid}")
+    return charged
+
+
+def state_hash() -> str:
+    h = hashlib.sha256()
+    with db.db_read() as con:
+        for sql in (
+            "SELECT tg_id, balance_cents FROM users ORDER BY tg_id",
+            "SELECT id, status, last_billed FROM devices ORDER BY id",
+            "SELECT tg_id, amount_cents, method, ref, created_at FROM payments ORDER BY tg_id, ref",
+        ):
+            for r in con.execute(sql):
+                h.update(repr(tuple(r)).encode())
+    return h.hexdigest()
+
+
+def run(path: Path, fn) -> tuple[float, str, Any]:
+    db.DB_PATH = path
+    t0 = time.perf_counter()
+    res = fn()
+    dt = time.perf_counter() - t0
+    digest = state_hash()
+    db.close()
+    return dt, digest, res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--devices", type=int, default=100000)
+    ap.add_argument("--fee", type=int, default=200)
+    args = ap.parse_args()
+    sod = int(time.time()) // 86400 * 86400
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "seed.db"
+        seed(base, args.users, args.devices, sod)
+        for name in ("old.db", "new.db"):
+            shutil.copy(base, Path(tmp) / name)
+
+        t_old, h_old, n_old = run(Path(tmp) / "old.db", lambda: old_billing(args.fee, sod))
+        t_new, h_new, res = run(Path(tmp) / "new.db", lambda: db.bill_daily(args.fee, sod))
+
+    print(f"{args.users} users, {args.devices} devices, fee {args.fee}c")
+    print(f"old per-device loop: {t_old:7.2f} s  ({n_old} charged)")
+    print(f"bill_daily:          {t_new:7.2f} s  ({res['charged']} charged, {len(res['paused'])} paused)")
+    print("final state:", "identical" if h_old == h_new else "DIFFERENT")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Накладные расходы на вызов в db.py: соединение на каждый вызов (как было) против
+постоянного писателя и пула читателей (db() / db_read()).
+
+    python scripts/bench_db_pool.py [--users 2000] [--iters 10000]
+
+База — во временном каталоге, рабочая bot.db не трогается.
+"""
+import argparse
+import contextlib
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot.services import db  # noqa: E402
+
+
+@contextlib.contextmanager
+def db_per_call():
+    """Прежний db(): новое соединение и PRAGMA на каждый вызов."""
+    con = sqlite3.connect(db.DB_PATH, timeout=10.0)
+    con.row_factory = sqlite3.Row
+    try:
+        con.execute("PRAGMA foreign_keys=ON;")
+        con.execute("PRAGMA busy_timeout=5000;")
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        yield con
+        con.commit()
+    finally:
+        con.close()
+
+
+def read_balance(ctx, tg_id: int) -> int:
+    with ctx() as con:
+        r = con.execute("SELECT balance_cents FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+        return int(r[0]) if r else 0
+
+
+def write_username(ctx, tg_id: int, name: str):
+    with ctx() as con:
+        con.execute("UPDATE users SET username=? WHERE tg_id=?", (name, tg_id))
+
+
+def timed(fn, ctx, ids: list[int], *args) -> float:
+    t0 = time.perf_counter()
+    for tg_id in ids:
+        fn(ctx, tg_id, *args)
+    return (time.perf_counter() - t0) / len(ids) * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--iters", type=int, default=10000)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(tmp) / "bench.db"
+        db.init()
+        now = int(time.time())
+        with db.db() as con:
+            con.executemany(
+                "INSERT INTO users(tg_id, created_at, balance_cents) VALUES(?,?,?)",
+                [(i, now, 1000) for i in range(1, args.users + 1)],
+            )
+
+        rnd = random.Random(1)
+        reads = [rnd.randint(1, args.users) for _ in range(args.iters)]
+        writes = reads[: max(1, args.iters // 5)]
+
+        rows = [
+            ("read  (SELECT by pk)", timed(read_balance, db_per_call, reads),
+             timed(read_balance, db.db_read, reads)),
+            ("write (UPDATE + commit)", timed(write_username, db_per_call, writes, "a"),
+             timed(write_username, db.db, writes, "b")),
+        ]
+        db.close()
+
+    print(f"{args.users} users, {args.iters} reads / {len(writes)} writes")
+    print(f"{'':26}{'per-call':>12}{'pooled':>12}")
+    for name, before, after in rows:
+        print(f"{name:26}{before:>9.1f} us{after:>9.1f} us   x{before / after:.0f}")
+
+
+if __name__ == "__main__":
+    main()
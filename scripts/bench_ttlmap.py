@@ -0,0 +1,70 @@
+"""cooldown-карта на обычном dict (как было) против cache.TTLMap: время на операцию
+и память после потока уникальных ключей (uuid за долгий аптайм).
+
+    python scripts/bench_ttlmap.py [--keys 500000]
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot.services.cache import TTLMap  # noqa: E402
+
+COOLDOWN_SEC = 300
+
+
+def plain_dict(keys: int):
+    """Прежний _cooldown_ok: запись на каждый ключ, ничего не удаляется."""
+    last: dict[str, float] = {}
+    for i in range(keys):
+        now = time.time()
+        k = f"u{i}"
+        if now - last.get(k, 0) >= COOLDOWN_SEC:
+            last[k] = now
+    return last
+
+
+def ttl_map(keys: int, ttl: float, maxsize: int):
+    m = TTLMap(maxsize=maxsize, ttl=ttl)
+    for i in range(keys):
+        m.claim(f"u{i}")
+    return m
+
+
+def measure(fn, *args) -> tuple[float, int, float]:
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = fn(*args)
+    dt = time.perf_counter() - t0
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return dt, len(obj), mem
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--keys", type=int, default=500000)
+    args = ap.parse_args()
+
+    cases = [
+        ("dict", plain_dict, args.keys),
+        ("TTLMap, capped 100k", ttl_map, args.keys, COOLDOWN_SEC, 100_000),
+        ("TTLMap, keys expire", ttl_map, args.keys, 0.01, 100_000),
+    ]
+    print(f"{args.keys} unique keys (tracemalloc on, timings are relative)")
+    for name, fn, *fn_args in cases:
+        dt, size, mem = measure(fn, *fn_args)
+        print(f"{name:22}{dt / args.keys * 1e6:7.2f} us/op  {size:>7} entries  {mem / 1e6:6.1f} MB")
+
+    # карта без записей: просроченное уходит на чтении (не чаще SWEEP_EVERY_SEC) или через sweep()
+    m = ttl_map(10_000, 0.01, 100_000)
+    time.sleep(0.02)
+    m.get("missing")
+    print(f"idle map after one read: {len(m._data)} entries left of 10000")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from bot.services import api
+from bot.services.backends import Backend, Router
+
+
+@pytest.fixture
+def single_backend(monkeypatch):
+    r = Router([Backend("http://a")])
+    monkeypatch.setattr(api, "router", r)
+    monkeypatch.setattr(api, "MUTATION_RETRIES", 0)
+    return r
+
+
+def test_single_backend_open_circuit_returns_error_dict(single_backend, monkeypatch):
+    calls = []
+
+    async def dead(method, url, path, **kw):
+        calls.append(url)
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(api, "_send", dead)
+
+    first = asyncio.run(api.create_user("tg_1"))
+    assert first["_error"] and calls == ["http://a/create"]
+    assert single_backend.order() == []
+
+    # цепь разомкнута, других нод нет: ошибка словарём, без исключения и без похода на ноду
+    second = asyncio.run(api.create_user("tg_1"))
+    assert second["_error"] == "no API backends available"
+    assert calls == ["http://a/create"]
+
+    assert asyncio.run(api.api_post("/pause", {"id": "x"}))["_error"]
+    assert asyncio.run(api.api_get("/changes", {"since": "0"}))["_error"]